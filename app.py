@@ -1,53 +1,257 @@
 import streamlit as st
-import sqlite3
-from datetime import datetime
-import csv
-from fpdf import FPDF
-import matplotlib.pyplot as plt
+from datetime import datetime, timedelta, timezone
+import io
 import re
-import pandas as pd
-import tempfile
+import secrets
+import bisect
+import hashlib
+import hmac
+import itertools
 import os
+import threading
+import time
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import (
+    BACKEND, DB_PATH, SHARD_COUNT, MYSQL_CONFIG, IMPORT_BATCH_ROWS, TIME_BUCKETS, ConnectionPool,
+    DuplicateEmailError, ExpenseSnapshot, Metrics, MySQLRepository, SQLiteRepository, ShardedRepository,
+    get_shard_layout, initialize_db, search_terms, set_shard_layout, shard_path, snapshot_path,
+)
+
+# Open every database read-only and leave the schema as it is, for batch
+# jobs that must not write (manage.py statements sets it in its workers)
+READ_ONLY = os.environ.get('EXPENSE_TRACKER_READ_ONLY') == '1'
+
+# Passwords are stored as salted PBKDF2-SHA256 hashes of this many
+# iterations; raising it rehashes each password at its owner's next login.
+# At most PASSWORD_HASH_THREADS hashes run at once, however many sessions
+# log in together.
+PASSWORD_HASH_ITERATIONS = int(os.environ.get('EXPENSE_TRACKER_PASSWORD_ITERATIONS', '600000'))
+PASSWORD_HASH_THREADS = 2
+# Seconds a login can be resumed from its session token after a reload or
+# reconnect, and how many tokens a server keeps
+SESSION_TTL = int(os.environ.get('EXPENSE_TRACKER_SESSION_TTL', str(12 * 3600)))
+SESSION_MAX_TOKENS = 100000
+
+# The debug panel shows every user's queries and can write the metrics to
+# METRICS_FILE, so a server only offers it (at ?debug=1) when this is set
+DEBUG_PANEL = os.environ.get('EXPENSE_TRACKER_DEBUG_PANEL') == '1'
+METRICS_FILE = os.environ.get('EXPENSE_TRACKER_METRICS_FILE', 'expense_tracker_metrics')
+
+@st.cache_resource
+def get_metrics():
+    return Metrics()
+
+# One pool per server process, shared by all sessions and reruns. The
+# schema is brought up to date when the pool is first created, so pages that
+# never touch the database never pay for it.
+@st.cache_resource
+def get_pool():
+    pool = ConnectionPool(DB_PATH, get_metrics(), read_only=READ_ONLY)
+    initialize_db(pool)
+    return pool
 
 # Database connection setup
 def connect_to_db():
-    return sqlite3.connect('expense_tracker.db')
-
-# User table creation
-def initialize_db():
-    db = connect_to_db()
-    cursor = db.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            userid INTEGER PRIMARY KEY AUTOINCREMENT,
-            username VARCHAR(255),
-            email VARCHAR(255),
-            password VARCHAR(255)
-        )
-    """)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS expenses (
-            expid INTEGER PRIMARY KEY AUTOINCREMENT,
-            userid INTEGER,
-            category VARCHAR(255),
-            description TEXT,
-            amount REAL,
-            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (userid) REFERENCES users(userid)
-        )
-    """)
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS income (
-            income_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            income_amount DECIMAL(10, 2),
-            FOREIGN KEY (user_id) REFERENCES users(userid)
-        )
-    ''')
-    db.commit()
-    db.close()
-
-initialize_db()
+    return get_pool().acquire()
+
+# Pools for every shard, schema up to date. Refuses to start when DB_PATH
+# records a different shard count than SHARD_COUNT, since users would be
+# looked for on the wrong shards; a database without users takes whatever
+# count it is first opened with.
+@st.cache_resource
+def get_shard_pools():
+    pools = [get_pool()]
+    db = pools[0].acquire()
+    try:
+        layout = get_shard_layout(db)
+        if layout != SHARD_COUNT:
+            if db.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+                raise RuntimeError(f"{DB_PATH} is laid out for {layout} shards but EXPENSE_TRACKER_SHARDS is "
+                                   f"{SHARD_COUNT}; run manage.py reshard --shards {SHARD_COUNT}")
+            set_shard_layout(db, SHARD_COUNT)
+    finally:
+        db.close()
+    for index in range(1, SHARD_COUNT):
+        pool = ConnectionPool(shard_path(index), get_metrics(), read_only=READ_ONLY)
+        initialize_db(pool)
+        pools.append(pool)
+    return pools
+
+# One repository per server process, for the backend picked by BACKEND
+@st.cache_resource
+def get_repository():
+    if BACKEND == "mysql":
+        repository = MySQLRepository(MYSQL_CONFIG, get_metrics())
+        repository.initialize()
+        return repository
+    pools = get_shard_pools()
+    if len(pools) == 1:
+        return SQLiteRepository(pools[0])
+    return ShardedRepository(pools)
+
+PASSWORD_SCHEME = "pbkdf2_sha256"
+
+def hash_password(password, iterations=None):
+    iterations = iterations or PASSWORD_HASH_ITERATIONS
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, iterations)
+    return f"{PASSWORD_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+# (matches, needs rehashing) for a password against its stored form: a
+# PASSWORD_SCHEME hash, or 'plain$' and the password itself for one stored
+# before hashing (see PASSWORD_HASHES). Every check costs at least
+# PASSWORD_HASH_ITERATIONS, so the response time does not single out the
+# accounts still waiting to be rehashed.
+def check_password(password, stored):
+    scheme, _, rest = (stored or "").partition("$")
+    iterations = 0
+    if scheme == PASSWORD_SCHEME:
+        iterations, salt, digest = rest.split("$")
+        iterations = int(iterations)
+        actual = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), iterations)
+        matches = hmac.compare_digest(actual, bytes.fromhex(digest))
+    else:
+        matches = scheme == "plain" and hmac.compare_digest(password.encode(), rest.encode())
+    if iterations < PASSWORD_HASH_ITERATIONS:
+        hashlib.pbkdf2_hmac("sha256", password.encode(), b"", PASSWORD_HASH_ITERATIONS - iterations)
+    return matches, iterations < PASSWORD_HASH_ITERATIONS
+
+# Runs the hashing of every session's logins, registrations and resets.
+# pbkdf2_hmac releases the GIL, so the other sessions' reruns keep going
+# while it works, and a burst of logins holds at most this many cores.
+@st.cache_resource
+def get_password_executor():
+    return ThreadPoolExecutor(max_workers=PASSWORD_HASH_THREADS, thread_name_prefix="password-hash")
+
+def hash_in_pool(password):
+    return get_password_executor().submit(hash_password, password).result()
+
+# (userid, username, has income) when the password matches. An unknown
+# email costs a hash too, so the response time does not tell which emails
+# are registered. A plaintext or cheaper hash is replaced on the way.
+def authenticate(email, password):
+    repository = get_repository()
+    row = repository.find_login(email)
+    if row is None:
+        hash_in_pool(password)
+        return None
+    user_id, username, stored, has_income = row
+    matches, stale = get_password_executor().submit(check_password, password, stored).result()
+    if not matches:
+        return None
+    if stale:
+        repository.set_password(email, hash_in_pool(password))
+    return user_id, username, has_income
+
+# Logged-in sessions by the random token kept in the SESSION_COOKIE cookie,
+# so a reload or a reconnect that starts a new Streamlit session resumes the
+# login without reading users. A token is good for one resume, which hands
+# out its replacement. Tokens live in this server's memory: other app nodes
+# and a restart do not know them, and those sessions log in again.
+class SessionTokens:
+    def __init__(self, ttl, max_tokens):
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def issue(self, user_id, username):
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            self._entries[token] = (user_id, username, time.monotonic() + self.ttl)
+            while len(self._entries) > self.max_tokens:
+                self._entries.popitem(last=False)
+        return token
+
+    # (userid, username) of a live token, which is used up, or None
+    def take(self, token):
+        with self._lock:
+            entry = self._entries.pop(token, None)
+            if entry is None or entry[2] < time.monotonic():
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[:2]
+
+    def revoke(self, token):
+        with self._lock:
+            self._entries.pop(token, None)
+
+    # After a password reset; tokens on other app nodes run out with SESSION_TTL
+    def revoke_user(self, user_id):
+        with self._lock:
+            for token in [token for token, entry in self._entries.items() if entry[0] == user_id]:
+                del self._entries[token]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "tokens": len(self._entries)}
+
+@st.cache_resource
+def get_session_tokens():
+    return SessionTokens(SESSION_TTL, SESSION_MAX_TOKENS)
+
+# Streamlit cannot set cookies from the server, so a script the page runs
+# writes it. It is readable by scripts on the page (there is no HttpOnly
+# from JavaScript); SameSite=Strict keeps other sites from sending it.
+SESSION_COOKIE = "expense_tracker_session"
+
+# Sets the session's token and has the next run write it to the cookie,
+# or clear the cookie when token is None
+def set_session_token(token):
+    st.session_state.token = token
+    st.session_state.pending_cookie = token or ""
+
+def write_session_cookie():
+    token = st.session_state.pop("pending_cookie", None)
+    if token is None:
+        return
+    st.html(f"""<script>
+        document.cookie = "{SESSION_COOKIE}={token}; Max-Age={SESSION_TTL if token else 0}; Path=/; SameSite=Strict"
+            + (location.protocol === "https:" ? "; Secure" : "");
+    </script>""", unsafe_allow_javascript=True)
+
+def start_session(user_id, username, has_income):
+    st.session_state.userid, st.session_state.username = user_id, username
+    set_session_token(get_session_tokens().issue(user_id, username))
+    st.session_state.page = "menu" if has_income else "income"
+
+# Picks up the login the browser's cookie belongs to, for a session that
+# has none yet, and swaps the token for a new one
+def resume_session():
+    token = st.context.cookies.get(SESSION_COOKIE)
+    if not token:
+        return
+    user = get_session_tokens().take(token)
+    if user is None:
+        set_session_token(None)
+        return
+    st.session_state.userid, st.session_state.username = user
+    set_session_token(get_session_tokens().issue(*user))
+    if st.session_state.page in ("home", "login", "register", "forgot_password"):
+        st.session_state.page = "menu" if get_repository().has_income(user[0]) else "income"
+
+def end_session():
+    get_session_tokens().revoke(st.session_state.get("token"))
+    set_session_token(None)
+    st.session_state.userid = None
+    st.session_state.username = None
+
+DEFAULT_CATEGORIES = ["Food", "Transport", "Shopping", "Utilities", "Entertainment", "Health"]
+
+# Options for the category selectboxes: the defaults, then the user's own in
+# the order they were added. Cleared for the user when they add one; the
+# ttl bounds how long other app nodes keep showing the old list.
+@st.cache_data(max_entries=1024, ttl=300, show_spinner=False)
+def get_categories(user_id):
+    names = list(DEFAULT_CATEGORIES)
+    names += [name for name in get_repository().categories(user_id) if name not in names]
+    return names
 
 # Helper functions
 def validate_email(email):
@@ -58,81 +262,803 @@ def validate_password(password):
     return len(password) > 0
 
 def get_balance(user_id):
-    db = connect_to_db()
-    cursor = db.cursor()
-    
-    # Get total income for the user
-    cursor.execute("SELECT SUM(income_amount) FROM income WHERE user_id=?", (user_id,))
-    total_income = cursor.fetchone()[0] or 0  # If no income, set to 0
-    
-    # Get total expenses for the user
-    cursor.execute("SELECT SUM(amount) FROM expenses WHERE userid=?", (user_id,))
-    total_expenses = cursor.fetchone()[0] or 0  # If no expenses, set to 0
-    
-    # Ensure both values are float for subtraction
-    total_income = float(total_income)
-    total_expenses = float(total_expenses)
-    
-    db.close()
+    # Totals are kept current by the rollup triggers
+    total_income, total_expenses = get_repository().get_totals(user_id)
     
     # Calculate balance
     balance = total_income - total_expenses
     return balance
 
-def generate_pdf(rows, user_id):
-    filename = "expenses.pdf"
+EXPORT_COLUMNS = ["Category", "Description", "Amount", "Date"]
+EXPORT_CHUNK_ROWS = 5000
+
+# Yields the user's matching expenses as (category, description, amount,
+# date) rows, one chunk at a time. Pages by expid so only a single chunk is
+# ever held in memory, and the connection goes back to the pool between pages.
+def iter_expense_rows(user_id, chunk_rows=EXPORT_CHUNK_ROWS, **filters):
+    repository = get_repository()
+    last_expid = 0
+    while True:
+        rows = repository.expense_chunk(user_id, filters, last_expid, chunk_rows)
+        if not rows:
+            return
+        last_expid = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+# Yields the user's expenses as CSV text, one chunk of rows at a time
+def iter_expense_csv(user_id, chunk_rows=EXPORT_CHUNK_ROWS, **filters):
+    import csv
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    for rows in iter_expense_rows(user_id, chunk_rows, **filters):
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+IMPORT_MAX_REJECTS_REPORTED = 100
+
+class ImportResult:
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.rejects = []  # (line number, reason), capped
+        self.categories = set()
+
+# Imports a CSV in the export layout (Category, Description, Amount, Date).
+# The file is parsed in batches; each batch is validated with column
+# operations, inserted with executemany in one transaction, and its totals
+# are added to the rollups in the same transaction. A blank Date means now.
+# progress(result, fraction) is called after every batch; fraction is None
+# when the source size is unknown.
+def import_expenses_csv(user_id, source, batch_rows=IMPORT_BATCH_ROWS, progress=None):
+    import pandas as pd
+    result = ImportResult()
+    size = None
+    if hasattr(source, "seek"):
+        size = source.seek(0, os.SEEK_END)
+        source.seek(0)
+    reader = pd.read_csv(source, chunksize=batch_rows, dtype=str, keep_default_na=False)
+    for batch in reader:
+        missing = [column for column in EXPORT_COLUMNS if column not in batch.columns]
+        if missing:
+            raise ValueError(f"Missing columns: {', '.join(missing)}")
+
+        category = batch["Category"].str.strip()
+        description = batch["Description"].str.strip()
+        amount = pd.to_numeric(batch["Amount"], errors="coerce")
+        date_text = batch["Date"].str.strip()
+        date = pd.to_datetime(date_text, errors="coerce", format="ISO8601")
+        date = date.where(date_text != "", pd.Timestamp.now(tz="UTC").tz_localize(None).floor("s"))
+
+        checks = [
+            (category == "", "missing category"),
+            (description == "", "missing description"),
+            (~(amount > 0) | (amount == float("inf")), "invalid amount"),
+            (date.isna(), "invalid date"),
+        ]
+        reason = pd.Series("", index=batch.index)
+        for failed, message in reversed(checks):
+            reason = reason.mask(failed, message)
+        valid = reason == ""
+
+        rejected = reason[~valid]
+        result.rejected += len(rejected)
+        room = IMPORT_MAX_REJECTS_REPORTED - len(result.rejects)
+        # Line numbers are 1-based and count the header
+        result.rejects += [(index + 2, message) for index, message in rejected.head(room).items()]
+
+        if valid.any():
+            # Inserting in date order keeps expid chronological and appends
+            # to the (userid, date) index instead of splitting its pages
+            order = date[valid].sort_values(kind="stable").index
+            repository = get_repository()
+            names = category[order].unique()
+            category_ids = category[order].map({name: repository.category_id(user_id, name, create=True)
+                                                for name in names})
+            amount = amount[order]
+            dates = date[order].dt.strftime("%Y-%m-%d %H:%M:%S")
+            rows = zip(
+                [user_id] * len(order),
+                category_ids.tolist(),
+                description[order].tolist(),
+                amount.tolist(),
+                dates.tolist(),
+            )
+            totals = amount.groupby(category_ids).agg(["sum", "count"])
+            buckets = {}
+            for table, _, length in TIME_BUCKETS:
+                bucket_totals = amount.groupby([dates.str[:length], category_ids]).agg(["sum", "count"])
+                buckets[table] = [(user_id, bucket, int(category_id), float(total), int(count))
+                                  for (bucket, category_id), (total, count) in bucket_totals.iterrows()]
+            repository.import_batch(user_id, rows, [
+                (user_id, int(category_id), float(total), int(count))
+                for category_id, (total, count) in totals.iterrows()
+            ], buckets)
+            result.imported += len(amount)
+            result.categories.update(names)
+
+        if progress:
+            progress(result, source.tell() / size if size else None)
+    return result
+
+VIEW_PAGE_SIZES = [25, 50, 100]
+
+# One page of the table view, newest first. `after` is the (date, expid) of
+# the last row on the previous page, so each page is a single index range
+# read whatever the page number, or a binary search of the user's cached
+# frame (see ExpenseFrameCache). Search results come best match first
+# instead, and `after` is the number of results already shown. Returns the
+# rows and whether more follow.
+def fetch_expense_page(user_id, filters, after=None, page_size=VIEW_PAGE_SIZES[0]):
+    repository = get_repository()
+    frame = cached_frame(user_id, filters)
+    if frame is not None:
+        rows = frame.page(filters, after, page_size + 1)
+    elif search_terms(filters.get("search")):
+        rows = repository.search_page(user_id, filters, after or 0, page_size + 1)
+    else:
+        rows = repository.expense_page(user_id, filters, after, page_size + 1)
+    return rows[:page_size], len(rows) > page_size
+
+# Counting reads every matching row unless the user's frame is cached, so it
+# is opt-in and cached until the user's data changes
+@st.cache_data(max_entries=256, show_spinner=False)
+def count_expenses(user_id, filters, data_version):
+    frame = cached_frame(user_id, filters)
+    if frame is not None:
+        return len(frame.view(filters))
+    return get_repository().count_expenses(user_id, filters)
+
+# Loads the next table page in the background while the user reads this one
+@st.cache_resource
+def get_prefetch_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="page-prefetch")
+
+# Spools the CSV export to a temporary file for st.download_button
+def export_expenses_csv(user_id, **filters):
+    import tempfile
+    export_file = tempfile.TemporaryFile()
+    frame = cached_frame(user_id, filters)
+    for chunk in frame.iter_csv(filters) if frame is not None else iter_expense_csv(user_id, **filters):
+        export_file.write(chunk.encode("utf-8"))
+    export_file.seek(0)
+    return export_file
+
+# Changes whenever the user's expenses do; see DATA_VERSION_TRIGGERS
+def get_data_version(user_id):
+    return get_repository().data_version(user_id)
+
+FRAME_CACHE_BYTES = 256 * 2**20
+FRAME_LOAD_CHUNK_ROWS = 50000
+FRAME_VIEWS_PER_USER = 8
+FRAME_COLUMNS = ["expid", "category", "description", "amount", "date"]
+
+# Rows of frame that pass the table view filters, as a boolean Series.
+# Matches what expense_filters() selects, including LIKE ignoring case.
+def frame_filter_mask(frame, category=None, start_date=None, end_date=None,
+                      min_amount=None, max_amount=None, description_prefix=None):
+    import pandas as pd
+    mask = pd.Series(True, index=frame.index)
+    if category and category != "All":
+        mask &= frame["category"] == category
+    if start_date:
+        mask &= frame["date"] >= start_date.isoformat()
+    if end_date:
+        mask &= frame["date"] < (end_date + timedelta(days=1)).isoformat()
+    if min_amount is not None:
+        mask &= frame["amount"] >= min_amount
+    if max_amount is not None:
+        mask &= frame["amount"] <= max_amount
+    if description_prefix:
+        mask &= frame["description"].str.lower().str.startswith(description_prefix.lower()).fillna(False)
+    return mask
+
+# One user's expenses in expid order, as of `versions`. Each filter's rows
+# are found once and kept, newest first, as positions into the frame, so
+# paging, counting and exporting reuse them until the user's data changes.
+class CachedFrame:
+    def __init__(self, frame, versions, frame_bytes):
+        self.frame = frame
+        self.versions = versions
+        self.frame_bytes = frame_bytes
+        self.nbytes = frame_bytes
+        # Plain arrays of each column, for building pages without pandas
+        self.expids = frame["expid"].to_numpy()
+        self.codes = frame["category"].cat.codes.to_numpy()
+        self.categories = frame["category"].cat.categories.tolist()
+        self.descriptions = frame["description"].to_numpy()
+        self.amounts = frame["amount"].to_numpy()
+        self.dates = frame["date"].to_numpy()
+        self._newest = None
+        self._views = OrderedDict()
+        self._lock = threading.Lock()
+
+    def view(self, filters):
+        import numpy as np
+        filters = {name: value for name, value in filters.items() if name != "search"}
+        key = tuple(sorted(filters.items()))
+        with self._lock:
+            positions = self._views.get(key)
+            if positions is not None:
+                self._views.move_to_end(key)
+                return positions
+            if self._newest is None:
+                self._newest = np.lexsort((self.expids, self.dates))[::-1].copy()
+                self.nbytes += self._newest.nbytes
+            mask = frame_filter_mask(self.frame, **filters).to_numpy()
+            positions = self._newest[mask[self._newest]]
+            self._views[key] = positions
+            self.nbytes += positions.nbytes
+            if len(self._views) > FRAME_VIEWS_PER_USER:
+                _, evicted = self._views.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+            return positions
+
+    # The frame's rows at `positions` as (expid, category, description,
+    # amount, date) tuples of plain Python values, like the repository returns
+    def rows(self, positions):
+        return list(zip(
+            self.expids[positions].tolist(),
+            [self.categories[code] if code >= 0 else None for code in self.codes[positions].tolist()],
+            self.descriptions[positions].tolist(),
+            [None if amount != amount else amount for amount in self.amounts[positions].tolist()],
+            self.dates[positions].tolist(),
+        ))
+
+    # Same rows as ExpenseRepository.expense_page()
+    def page(self, filters, after, limit):
+        positions = self.view(filters)
+        start = 0
+        if after:
+            after = tuple(after)
+            # Positions run newest first, so rows before the cursor come first
+            start = bisect.bisect_left(range(len(positions)), True, key=lambda i: (
+                self.dates[positions[i]], self.expids[positions[i]]) < after)
+        return self.rows(positions[start:start + limit])
+
+    # Same text as iter_expense_csv()
+    def iter_csv(self, filters, chunk_rows=EXPORT_CHUNK_ROWS):
+        import numpy as np
+        positions = np.sort(self.view(filters))
+        yield ",".join(EXPORT_COLUMNS) + "\r\n"
+        for start in range(0, len(positions), chunk_rows):
+            chunk = self.frame.iloc[positions[start:start + chunk_rows], 1:]
+            yield chunk.to_csv(header=False, index=False, lineterminator="\r\n")
+
+# LRU cache of each user's CachedFrame bounded by their total size, so page
+# reruns, Next clicks and exports stop reading the user's rows from the
+# database. A frame is reused while versions() is unchanged; after inserts
+# alone only the new rows are read and appended, and any edit reloads it.
+class ExpenseFrameCache:
+    def __init__(self, repository, max_bytes):
+        self.repository = repository
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.appends = 0
+        self.loads = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Users whose frame alone is over max_bytes, at the versions it was
+        self._oversize = {}
+        self._lock = threading.Lock()
+
+    # The user's CachedFrame, or None when it would not fit and callers
+    # should query the database instead
+    def get(self, user_id):
+        versions = self.repository.versions(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries.move_to_end(user_id)
+                if entry.versions == versions:
+                    self.hits += 1
+                    return entry
+            if self._oversize.get(user_id) == versions:
+                return None
+        if entry is not None and entry.versions[1] == versions[1]:
+            entry = self._append(user_id, entry, versions)
+        else:
+            entry = self._load(user_id, versions)
+        with self._lock:
+            if entry.nbytes > self.max_bytes:
+                self._entries.pop(user_id, None)
+                self._oversize[user_id] = versions
+                return None
+            self._oversize.pop(user_id, None)
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while sum(cached.nbytes for cached in self._entries.values()) > self.max_bytes:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    # Reads the user's rows past after_expid into a frame whose category
+    # column uses `categories` followed by any new names
+    def _read(self, user_id, after_expid, categories=()):
+        import pandas as pd
+        chunks = []
+        while True:
+            rows = self.repository.expense_chunk(user_id, {}, after_expid, FRAME_LOAD_CHUNK_ROWS)
+            if rows:
+                chunks.append(pd.DataFrame(rows, columns=FRAME_COLUMNS, dtype=object))
+                after_expid = rows[-1][0]
+            if len(rows) < FRAME_LOAD_CHUNK_ROWS:
+                break
+        if chunks:
+            frame = pd.concat(chunks, ignore_index=True)
+        else:
+            frame = pd.DataFrame(columns=FRAME_COLUMNS, dtype=object)
+        names = list(categories)
+        names += sorted(set(frame["category"].dropna()) - set(names))
+        # Text stays in object columns: pages pick a few rows at a time, which
+        # is far cheaper from Python strings than from Arrow-backed ones
+        return frame.astype({"expid": "int64", "category": pd.CategoricalDtype(names), "amount": "float64"})
+
+    def _load(self, user_id, versions):
+        frame = self._read(user_id, 0)
+        with self._lock:
+            self.loads += 1
+        return CachedFrame(frame, versions, int(frame.memory_usage(deep=True).sum()))
+
+    def _append(self, user_id, entry, versions):
+        import pandas as pd
+        old = entry.frame
+        new = self._read(user_id, int(entry.expids[-1]) if len(old) else 0, old["category"].cat.categories)
+        with self._lock:
+            self.appends += 1
+        if new.empty:
+            # Only the rollups changed; the rows and their views still hold
+            entry.versions = versions
+            return entry
+        # Sized by adding the new rows: measuring the text of the whole frame
+        # again would cost more than reading them
+        return CachedFrame(pd.concat([old.astype({"category": new["category"].dtype}), new], ignore_index=True),
+                           versions, entry.frame_bytes + int(new.memory_usage(deep=True, index=False).sum()))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.appends + self.loads
+            return {"hits": self.hits, "appends": self.appends, "loads": self.loads, "evictions": self.evictions,
+                    "hit_rate": self.hits / lookups if lookups else 0.0, "users": len(self._entries),
+                    "bytes": sum(entry.nbytes for entry in self._entries.values())}
+
+@st.cache_resource
+def get_frame_cache():
+    return ExpenseFrameCache(get_repository(), FRAME_CACHE_BYTES)
+
+# The user's cached frame when it can answer these filters; searches rank by
+# relevance and always go to the search index
+def cached_frame(user_id, filters):
+    if search_terms(filters.get("search")):
+        return None
+    return get_frame_cache().get(user_id)
+
+CHART_CACHE_BYTES = 64 * 2**20
+BAR_COLORS = ["blue", "orange", "green", "red", "purple", "brown"]
+
+# LRU cache of rendered bytes bounded by their total size. Each key holds
+# a single version: storing a newer one replaces it, and asking for any
+# other version is a miss.
+class VersionedByteCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, data):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (version, data)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries), "bytes": self.size}
+
+@st.cache_resource
+def get_chart_cache():
+    return VersionedByteCache(CHART_CACHE_BYTES)
+
+# Draws on a standalone Figure rather than through pyplot, so nothing is
+# registered in pyplot's global figure list and the figure is freed as soon
+# as the bytes are written
+def render_chart(chart_type, categories, amounts, fmt="png"):
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
+    if chart_type == "bar":
+        ax.bar(categories, amounts, color=BAR_COLORS)
+        ax.set_title("Expense Categories")
+        ax.set_xlabel("Category")
+        ax.set_ylabel("Amount")
+        for i, amount in enumerate(amounts):
+            ax.text(i, amount + 1, f"{amount:.2f}", ha='center')
+    else:
+        ax.pie(amounts, labels=categories, autopct='%1.1f%%', startangle=90)
+        ax.set_title("Expense Distribution by Category")
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format=fmt)
+    return buffer.getvalue()
+
+# The snapshot `manage.py snapshot` keeps of a database, mapped again once a
+# refresh replaces its manifest (stamp). Segments the refresh deleted stay
+# readable while an older mapping of them is cached.
+@st.cache_resource(max_entries=2 * SHARD_COUNT, show_spinner=False)
+def load_snapshot(directory, stamp):
+    return ExpenseSnapshot(directory)
+
+# A user's totals as the snapshot computes them, named like the rollups'
+class SnapshotTotals:
+    def __init__(self, snapshot, names):
+        self.snapshot = snapshot
+        self.names = names
+
+    def category_totals(self, user_id):
+        return sorted((self.names[category_id], total)
+                      for category_id, total in self.snapshot.category_totals(user_id))
+
+    def monthly_totals(self, user_id, first_month, last_month):
+        return [(month, self.names.get(category_id), total)
+                for month, category_id, total in self.snapshot.monthly_totals(user_id, first_month, last_month)]
+
+    def daily_totals(self, user_id, first_day, last_day):
+        return self.snapshot.daily_totals(user_id, first_day, last_day)
+
+# SnapshotTotals for the user when the snapshot of their shard was refreshed
+# after their latest write, otherwise None
+def snapshot_totals(repository, user_id):
+    shard = repository.shard(user_id) if isinstance(repository, ShardedRepository) else repository
+    directory = snapshot_path(shard.pool.path)
+    try:
+        manifest = os.stat(os.path.join(directory, "manifest.json"))
+        snapshot = load_snapshot(directory, (manifest.st_ino, manifest.st_mtime_ns))
+    except FileNotFoundError:
+        return None
+    if snapshot.versions(user_id) != repository.versions(user_id):
+        return None
+    return SnapshotTotals(snapshot, {category_id: name for name, category_id in repository.categories(user_id).items()})
+
+# Where the charts and trends read a user's spending totals: the snapshot
+# while it is current for them, the rollups otherwise and on MySQL
+def get_totals_source(user_id):
+    repository = get_repository()
+    if BACKEND == "mysql":
+        return repository
+    return snapshot_totals(repository, user_id) or repository
+
+# Returns the chart as image bytes, or None when the user has no expenses
+def get_chart(user_id, chart_type, fmt="png"):
+    cache = get_chart_cache()
+    key = (user_id, chart_type, fmt)
+    version = get_data_version(user_id)
+    chart = cache.get(key, version)
+    if chart is None:
+        data = get_totals_source(user_id).category_totals(user_id)
+        if not data:
+            return None
+        chart = render_chart(chart_type, [row[0] for row in data], [row[1] for row in data], fmt)
+        cache.put(key, version, chart)
+    return chart
+
+TREND_MONTHS = [3, 6, 12, 24]
+
+# Trend views for the `months` months ending with last_month ('YYYY-MM'),
+# computed over the day and month buckets with column operations. That is at
+# most one row per category per month and one per day, however many
+# expenses the user has, summed from the snapshot while it is current for
+# the user (see get_totals_source). income is the user's monthly income.
+def spending_trends(user_id, months, last_month, income):
+    import numpy as np
+    import pandas as pd
+    repository = get_repository()
+    totals = get_totals_source(user_id)
+    periods = pd.period_range(end=pd.Period(last_month, "M"), periods=months, freq="M")
+    labels = list(periods.strftime("%Y-%m"))
+
+    monthly = pd.DataFrame(totals.monthly_totals(user_id, labels[0], labels[-1]),
+                           columns=["Month", "Category", "Total"])
+    by_category = (monthly.fillna({"Category": "Uncategorized"})
+                   .groupby(["Month", "Category"])["Total"].sum()
+                   .unstack(fill_value=0.0)
+                   .reindex(labels, fill_value=0.0))
+    spent = by_category.sum(axis=1)
+    previous = spent.shift()
+    trend = pd.DataFrame({
+        "Spent": spent,
+        "Change": spent - previous,
+        "Change %": (spent - previous) / previous.where(previous != 0) * 100,
+    })
+    budget = pd.DataFrame({
+        "Income": income,
+        "Spent": spent,
+        "Saved": income - spent,
+        "% of income": spent / income * 100 if income else np.nan,
+    }, index=spent.index)
+
+    # Balance at the end of each day. Income counts once, as in the menu's
+    # balance, so the period opens with what was left before it.
+    days = pd.date_range(periods[0].start_time, periods[-1].end_time.normalize(), freq="D")
+    daily = totals.daily_totals(user_id, days[0].strftime("%Y-%m-%d"), days[-1].strftime("%Y-%m-%d"))
+    spent_daily = pd.Series([total for _, total in daily], dtype=float,
+                            index=pd.to_datetime([day for day, _ in daily])).reindex(days, fill_value=0.0)
+    opening = income - repository.spent_before(user_id, labels[0])
+    balance = (opening - spent_daily.cumsum()).to_frame("Balance")
+
+    return {
+        "by_category": by_category,
+        "trend": trend.round(2),
+        "budget": budget.round(2),
+        "balance": balance,
+    }
+
+# Cached until the user's expenses or income change
+@st.cache_data(max_entries=256, show_spinner=False)
+def cached_spending_trends(user_id, months, last_month, income, data_version):
+    return spending_trends(user_id, months, last_month, income)
+
+# Report table layout: (header, width in mm, alignment)
+REPORT_COLUMNS = [("Category", 40, "L"), ("Description", 80, "L"), ("Amount", 30, "R"), ("Date", 40, "L")]
+REPORT_ROW_HEIGHT = 8
+REPORT_FONT_SIZE = 10
+REPORT_MARGIN = 15
+REPORT_PADDING = 1.5
+
+# Trims text to fit a column. Strings shorter than safe_chars always fit, so
+# only the occasional long value is measured.
+def fit_report_text(pdf, text, width, safe_chars):
+    if len(text) <= safe_chars or pdf.get_string_width(text) <= width:
+        return text
+    while text and pdf.get_string_width(text + "...") > width:
+        text = text[:-1]
+    return text + "..."
+
+def draw_report_header(pdf, x_positions, y):
+    pdf.set_font("Arial", style='B', size=REPORT_FONT_SIZE)
+    for (title, width, _), x in zip(REPORT_COLUMNS, x_positions):
+        pdf.set_xy(x, y)
+        pdf.cell(width, REPORT_ROW_HEIGHT, title, border=1, align='C')
+    pdf.set_font("Arial", size=REPORT_FONT_SIZE)
+    return y + REPORT_ROW_HEIGHT
+
+# Closes a page's table with one vertical rule per column edge
+def draw_report_rules(pdf, x_positions, top, bottom):
+    for x in x_positions + [x_positions[-1] + REPORT_COLUMNS[-1][1]]:
+        pdf.line(x, top, x, bottom)
+
+# Renders the expense report into memory and returns the PDF bytes. Rows are
+# streamed from the database and laid out with fixed column positions, one
+# text() call per cell and one rule per row, instead of bordered cells. The
+# highest spending category is summed from the same rows as they go by and
+# written into the space kept for it on the first page, so it always agrees
+# with the filtered rows listed under it.
+def generate_pdf(user_id, **filters):
+    from fpdf import FPDF
     pdf = FPDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.set_auto_page_break(auto=False)
+    pdf.set_margins(REPORT_MARGIN, REPORT_MARGIN)
     pdf.add_page()
 
     # Title
     pdf.set_font("Arial", style='B', size=16)
-    pdf.cell(200, 10, txt="Personal Expense Tracker", ln=True, align='C')
+    pdf.cell(0, 10, txt="Personal Expense Tracker", ln=True, align='C')
     pdf.ln(10)
 
-    db = connect_to_db()
-    cursor = db.cursor()
+    # Room for the highest spending category, written once the rows are summed
+    chunks = iter_expense_rows(user_id, **filters)
+    first_chunk = next(chunks, None)
+    summary_top = pdf.get_y()
+    if first_chunk is not None:
+        pdf.set_y(summary_top + 30)
+    category_totals = {}
+
+    # Column geometry, computed once for the whole report
+    x_positions = []
+    x = pdf.l_margin
+    for _, width, _ in REPORT_COLUMNS:
+        x_positions.append(x)
+        x += width
+    table_right = x
+    pdf.set_font("Arial", size=REPORT_FONT_SIZE)
+    widest_char = pdf.get_string_width("W")
+    text_widths = [width - 2 * REPORT_PADDING for _, width, _ in REPORT_COLUMNS]
+    safe_chars = [int(width / widest_char) for width in text_widths]
+    baseline = REPORT_ROW_HEIGHT / 2 + REPORT_FONT_SIZE * 0.35 / 2
+    page_bottom = pdf.h - REPORT_MARGIN
+
+    table_top = pdf.get_y()
+    y = draw_report_header(pdf, x_positions, table_top)
+    for rows in itertools.chain([first_chunk] if first_chunk is not None else [], chunks):
+        for row in rows:
+            if row[0] is not None:
+                category_totals[row[0]] = category_totals.get(row[0], 0.0) + row[2]
+            if y + REPORT_ROW_HEIGHT > page_bottom:
+                draw_report_rules(pdf, x_positions, table_top, y)
+                pdf.add_page()
+                table_top = pdf.get_y()
+                y = draw_report_header(pdf, x_positions, table_top)
+            for value, (_, width, align), x, text_width, limit in zip(
+                    row, REPORT_COLUMNS, x_positions, text_widths, safe_chars):
+                text = fit_report_text(pdf, "" if value is None else str(value), text_width, limit)
+                if align == "R":
+                    pdf.text(x + width - REPORT_PADDING - pdf.get_string_width(text), y + baseline, text)
+                else:
+                    pdf.text(x + REPORT_PADDING, y + baseline, text)
+            y += REPORT_ROW_HEIGHT
+            pdf.line(x_positions[0], y, table_right, y)
+    draw_report_rules(pdf, x_positions, table_top, y)
+
+    if category_totals:
+        top_category, total_spent = max(category_totals.items(), key=lambda item: item[1])
+        last_page = pdf.page
+        pdf.page = 1
+        pdf.set_xy(pdf.l_margin, summary_top)
+        pdf.set_font("Arial", size=12)
+        pdf.cell(0, 10, txt=f"Highest Spending Category: {top_category}", ln=True, align='L')
+        pdf.cell(0, 10, txt=f"Total Spent: {total_spent:.2f}", ln=True, align='L')
+        pdf.page = last_page
+
+    return bytes(pdf.output())
+
+# Finished reports are cached per user and filter, bounded by their total
+# size: a report over a million rows runs to tens of MiB. data_version is the
+# entry's version: any write to the user's expenses bumps it, so a stale
+# report is never served and an unchanged one is never rendered twice.
+REPORT_CACHE_BYTES = 128 * 2**20
+
+@st.cache_resource
+def get_report_cache():
+    return VersionedByteCache(REPORT_CACHE_BYTES)
+
+def cached_expense_report(user_id, filters, data_version):
+    cache = get_report_cache()
+    key = (user_id, tuple(sorted(filters.items())))
+    report = cache.get(key, data_version)
+    if report is None:
+        report = generate_pdf(user_id, **filters)
+        cache.put(key, data_version, report)
+    return report
 
-    # Get highest spending category
-    cursor.execute("""
-        SELECT category, SUM(amount) as total_spent
-        FROM expenses 
-        WHERE userid = ?
-        GROUP BY category
-        ORDER BY total_spent DESC
-        LIMIT 1
-    """, (user_id,))
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def metrics_json():
+    queries, pages = get_metrics().snapshot()
+    return json.dumps({
+        "queries": queries,
+        "pages": pages,
+        "pool": get_repository().stats(),
+        "chart_cache": get_chart_cache().stats(),
+        "report_cache": get_report_cache().stats(),
+        "frame_cache": get_frame_cache().stats(),
+    }, indent=2)
+
+# Prometheus text exposition format
+def metrics_prometheus():
+    queries, pages = get_metrics().snapshot()
+    lines = [
+        "# HELP expense_tracker_query_seconds Time spent executing and fetching a query.",
+        "# TYPE expense_tracker_query_seconds summary",
+    ]
+    for sql, stats in queries.items():
+        label = f'query="{escape_label(sql)}"'
+        lines.append(f"expense_tracker_query_seconds_count{{{label}}} {stats['calls']}")
+        lines.append(f"expense_tracker_query_seconds_sum{{{label}}} {stats['seconds']:.6f}")
+    lines += ["# HELP expense_tracker_query_max_seconds Slowest single call of a query.",
+              "# TYPE expense_tracker_query_max_seconds gauge"]
+    lines += [f'expense_tracker_query_max_seconds{{query="{escape_label(sql)}"}} {stats["max_seconds"]:.6f}'
+              for sql, stats in queries.items()]
+    lines += ["# HELP expense_tracker_query_rows_total Rows fetched or changed by a query.",
+              "# TYPE expense_tracker_query_rows_total counter"]
+    lines += [f'expense_tracker_query_rows_total{{query="{escape_label(sql)}"}} {stats["rows"]}'
+              for sql, stats in queries.items()]
+    lines += ["# HELP expense_tracker_query_statements_total SQLite statements run, including triggers.",
+              "# TYPE expense_tracker_query_statements_total counter"]
+    lines += [f'expense_tracker_query_statements_total{{query="{escape_label(sql)}"}} {stats["statements"]}'
+              for sql, stats in queries.items()]
+    lines += ["# HELP expense_tracker_page_render_seconds Time to render a page.",
+              "# TYPE expense_tracker_page_render_seconds summary"]
+    for page, stats in pages.items():
+        lines.append(f'expense_tracker_page_render_seconds_count{{page="{page}"}} {stats["renders"]}')
+        lines.append(f'expense_tracker_page_render_seconds_sum{{page="{page}"}} {stats["seconds"]:.6f}')
+    pool_stats = get_repository().stats()
+    lines += ["# TYPE expense_tracker_pool_hits_total counter",
+              f"expense_tracker_pool_hits_total {pool_stats['hits']}",
+              "# TYPE expense_tracker_pool_misses_total counter",
+              f"expense_tracker_pool_misses_total {pool_stats['misses']}",
+              "# HELP expense_tracker_archive_reads_total Queries that read archived expenses.",
+              "# TYPE expense_tracker_archive_reads_total counter",
+              f"expense_tracker_archive_reads_total {pool_stats.get('archive_reads', 0)}"]
+    return "\n".join(lines) + "\n"
+
+# Opt-in with ?debug=1 on servers started with DEBUG_PANEL
+def debug_panel():
+    st.sidebar.header("Debug")
+    queries, pages = get_metrics().snapshot()
     
-    result = cursor.fetchone()
+    with st.sidebar.expander("Page render times", expanded=True):
+        st.dataframe([
+            {"Page": page, "Renders": stats["renders"],
+             "Avg ms": 1000 * stats["seconds"] / stats["renders"], "Max ms": 1000 * stats["max_seconds"]}
+            for page, stats in sorted(pages.items(), key=lambda item: -item[1]["seconds"])
+        ])
     
-    if result:
-        category, total_spent = result
-        
-        # Display the Highest Spending Category Information
-        pdf.set_font("Arial", size=12)
-        pdf.cell(200, 10, txt=f"Highest Spending Category: {category}", ln=True, align='L')
-        pdf.cell(200, 10, txt=f"Total Spent: {total_spent}", ln=True, align='L')
-        pdf.ln(10)
-    
-    # Table Header (Bold)
-    pdf.set_font("Arial", style='B', size=12)
-    pdf.cell(40, 10, 'Category', border=1, align='C')
-    pdf.cell(70, 10, 'Description', border=1, align='C')
-    pdf.cell(30, 10, 'Amount', border=1, align='C')
-    pdf.cell(40, 10, 'Date', border=1, align='C')
-    pdf.ln()
-
-    # Table Rows
-    pdf.set_font("Arial", size=12)
-    for row in rows:
-        pdf.cell(40, 10, row[0], border=1, align='C')
-        pdf.cell(70, 10, row[1], border=1, align='C')
-        pdf.cell(30, 10, str(row[2]), border=1, align='C')
-        pdf.cell(40, 10, str(row[3]), border=1, align='C')
-        pdf.ln()
-
-    pdf.output(filename)
-    return filename
+    with st.sidebar.expander("Slowest queries", expanded=True):
+        st.dataframe([
+            {"Query": sql[:120], "Calls": stats["calls"], "Total ms": 1000 * stats["seconds"],
+             "Max ms": 1000 * stats["max_seconds"], "Rows": stats["rows"], "Statements": stats["statements"]}
+            for sql, stats in sorted(queries.items(), key=lambda item: -item[1]["seconds"])[:15]
+        ])
+    
+    pool_stats = get_repository().stats()
+    with st.sidebar.expander("Connection pool"):
+        st.write(f"Hits: {pool_stats['hits']}")
+        st.write(f"Misses: {pool_stats['misses']}")
+        st.write(f"Idle connections: {pool_stats['idle']}")
+        if "archive_reads" in pool_stats:
+            st.write(f"Queries reading archives: {pool_stats['archive_reads']}")
+    # One writer thread per SQLite shard
+    repository = get_repository()
+    writers = [shard.writer for shard in getattr(repository, "shards", [repository]) if hasattr(shard, "writer")]
+    if writers:
+        writer_stats = [writer.stats() for writer in writers]
+        with st.sidebar.expander("Write queue"):
+            st.write(f"Writes: {sum(stats['writes'] for stats in writer_stats)}")
+            st.write(f"Commits: {sum(stats['batches'] for stats in writer_stats)}")
+            if len(writers) > 1:
+                st.write("Writes per shard: " + ", ".join(str(stats["writes"]) for stats in writer_stats))
+    chart_stats = get_chart_cache().stats()
+    with st.sidebar.expander("Chart cache"):
+        st.write(f"Hits: {chart_stats['hits']}")
+        st.write(f"Misses: {chart_stats['misses']}")
+        st.write(f"Cached charts: {chart_stats['entries']} ({chart_stats['bytes'] / 1024:.0f} KiB)")
+    report_stats = get_report_cache().stats()
+    with st.sidebar.expander("Report cache"):
+        st.write(f"Hits: {report_stats['hits']}")
+        st.write(f"Misses: {report_stats['misses']}")
+        st.write(f"Cached reports: {report_stats['entries']} ({report_stats['bytes'] / 2**20:.1f} MiB)")
+    frame_stats = get_frame_cache().stats()
+    with st.sidebar.expander("Frame cache"):
+        st.write(f"Hits: {frame_stats['hits']} ({frame_stats['hit_rate']:.0%})")
+        st.write(f"Appends: {frame_stats['appends']}")
+        st.write(f"Loads: {frame_stats['loads']}")
+        st.write(f"Evictions: {frame_stats['evictions']}")
+        st.write(f"Cached users: {frame_stats['users']} ({frame_stats['bytes'] / 2**20:.1f} MiB)")
+    token_stats = get_session_tokens().stats()
+    with st.sidebar.expander("Session tokens"):
+        st.write(f"Resumed logins: {token_stats['hits']}")
+        st.write(f"Unknown or expired: {token_stats['misses']}")
+        st.write(f"Live tokens: {token_stats['tokens']}")
+    
+    if DEBUG_PANEL and st.sidebar.button("Save metrics to disk"):
+        with open(f"{METRICS_FILE}.prom", "w") as output:
+            output.write(metrics_prometheus())
+        with open(f"{METRICS_FILE}.json", "w") as output:
+            output.write(metrics_json())
+        st.sidebar.success(f"Wrote {METRICS_FILE}.prom and {METRICS_FILE}.json")
 
 # Streamlit App
 def main():
@@ -148,32 +1074,42 @@ def main():
         st.session_state.userid = None
     if 'username' not in st.session_state:
         st.session_state.username = None
-    if 'categories' not in st.session_state:
-        st.session_state.categories = ["Food", "Transport", "Shopping", "Utilities", "Entertainment", "Health"]
     if 'page' not in st.session_state:
         st.session_state.page = "home"
+    if st.session_state.userid is None:
+        resume_session()
+    write_session_cookie()
     
     # Navigation
-    if st.session_state.page == "home":
-        home_page()
-    elif st.session_state.page == "login":
-        login_page()
-    elif st.session_state.page == "register":
-        register_page()
-    elif st.session_state.page == "forgot_password":
-        forgot_password_page()
-    elif st.session_state.page == "income":
-        income_page()
-    elif st.session_state.page == "menu":
-        menu_page()
-    elif st.session_state.page == "add_expense":
-        add_expense_page()
-    elif st.session_state.page == "delete_expense":
-        delete_expense_page()
-    elif st.session_state.page == "update_expense":
-        update_expense_page()
-    elif st.session_state.page == "view_expense":
-        view_expense_page()
+    page = st.session_state.page
+    started = time.perf_counter()
+    try:
+        if page == "home":
+            home_page()
+        elif page == "login":
+            login_page()
+        elif page == "register":
+            register_page()
+        elif page == "forgot_password":
+            forgot_password_page()
+        elif page == "income":
+            income_page()
+        elif page == "menu":
+            menu_page()
+        elif page == "add_expense":
+            add_expense_page()
+        elif page == "delete_expense":
+            delete_expense_page()
+        elif page == "update_expense":
+            update_expense_page()
+        elif page == "view_expense":
+            view_expense_page()
+    finally:
+        # Also runs when a page calls st.rerun(), which raises
+        get_metrics().record_page(page, time.perf_counter() - started)
+    
+    if DEBUG_PANEL and st.query_params.get("debug"):
+        debug_panel()
 
 def home_page():
     st.title("Welcome to Your Personal Expense Tracker")
@@ -223,27 +1159,12 @@ def login_page():
             st.error("Password is required")
             return
             
-        db = connect_to_db()
-        cursor = db.cursor()
-        cursor.execute("SELECT userid, username FROM users WHERE email=? AND password=?", (email, password))
-        user = cursor.fetchone()
-        db.close()
+        user = authenticate(email, password)
 
         if user:
-            st.session_state.userid, st.session_state.username = user
+            # Users without income recorded yet go to the income page first
+            start_session(*user)
             st.success("Login Successful")
-            
-            # Check if income already exists for the user
-            db = connect_to_db()
-            cursor = db.cursor()
-            cursor.execute("SELECT income_amount FROM income WHERE user_id=?", (st.session_state.userid,))
-            income = cursor.fetchone()
-            db.close()
-
-            if income:
-                st.session_state.page = "menu"
-            else:
-                st.session_state.page = "income"
             st.rerun()
         else:
             st.error("Invalid email or password")
@@ -260,11 +1181,7 @@ def forgot_password_page():
                 st.error("Email is required")
                 return
                 
-            db = connect_to_db()
-            cursor = db.cursor()
-            cursor.execute("SELECT userid FROM users WHERE email=?", (email,))
-            user = cursor.fetchone()
-            db.close()
+            user = get_repository().find_user_by_email(email)
 
             if user:
                 st.session_state.temp_email = email
@@ -284,11 +1201,9 @@ def forgot_password_page():
         
         if st.button("Submit New Password"):
             if new_password and new_password == confirm_password:
-                db = connect_to_db()
-                cursor = db.cursor()
-                cursor.execute("UPDATE users SET password=? WHERE email=?", (new_password, st.session_state.temp_email))
-                db.commit()
-                db.close()
+                repository = get_repository()
+                repository.set_password(st.session_state.temp_email, hash_in_pool(new_password))
+                get_session_tokens().revoke_user(repository.find_user_by_email(st.session_state.temp_email))
                 st.success("Password reset successfully")
                 del st.session_state.temp_email
                 st.session_state.page = "login"
@@ -321,12 +1236,11 @@ def register_page():
             st.error("Password is required")
             return
             
-        db = connect_to_db()
-        cursor = db.cursor()
-        cursor.execute("INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
-                       (username, email, password))
-        db.commit()
-        db.close()
+        try:
+            get_repository().create_user(username, email, hash_in_pool(password))
+        except DuplicateEmailError:
+            st.error("Email is already registered")
+            return
 
         st.success("Registration Successful")
         st.session_state.page = "login"
@@ -344,12 +1258,7 @@ def income_page():
             return
 
         try:
-            conn = connect_to_db()
-            cursor = conn.cursor()
-            query = "INSERT INTO income (user_id, income_amount) VALUES (?, ?)"
-            cursor.execute(query, (st.session_state.userid, income_amount))
-            conn.commit()
-            conn.close()
+            get_repository().add_income(st.session_state.userid, income_amount)
             st.success("Income recorded successfully!")
             st.session_state.page = "menu"
             st.rerun()
@@ -393,8 +1302,7 @@ def menu_page():
             update_income()
         
         if st.button("Logout", use_container_width=True):
-            st.session_state.userid = None
-            st.session_state.username = None
+            end_session()
             st.session_state.page = "home"
             st.rerun()
 
@@ -403,28 +1311,37 @@ def update_income():
     
     if st.button("Update Income"):
         try:
-            conn = connect_to_db()  
-            cursor = conn.cursor()
-            cursor.execute("UPDATE income SET income_amount = ? WHERE user_id = ?", 
-                          (new_income, st.session_state.userid))
-            conn.commit()
-            conn.close()
+            get_repository().set_income(st.session_state.userid, new_income)
             st.success("Income updated successfully!")
             st.rerun()
         except Exception as err:
             st.error(f"Error: {err}")
 
+def add_category():
+    user_id = st.session_state.userid
+    name = st.session_state.new_category.strip()
+    if name and name not in get_categories(user_id):
+        try:
+            get_repository().add_category(user_id, name)
+        except Exception as err:
+            st.session_state.category_error = f"Error: {err}"
+            return
+        get_categories.clear(user_id)
+        st.session_state.category_notice = "New category added."
+    st.session_state.new_category = ""
+
 def add_expense_page():
     st.title("Add Expense")
     st.markdown("> *Shape Your Financial Journey!*")
     
-    category = st.selectbox("Select your Category:", st.session_state.categories)
+    category = st.selectbox("Select your Category:", get_categories(st.session_state.userid))
     
-    if st.button("Add New Category"):
-        new_category = st.text_input("Enter new category:")
-        if new_category and new_category not in st.session_state.categories:
-            st.session_state.categories.append(new_category)
-            st.success("New category added.")
+    st.text_input("Enter new category:", key="new_category")
+    st.button("Add New Category", on_click=add_category)
+    if "category_notice" in st.session_state:
+        st.success(st.session_state.pop("category_notice"))
+    if "category_error" in st.session_state:
+        st.error(st.session_state.pop("category_error"))
     
     description = st.text_input("Enter Description:")
     amount = st.number_input("Enter Amount:", min_value=0.0, step=0.01)
@@ -436,12 +1353,11 @@ def add_expense_page():
                 st.error("All fields are required")
                 return
 
-            db = connect_to_db()
-            cursor = db.cursor()
-            cursor.execute("INSERT INTO expenses (userid, category, description, amount) VALUES (?, ?, ?, ?)",
-                           (st.session_state.userid, category, description, float(amount)))
-            db.commit()
-            db.close()
+            try:
+                get_repository().add_expense(st.session_state.userid, category, description, float(amount))
+            except Exception as err:
+                st.error(f"Error: {err}")
+                return
 
             st.success("Expense Added Successfully")
             st.session_state.page = "menu"
@@ -451,27 +1367,71 @@ def add_expense_page():
         if st.button("Back"):
             st.session_state.page = "menu"
             st.rerun()
+    
+    st.header("Import from CSV")
+    st.markdown("Upload a file with the same columns as the CSV export: Category, Description, Amount, Date.")
+    uploaded_file = st.file_uploader("Choose a CSV file", type="csv")
+    
+    if uploaded_file is not None and st.button("Import"):
+        import pandas as pd
+        progress_bar = st.progress(0.0)
+        
+        def show_progress(result, fraction):
+            progress_bar.progress(min(fraction or 0.0, 1.0), text=f"{result.imported} expenses imported")
+        
+        try:
+            result = import_expenses_csv(st.session_state.userid, uploaded_file, progress=show_progress)
+        except (ValueError, pd.errors.ParserError) as err:
+            st.error(f"Error: {err}")
+            return
+        
+        if result.categories - set(get_categories(st.session_state.userid)):
+            get_categories.clear(st.session_state.userid)
+        
+        st.success(f"Imported {result.imported} expenses")
+        if result.rejected:
+            st.warning(f"Skipped {result.rejected} invalid rows")
+            st.dataframe(pd.DataFrame(result.rejects, columns=["Line", "Reason"]))
+
+# Most recent expenses the edit pages offer to pick from
+EDIT_PICKER_ROWS = 100
+
+# Archived expenses are read-only, so the pickers skip them, and with them
+# the cached frame, which holds them too
+def find_expenses(user_id, category, search):
+    repository = get_repository()
+    filters = {"category": category, "search": search, "archived": False}
+    if search_terms(search):
+        return repository.search_page(user_id, filters, 0, EDIT_PICKER_ROWS)
+    return repository.expense_page(user_id, filters, None, EDIT_PICKER_ROWS)
+
+def expense_label(row):
+    return f"{row[4]} · {row[1]} · {row[2]} · {row[3]:.2f}"
 
 def delete_expense_page():
     st.title("Delete Expense")
     st.markdown("> *Remove unwanted expenses and keep your budget in check!*")
     
-    category = st.selectbox("Select Category:", st.session_state.categories)
-    description = st.text_input("Enter Description:")
+    category = st.selectbox("Select Category:", get_categories(st.session_state.userid))
+    search = st.text_input("Search descriptions:")
+    expenses = find_expenses(st.session_state.userid, category, search)
+    selected = st.multiselect("Select Expenses:", expenses, format_func=expense_label)
     
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Delete"):
-            if not category or not description:
-                st.error("All fields are required")
+            if not selected:
+                st.error("Select at least one expense")
                 return
 
-            db = connect_to_db()
-            cursor = db.cursor()
-            cursor.execute("DELETE FROM expenses WHERE userid=? AND category=? AND description=?", 
-                           (st.session_state.userid, category, description))
-            db.commit()
-            db.close()
+            try:
+                count = get_repository().delete_expenses(st.session_state.userid, [row[0] for row in selected])
+            except Exception as err:
+                st.error(f"Error: {err}")
+                return
+            if not count:
+                st.error("No expense was deleted; it may have been changed by another session")
+                return
 
             st.success("Expense Deleted Successfully")
             st.session_state.page = "menu"
@@ -486,25 +1446,33 @@ def update_expense_page():
     st.title("Update Expense")
     st.markdown("> *Edit and keep track of your expenses for better budgeting!*")
     
-    category = st.selectbox("Select Category:", st.session_state.categories)
-    old_description = st.text_input("Enter Old Description:")
-    new_description = st.text_input("Enter New Description:")
-    new_amount = st.number_input("Enter New Amount:", min_value=0.0, step=0.01)
+    categories = get_categories(st.session_state.userid)
+    category = st.selectbox("Select Category:", categories)
+    search = st.text_input("Search descriptions:")
+    expense = st.selectbox("Select Expense:", find_expenses(st.session_state.userid, category, search),
+                           format_func=expense_label)
+    
+    new_category = st.selectbox("New Category:", categories, index=categories.index(category))
+    new_description = st.text_input("Enter New Description:", value=expense[2] if expense else "")
+    new_amount = st.number_input("Enter New Amount:", min_value=0.0, step=0.01,
+                                 value=float(expense[3]) if expense else 0.0)
     
     col1, col2 = st.columns(2)
     with col1:
         if st.button("Update"):
-            if not category or not old_description or not new_description or not new_amount:
+            if not expense or not new_description or not new_amount:
                 st.error("All fields are required")
                 return
 
-            db = connect_to_db()
-            cursor = db.cursor()
-            cursor.execute("""
-                UPDATE expenses SET description=?, amount=? WHERE userid=? AND category=? AND description=?
-            """, (new_description, float(new_amount), st.session_state.userid, category, old_description))
-            db.commit()
-            db.close()
+            try:
+                count = get_repository().update_expenses(st.session_state.userid, [expense[0]], category=new_category,
+                                                         description=new_description, amount=float(new_amount))
+            except Exception as err:
+                st.error(f"Error: {err}")
+                return
+            if not count:
+                st.error("No expense was updated; it may have been changed by another session")
+                return
 
             st.success("Expense Updated Successfully")
             st.session_state.page = "menu"
@@ -515,56 +1483,162 @@ def update_expense_page():
             st.session_state.page = "menu"
             st.rerun()
 
+def next_expense_page(cursor):
+    st.session_state.view_cursors.append(cursor)
+
+def previous_expense_page():
+    st.session_state.view_cursors.pop()
+
+# Applies the chosen action to every selected row in one batch, then starts
+# a fresh selection: the old one holds row positions, not expids
+def apply_to_selection(expids):
+    repository = get_repository()
+    user_id = st.session_state.userid
+    action = st.session_state.selection_action
+    try:
+        if action == "Delete":
+            count = repository.delete_expenses(user_id, expids)
+            st.session_state.view_notice = f"Deleted {count} expenses"
+        elif action == "Change category":
+            category = st.session_state.selection_category
+            count = repository.update_expenses(user_id, expids, category=category)
+            st.session_state.view_notice = f"Moved {count} expenses to {category}"
+        else:
+            amount = st.session_state.selection_amount
+            count = repository.update_expenses(user_id, expids, amount=amount)
+            st.session_state.view_notice = f"Set the amount of {count} expenses to {amount:.2f}"
+    except Exception as err:
+        st.session_state.view_error = f"Error: {err}"
+        return
+    if count < len(expids):
+        st.session_state.view_notice += f" ({len(expids) - count} archived expenses are read-only)"
+    st.session_state.view_selection += 1
+
+def edit_selection(expids):
+    st.subheader(f"{len(expids)} selected")
+    action = st.radio("Action", ["Delete", "Change category", "Change amount"], horizontal=True,
+                      key="selection_action")
+    if action == "Change category":
+        st.selectbox("New Category:", get_categories(st.session_state.userid), key="selection_category")
+    elif action == "Change amount":
+        st.number_input("New Amount:", min_value=0.01, step=0.01, key="selection_amount")
+    st.button("Apply to selected", on_click=apply_to_selection, args=(expids,))
+
+# Shows the current page of the table view. The page after it is fetched in
+# the background so that clicking Next is served from memory.
+def show_expense_table(page_size, show_count):
+    import pandas as pd
+    user_id = st.session_state.userid
+    filters = st.session_state.view_filters
+    cursors = st.session_state.view_cursors
+    version = get_data_version(user_id)
+    
+    page_key = (user_id, tuple(filters.items()), cursors[-1], page_size, version)
+    prefetched = st.session_state.get("view_prefetch")
+    if prefetched and prefetched[0] == page_key:
+        rows, has_more = prefetched[1].result()
+    else:
+        rows, has_more = fetch_expense_page(user_id, filters, cursors[-1], page_size)
+    
+    if "view_notice" in st.session_state:
+        st.success(st.session_state.pop("view_notice"))
+    if "view_error" in st.session_state:
+        st.error(st.session_state.pop("view_error"))
+    
+    selected = []
+    if rows:
+        df = pd.DataFrame([row[1:] for row in rows], columns=EXPORT_COLUMNS)
+        event = st.dataframe(df, on_select="rerun", selection_mode="multi-row",
+                             key=f"view_table_{st.session_state.setdefault('view_selection', 0)}")
+        selected = [rows[index][0] for index in event.selection.rows]
+    else:
+        st.info("No expenses found for the selected filters.")
+    
+    caption = f"Page {len(cursors)}"
+    if show_count:
+        caption += f" of {count_expenses(user_id, filters, version)} matching expenses"
+    st.caption(caption)
+    
+    if search_terms(filters.get("search")):
+        next_cursor = (cursors[-1] or 0) + len(rows)
+    else:
+        next_cursor = (rows[-1][4], rows[-1][0]) if rows else None
+    if has_more:
+        next_key = (user_id, tuple(filters.items()), next_cursor, page_size, version)
+        future = get_prefetch_executor().submit(fetch_expense_page, user_id, filters, next_cursor, page_size)
+        st.session_state.view_prefetch = (next_key, future)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.button("Previous", on_click=previous_expense_page, disabled=len(cursors) == 1)
+    with col2:
+        st.button("Next", on_click=next_expense_page, args=(next_cursor,), disabled=not has_more)
+    
+    if selected:
+        edit_selection(selected)
+
 def view_expense_page():
     st.title("VIEW EXPENSE")
     st.markdown("> *Track your expenses and get insights into your spending patterns!*")
     
     st.header("Table View")
-    category = st.selectbox("View by Category", ["All"] + st.session_state.categories)
+    search = st.text_input("Search descriptions", placeholder="Words or the start of words, e.g. coff lun")
+    category = st.selectbox("View by Category", ["All"] + get_categories(st.session_state.userid))
+    
+    with st.expander("More Filters"):
+        col1, col2 = st.columns(2)
+        with col1:
+            start_date = st.date_input("From", value=None)
+            min_amount = st.number_input("Min Amount", min_value=0.0, step=0.01, value=None)
+        with col2:
+            end_date = st.date_input("To", value=None)
+            max_amount = st.number_input("Max Amount", min_value=0.0, step=0.01, value=None)
+        description_prefix = st.text_input("Description starts with")
+    filters = {
+        "search": search,
+        "category": category,
+        "start_date": start_date,
+        "end_date": end_date,
+        "min_amount": min_amount,
+        "max_amount": max_amount,
+        "description_prefix": description_prefix,
+    }
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        page_size = st.selectbox("Rows per page", VIEW_PAGE_SIZES)
+    with col2:
+        show_count = st.checkbox("Show total count")
     
     if st.button("View"):
-        db = connect_to_db()
-        cursor = db.cursor()
-        query = "SELECT category, description, amount, date FROM expenses WHERE userid=?"
-        params = [st.session_state.userid]
-
-        if category != "All":
-            query += " AND category=?"
-            params.append(category)
-
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        db.close()
-        
-        if rows:
-            df = pd.DataFrame(rows, columns=["Category", "Description", "Amount", "Date"])
-            st.dataframe(df)
-            
-            # Export options
-            col1, col2 = st.columns(2)
-            
-            with col1:
-                if st.button("Export to CSV"):
-                    csv = df.to_csv(index=False)
-                    st.download_button(
-                        label="Download CSV",
-                        data=csv,
-                        file_name=f"expenses_{st.session_state.userid}.csv",
-                        mime="text/csv"
-                    )
-            
-            with col2:
-                if st.button("Export to PDF"):
-                    pdf_file = generate_pdf(rows, st.session_state.userid)
-                    with open(pdf_file, "rb") as file:
-                        st.download_button(
-                            label="Download PDF",
-                            data=file,
-                            file_name="expenses.pdf",
-                            mime="application/pdf"
-                        )
-        else:
-            st.info("No expenses found for the selected category.")
+        st.session_state.view_filters = filters
+        st.session_state.view_cursors = [None]
+    
+    if st.session_state.get("view_filters") is not None:
+        show_expense_table(page_size, show_count)
+    
+    st.header("Export")
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Export to CSV"):
+            with export_expenses_csv(st.session_state.userid, **filters) as export_file:
+                st.download_button(
+                    label="Download CSV",
+                    data=export_file.read(),
+                    file_name=f"expenses_{st.session_state.userid}.csv",
+                    mime="text/csv"
+                )
+    
+    with col2:
+        if st.button("Export to PDF"):
+            pdf_data = cached_expense_report(st.session_state.userid, filters,
+                                             get_data_version(st.session_state.userid))
+            st.download_button(
+                label="Download PDF",
+                data=pdf_data,
+                file_name=f"expenses_{st.session_state.userid}.pdf",
+                mime="application/pdf"
+            )
     
     st.header("Graphical Representation")
     
@@ -572,46 +1646,39 @@ def view_expense_page():
     
     with col1:
         if st.button("Bar Chart"):
-            db = connect_to_db()
-            cursor = db.cursor()
-            cursor.execute("SELECT category, SUM(amount) FROM expenses WHERE userid=? GROUP BY category", (st.session_state.userid,))
-            data = cursor.fetchall()
-            db.close()
-
-            if data:
-                categories = [row[0] for row in data]
-                amounts = [row[1] for row in data]
-
-                fig, ax = plt.subplots()
-                ax.bar(categories, amounts, color=["blue", "orange", "green", "red", "purple", "brown"])
-                ax.set_title("Expense Categories")
-                ax.set_xlabel("Category")
-                ax.set_ylabel("Amount")
-                for i in range(len(categories)):
-                    ax.text(i, amounts[i] + 1, str(amounts[i]), ha='center')
-                st.pyplot(fig)
+            chart = get_chart(st.session_state.userid, "bar")
+            if chart:
+                st.image(chart)
             else:
                 st.info("No data available for chart.")
     
     with col2:
         if st.button("Pie Chart"):
-            db = connect_to_db()
-            cursor = db.cursor()
-            cursor.execute("SELECT category, SUM(amount) FROM expenses WHERE userid=? GROUP BY category", (st.session_state.userid,))
-            data = cursor.fetchall()
-            db.close()
-
-            if data:
-                categories = [row[0] for row in data]
-                amounts = [row[1] for row in data]
-
-                fig, ax = plt.subplots()
-                ax.pie(amounts, labels=categories, autopct='%1.1f%%', startangle=90)
-                ax.set_title("Expense Distribution by Category")
-                st.pyplot(fig)
+            chart = get_chart(st.session_state.userid, "pie")
+            if chart:
+                st.image(chart)
             else:
                 st.info("No data available for chart.")
     
+    st.header("Trends")
+    if st.toggle("Show trends"):
+        user_id = st.session_state.userid
+        months = st.selectbox("Period", TREND_MONTHS, index=TREND_MONTHS.index(12),
+                              format_func=lambda months: f"Last {months} months")
+        income, _ = get_repository().get_totals(user_id)
+        trends = cached_spending_trends(user_id, months, datetime.now(timezone.utc).strftime("%Y-%m"), income,
+                                        get_data_version(user_id))
+        
+        month_tab, balance_tab, budget_tab = st.tabs(["Month over month", "Running balance", "Budget vs income"])
+        with month_tab:
+            st.line_chart(trends["by_category"])
+            st.dataframe(trends["trend"])
+        with balance_tab:
+            st.line_chart(trends["balance"])
+        with budget_tab:
+            st.bar_chart(trends["budget"][["Income", "Spent"]], stack=False)
+            st.dataframe(trends["budget"])
+    
     if st.button("Back to Menu"):
         st.session_state.page = "menu"
         st.rerun()
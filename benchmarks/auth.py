@@ -0,0 +1,147 @@
+# Login throughput and latency as the number of registered users grows.
+#
+#   python -m benchmarks.auth --users 10000,100000,1000000 --clients 1,4,16
+#
+# Each size is its own temporary database of users whose password is
+# "password", every other one with income recorded. A fresh interpreter then
+# times the login lookup (one query through the email index, and the same
+# query made to scan users, as it would without the index), full logins
+# through authenticate() from several client threads at once, as many
+# sessions pressing Login together would, and resuming a login from its
+# session token, which swaps it for a new one. --iterations sets
+# PASSWORD_HASH_ITERATIONS for the run; hashing dominates a login, so
+# logins/s tops out near min(PASSWORD_HASH_THREADS, cores) / hash time
+# whatever the user count.
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from benchmarks.common import Timer, run_worker
+from benchmarks.suite import time_calls
+from benchmarks.writes import percentile
+
+LOGIN_QUERY = """
+    SELECT userid, username, password, EXISTS (SELECT 1 FROM income WHERE user_id = users.userid)
+    FROM users {hint} WHERE email=?
+"""
+
+def generate(users):
+    import app
+    db = app.connect_to_db()
+    # One hash shared by every user; see benchmarks.datagen
+    password_hash = app.hash_password("password")
+    db.execute("BEGIN IMMEDIATE")
+    db.executemany("INSERT INTO users (userid, username, email, password) VALUES (?, ?, ?, ?)",
+                   ((u, f"user{u}", f"user{u}@example.com", password_hash) for u in range(1, users + 1)))
+    db.executemany("INSERT INTO income (user_id, income_amount) VALUES (?, 3000)",
+                   ((u,) for u in range(1, users + 1, 2)))
+    db.commit()
+    db.close()
+
+# Logs in as random users from `clients` threads for `seconds` and returns
+# the latencies
+def login_load(app, users, clients, seconds):
+    latencies = []
+    failures = []
+    start = threading.Barrier(clients)
+
+    def client(index):
+        rng = random.Random(index)
+        start.wait()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            began = time.perf_counter()
+            user = app.authenticate(f"user{rng.randint(1, users)}@example.com", "password")
+            latencies.append(time.perf_counter() - began)
+            if user is None:
+                failures.append(index)
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    with Timer() as timer:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return {
+        "logins_per_second": len(latencies) / timer.seconds,
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p95_ms": 1000 * percentile(latencies, 0.95),
+        "failures": len(failures),
+    }
+
+def measure(users, clients, seconds, repeats, budget):
+    import app
+    repository = app.get_repository()
+    app.get_password_executor()
+    rng = random.Random(0)
+    db = app.connect_to_db()
+
+    def lookup(hint):
+        query = LOGIN_QUERY.format(hint=hint)
+        return lambda: db.execute(query, (f"user{rng.randint(1, users)}@example.com",)).fetchone()
+
+    tokens = app.SessionTokens(app.SESSION_TTL, app.SESSION_MAX_TOKENS)
+    issued = [tokens.issue(user_id, f"user{user_id}") for user_id in range(1, min(users, tokens.max_tokens) + 1)]
+
+    # Uses up a token and issues its replacement, as resume_session does
+    def resume():
+        index = rng.randrange(len(issued))
+        issued[index] = tokens.issue(*tokens.take(issued[index]))
+
+    with Timer() as hash_timer:
+        app.hash_password("password")
+    results = {
+        "hash_ms": 1000 * hash_timer.seconds,
+        "lookup": time_calls(lambda: repository.find_login(f"user{rng.randint(1, users)}@example.com"),
+                             repeats, budget),
+        "indexed": time_calls(lookup(""), repeats, budget),
+        "scan": time_calls(lookup("NOT INDEXED"), repeats, budget),
+        "resume": time_calls(resume, repeats, budget),
+        "clients": {count: login_load(app, users, count, seconds) for count in clients},
+    }
+    db.close()
+    print(json.dumps(results))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", default="10000,100000,1000000", help="comma-separated user counts")
+    parser.add_argument("--clients", default="1,4,16", help="comma-separated numbers of concurrent logins")
+    parser.add_argument("--seconds", type=float, default=5.0, help="seconds to log in for at each client count")
+    parser.add_argument("--iterations", type=int, help="PASSWORD_HASH_ITERATIONS (default: the app's)")
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--budget", type=float, default=2.0, help="seconds to spend per lookup")
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    clients = [int(count) for count in args.clients.split(",")]
+
+    if args.worker:
+        if args.worker[0] == "generate":
+            generate(int(args.worker[1]))
+        else:
+            measure(int(args.worker[1]), clients, args.seconds, args.repeats, args.budget)
+        return
+
+    env = {"EXPENSE_TRACKER_PASSWORD_ITERATIONS": str(args.iterations)} if args.iterations else None
+    print(f"{os.cpu_count()} cores")
+    with tempfile.TemporaryDirectory() as tmp:
+        for users in (int(count) for count in args.users.split(",")):
+            db_path = os.path.join(tmp, f"auth_{users}.db")
+            run_worker("benchmarks.auth", db_path, "generate", str(users), env=env)
+            result = run_worker("benchmarks.auth", db_path, "measure", str(users), "--clients", args.clients,
+                                "--seconds", str(args.seconds), "--repeats", str(args.repeats),
+                                "--budget", str(args.budget), env=env)
+            print(f"\n{users} users: hash {result['hash_ms']:.1f} ms; lookup {result['lookup']['median_ms']:.3f} ms "
+                  f"(query {result['indexed']['median_ms']:.3f} ms, scanning users "
+                  f"{result['scan']['median_ms']:.2f} ms); token resume {1000 * result['resume']['median_ms']:.1f} us")
+            print(f"  {'clients':>8} {'logins/s':>9} {'p50 ms':>8} {'p95 ms':>8}")
+            for count, stats in result["clients"].items():
+                print(f"  {count:>8} {stats['logins_per_second']:>9.1f} {stats['p50_ms']:>8.1f} "
+                      f"{stats['p95_ms']:>8.1f}" + (f"  ({stats['failures']} failed)" if stats["failures"] else ""))
+
+if __name__ == "__main__":
+    main()
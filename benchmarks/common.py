@@ -0,0 +1,81 @@
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+CATEGORIES = ["Food", "Transport", "Shopping", "Utilities", "Entertainment", "Health"]
+
+# Fills the database named by EXPENSE_TRACKER_DB with one user holding `rows`
+# expenses spread over 2024
+def populate(rows):
+    import app
+    db = app.connect_to_db()
+    rng = random.Random(rows)
+    db.execute("INSERT INTO users (username, email, password) VALUES ('bench', 'bench@example.com', 'x')")
+    db.executemany("INSERT INTO categories (userid, name) VALUES (1, ?)", ((name,) for name in CATEGORIES))
+    category_ids = [row[0] for row in db.execute("SELECT category_id FROM categories WHERE userid=1 ORDER BY category_id")]
+    db.executemany(
+        "INSERT INTO expenses (userid, category_id, description, amount, date) VALUES (1, ?, ?, ?, ?)",
+        ((rng.choice(category_ids), f"expense {i}", round(rng.uniform(1, 500), 2),
+          f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 12:00:00")
+         for i in range(rows)))
+    db.commit()
+    db.close()
+
+# Anonymous (heap) RSS. The database is memory-mapped, and those file-backed
+# pages are page cache rather than memory the code under test holds, so
+# ru_maxrss would overstate it.
+def anon_rss_kb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("RssAnon:"):
+                return int(line.split()[1])
+    return 0
+
+# Samples anonymous RSS in the background while the block runs
+class PeakMemory:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, anon_rss_kb())
+
+    def __enter__(self):
+        self.baseline = self.peak = anon_rss_kb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, anon_rss_kb())
+
+    @property
+    def growth_kb(self):
+        return self.peak - self.baseline
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+
+# Runs `python -m <module> --worker <args>` against db_path in a fresh
+# interpreter and returns the JSON object it prints last, if any. `env`
+# adds app settings such as EXPENSE_TRACKER_SHARDS.
+def run_worker(module, db_path, *args, env=None):
+    env = dict(os.environ, EXPENSE_TRACKER_DB=db_path, **(env or {}))
+    result = subprocess.run([sys.executable, "-m", module, "--worker", *args],
+                            env=env, capture_output=True, text=True, check=True)
+    lines = result.stdout.strip().splitlines()
+    return json.loads(lines[-1]) if lines else None
@@ -0,0 +1,56 @@
+# Memory of the CSV export as the exported history grows.
+#
+#   python -m benchmarks.csv_export --sizes 10000,100000,1000000
+#
+# Each export runs in a fresh interpreter. The streaming export should stay
+# flat across sizes while the old fetchall + DataFrame path grows with the
+# row count.
+import argparse
+import json
+import os
+import tempfile
+
+from benchmarks.common import PeakMemory, Timer, populate, run_worker
+
+def export(mode):
+    import app
+    with open(os.devnull, "w") as sink, PeakMemory() as memory, Timer() as timer:
+        if mode == "streaming":
+            for chunk in app.iter_expense_csv(1):
+                sink.write(chunk)
+        else:
+            import pandas as pd
+            db = app.connect_to_db()
+            rows = db.execute("""
+                SELECT categories.name, description, amount, date
+                FROM expenses LEFT JOIN categories USING (category_id)
+                WHERE expenses.userid=?
+            """, (1,)).fetchall()
+            db.close()
+            sink.write(pd.DataFrame(rows, columns=app.EXPORT_COLUMNS).to_csv(index=False))
+    print(json.dumps({"seconds": timer.seconds, "rss_kb": memory.growth_kb}))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        if args.worker[0] == "populate":
+            populate(int(args.worker[1]))
+        else:
+            export(args.worker[0])
+        return
+
+    print(f"{'rows':>10} {'mode':>10} {'seconds':>9} {'RSS growth MB':>14}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (int(s) for s in args.sizes.split(",")):
+            db_path = os.path.join(tmp, f"bench_{size}.db")
+            run_worker("benchmarks.csv_export", db_path, "populate", str(size))
+            for mode in ("streaming", "dataframe"):
+                result = run_worker("benchmarks.csv_export", db_path, mode)
+                print(f"{size:>10} {mode:>10} {result['seconds']:>9.2f} {result['rss_kb'] / 1024:>14.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# Deterministic synthetic data for the benchmarks.
+#
+#   EXPENSE_TRACKER_DB=bench.db python -m benchmarks.datagen --users 2000 --expenses 1000000
+#
+# Activity is skewed the way real usage is: users are drawn from a Zipf-like
+# distribution so a few heavy users own a large share of the rows, categories
+# have fixed popularity weights, and amounts are log-normal around a
+# per-category typical spend. The same seed always produces the same data.
+import argparse
+import time
+
+import numpy as np
+
+# (category, weight, typical amount)
+CATEGORY_PROFILE = [
+    ("Food", 0.32, 12.0),
+    ("Transport", 0.18, 8.0),
+    ("Shopping", 0.16, 45.0),
+    ("Utilities", 0.08, 90.0),
+    ("Entertainment", 0.14, 25.0),
+    ("Health", 0.07, 60.0),
+    ("Rent", 0.02, 900.0),
+    ("Travel", 0.03, 250.0),
+]
+DESCRIPTIONS = ["coffee", "groceries", "lunch", "dinner", "taxi", "bus pass", "fuel", "shoes",
+                "books", "electricity", "internet", "movie", "concert", "pharmacy", "gym",
+                "rent", "flight", "hotel", "gift", "subscription"]
+HISTORY_DAYS = 730
+BATCH_ROWS = 100000
+
+def user_weights(users, skew=1.1):
+    weights = 1.0 / np.arange(1, users + 1) ** skew
+    return weights / weights.sum()
+
+def generate(db, users, expenses, seed=42, start_date="2023-01-01"):
+    import app
+    rng = np.random.default_rng(seed)
+    # Every user's password is "password", under one hash (and salt) shared by
+    # all of them: hashing each one at full cost would take longer than the rest
+    password_hash = app.hash_password("password")
+    first_userid = (db.execute("SELECT MAX(userid) FROM users").fetchone()[0] or 0) + 1
+    userids = np.arange(first_userid, first_userid + users)
+
+    db.execute("BEGIN IMMEDIATE")
+    db.executemany("INSERT INTO users (userid, username, email, password) VALUES (?, ?, ?, ?)",
+                   ((int(u), f"user{u}", f"user{u}@example.com", password_hash) for u in userids))
+    incomes = np.round(rng.lognormal(np.log(3000), 0.5, users), 2)
+    db.executemany("INSERT INTO income (user_id, income_amount) VALUES (?, ?)",
+                   zip(userids.tolist(), incomes.tolist()))
+    names = np.array([name for name, _, _ in CATEGORY_PROFILE])
+    db.executemany("INSERT INTO categories (userid, name) VALUES (?, ?)",
+                   ((int(u), name) for u in userids for name in names.tolist()))
+    # category_ids[user offset, category index]
+    category_ids = np.array([row[0] for row in db.execute(
+        "SELECT category_id FROM categories WHERE userid >= ? ORDER BY userid, category_id", (first_userid,))])
+    category_ids = category_ids.reshape(users, len(names))
+    db.commit()
+
+    category_weights = np.array([weight for _, weight, _ in CATEGORY_PROFILE])
+    category_weights /= category_weights.sum()
+    typical = np.log([amount for _, _, amount in CATEGORY_PROFILE])
+    descriptions = np.array(DESCRIPTIONS)
+    probabilities = user_weights(users)
+    start = np.datetime64(start_date, "s")
+
+    done = 0
+    while done < expenses:
+        n = min(BATCH_ROWS, expenses - done)
+        owners = rng.choice(userids, size=n, p=probabilities)
+        category_index = rng.choice(len(names), size=n, p=category_weights)
+        amounts = np.round(rng.lognormal(typical[category_index], 0.6), 2)
+        offsets = np.sort(rng.integers(0, HISTORY_DAYS * 86400, size=n))
+        dates = (start + offsets.astype("timedelta64[s]")).astype(str)
+        labels = descriptions[rng.integers(0, len(descriptions), size=n)]
+        db.execute("BEGIN IMMEDIATE")
+        # Rollups and the search index are rebuilt once at the end instead of per row
+        db.execute("INSERT OR IGNORE INTO bulk_load (userid) VALUES (0)")
+        db.executemany(
+            "INSERT INTO expenses (userid, category_id, description, amount, date) VALUES (?, ?, ?, ?, ?)",
+            zip(owners.tolist(), category_ids[owners - first_userid, category_index].tolist(), labels.tolist(),
+                amounts.tolist(),
+                np.char.replace(dates, "T", " ").tolist()))
+        db.execute("DELETE FROM bulk_load")
+        db.commit()
+        done += n
+
+def main():
+    import app
+    import storage
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--expenses", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    db = app.connect_to_db()
+    generate(db, args.users, args.expenses, args.seed)
+    storage.rebuild_rollups(db)
+    storage.rebuild_search_index(db)
+    db.close()
+    print(f"Generated {args.users} users and {args.expenses} expenses in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
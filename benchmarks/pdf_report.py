@@ -0,0 +1,47 @@
+# Time and memory of the PDF report as the history grows.
+#
+#   python -m benchmarks.pdf_report --sizes 1000,100000,1000000
+#
+# Each size renders in a fresh interpreter, then asks for the same report
+# again to show the cost of a cached repeat download.
+import argparse
+import json
+import os
+import tempfile
+
+from benchmarks.common import PeakMemory, Timer, populate, run_worker
+
+def render():
+    import app
+    version = app.get_data_version(1)
+    with PeakMemory() as memory, Timer() as first:
+        data = app.cached_expense_report(1, {}, version)
+    with Timer() as repeat:
+        app.cached_expense_report(1, {}, version)
+    print(json.dumps({"seconds": first.seconds, "cached_seconds": repeat.seconds,
+                      "rss_kb": memory.growth_kb, "pdf_bytes": len(data)}))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,100000,1000000")
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        if args.worker[0] == "populate":
+            populate(int(args.worker[1]))
+        else:
+            render()
+        return
+
+    print(f"{'rows':>10} {'seconds':>9} {'cached ms':>10} {'RSS growth MB':>14} {'PDF MB':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in (int(s) for s in args.sizes.split(",")):
+            db_path = os.path.join(tmp, f"bench_{size}.db")
+            run_worker("benchmarks.pdf_report", db_path, "populate", str(size))
+            result = run_worker("benchmarks.pdf_report", db_path, "render")
+            print(f"{size:>10} {result['seconds']:>9.2f} {result['cached_seconds'] * 1000:>10.2f} "
+                  f"{result['rss_kb'] / 1024:>14.1f} {result['pdf_bytes'] / 2**20:>8.1f}")
+
+if __name__ == "__main__":
+    main()
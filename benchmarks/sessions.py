@@ -0,0 +1,251 @@
+# Rerun latency of the whole app with many sessions open at once.
+#
+#   python -m benchmarks.sessions --sessions 200 --processes 4 --write-share 0.2 --steps 40
+#
+# Every session is a headless streamlit.testing AppTest with its own session
+# state. It logs in as one of datagen's users (password "password") and walks the pages the way a
+# person would: menu, Add Expense, View Expense, the table, a search, a chart
+# and the CSV export. "read" sessions save one expense per round; "write"
+# sessions save several and look at the table once. --write-share is the
+# fraction of write sessions.
+#
+# AppTest patches process-wide Streamlit state, so one interpreter can run
+# only one script at a time. Each worker process keeps its share of the
+# sessions open and steps them round-robin, one rerun each, so the
+# concurrency is one rerun per process, against the same database file, like
+# several app servers behind a load balancer. Every worker has its own
+# cache_resource singletons (pools, writer thread, caches), as separate
+# servers would.
+#
+# A rerun's latency is what the driver waits for, so it includes AppTest's own
+# cost of starting the script thread and rebuilding the element tree (about
+# 150-250 ms a rerun on a small VM, which the home page, which reads nothing,
+# shows). That is the same in every run, so compare runs with each other
+# rather than reading the numbers as what a browser would see.
+#
+# A rerun that fails counts as an error and the session starts over from the
+# home page. Errors whose message says the database is locked or busy are
+# also counted as lock errors.
+import argparse
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.common import run_worker
+from benchmarks.writes import percentile
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+RERUN_TIMEOUT = 60
+
+# Steps each scenario repeats once logged in, in order
+SCENARIOS = {
+    "read": ["add_expense_page", "save_expense", "view_expense_page", "view_table", "next_page", "search",
+             "bar_chart", "export_csv", "back_to_menu"],
+    "write": ["add_expense_page", "save_expense", "add_expense_page", "save_expense", "add_expense_page",
+              "save_expense", "view_expense_page", "view_table", "back_to_menu"],
+}
+
+def find(widgets, label):
+    for widget in widgets:
+        if widget.label == label:
+            return widget
+    raise LookupError(f"no widget labelled {label!r}")
+
+def click(label):
+    def step(at, session):
+        find(at.button, label).click()
+    return step
+
+def log_in(at, session):
+    find(at.text_input, "Enter your Email:").input(f"user{session['userid']}@example.com")
+    find(at.text_input, "Enter your Password:").input("password")
+    find(at.button, "Login").click()
+
+def save_expense(at, session):
+    session["saved"] += 1
+    find(at.text_input, "Enter Description:").input(f"load test {session['saved']}")
+    find(at.number_input, "Enter Amount:").set_value(round(session["rng"].uniform(1, 100), 2))
+    find(at.button, "Save").click()
+
+def next_page(at, session):
+    button = find(at.button, "Next")
+    if not button.disabled:
+        button.click()
+
+def search(at, session):
+    find(at.text_input, "Search descriptions").input(session["rng"].choice(["coff", "lunch", "taxi", "gym"]))
+    find(at.button, "View").click()
+
+STEPS = {
+    "home_page": lambda at, session: None,
+    "login_page": click("Login"),
+    "log_in": log_in,
+    "add_expense_page": click("Add Expense"),
+    "save_expense": save_expense,
+    "view_expense_page": click("View Expense"),
+    "view_table": click("View"),
+    "next_page": next_page,
+    "search": search,
+    "bar_chart": click("Bar Chart"),
+    "export_csv": click("Export to CSV"),
+    "back_to_menu": click("Back to Menu"),
+}
+LOGIN_STEPS = ["home_page", "login_page", "log_in"]
+
+# A page that calls st.rerun() leaves the widgets of the run it cut short in
+# AppTest's element tree, where a browser would drop them. Their state is
+# gone, so sending them back fails; this drops them the same way.
+def drop_stale_widgets(block, state):
+    from streamlit.testing.v1.element_tree import Widget
+    for key, node in list(block.children.items()):
+        if isinstance(node, Widget) and node.id not in state:
+            del block.children[key]
+        elif getattr(node, "children", None):
+            drop_stale_widgets(node, state)
+
+def is_lock_error(message):
+    return "locked" in message or "busy" in message
+
+def start_session(session):
+    from streamlit.testing.v1 import AppTest
+    session["at"] = AppTest.from_file(APP_PATH, default_timeout=RERUN_TIMEOUT)
+    session["queue"] = list(LOGIN_STEPS)
+
+# Runs each of this worker's sessions for `steps` reruns, round-robin, and
+# prints every rerun's (scenario, step, seconds) and the errors seen
+def drive(worker, processes, sessions, steps, write_share, seed):
+    import app
+    db = app.connect_to_db()
+    userids = [row[0] for row in db.execute("SELECT userid FROM users ORDER BY userid")]
+    db.close()
+    mine = []
+    for index in range(worker, sessions, processes):
+        rng = random.Random(seed * 100003 + index)
+        scenario = "write" if rng.random() < write_share else "read"
+        mine.append({"index": index, "userid": userids[index % len(userids)], "scenario": scenario, "rng": rng, "saved": 0})
+    for session in mine:
+        start_session(session)
+
+    reruns = []
+    errors = []
+    started = time.time()
+    for _ in range(steps):
+        for session in mine:
+            if not session["queue"]:
+                session["queue"] = list(SCENARIOS[session["scenario"]])
+            name = session["queue"].pop(0)
+            at = session["at"]
+            began = time.perf_counter()
+            try:
+                STEPS[name](at, session)
+                at.run()
+                failures = [element.message for element in at.exception]
+                drop_stale_widgets(at.main, at.session_state)
+            except Exception as err:
+                failures = [f"{type(err).__name__}: {err}"]
+            elapsed = time.perf_counter() - began
+            reruns.append((session["scenario"], name, elapsed))
+            if failures:
+                errors.append((session["scenario"], name, failures[0][:200]))
+                start_session(session)
+    print(json.dumps({"started": started, "finished": time.time(), "reruns": reruns, "errors": errors}))
+
+def summarize(latencies):
+    return {
+        "reruns": len(latencies),
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p95_ms": 1000 * percentile(latencies, 0.95),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+    }
+
+def report(results):
+    reruns = [rerun for result in results for rerun in result["reruns"]]
+    errors = [error for result in results for error in result["errors"]]
+    window = max(result["finished"] for result in results) - min(result["started"] for result in results)
+    by_scenario = defaultdict(list)
+    by_step = defaultdict(list)
+    for scenario, step, seconds in reruns:
+        by_scenario[scenario].append(seconds)
+        by_step[step].append(seconds)
+    messages = defaultdict(int)
+    for _, step, message in errors:
+        messages[f"{step}: {message}"] += 1
+    return {
+        "reruns_per_second": len(reruns) / window,
+        "seconds": window,
+        "all": summarize([seconds for _, _, seconds in reruns]),
+        "scenarios": {scenario: summarize(latencies) for scenario, latencies in sorted(by_scenario.items())},
+        "steps": {step: summarize(latencies) for step, latencies in sorted(by_step.items())},
+        "errors": len(errors),
+        "lock_errors": sum(1 for _, _, message in errors if is_lock_error(message)),
+        "error_messages": dict(sorted(messages.items(), key=lambda item: -item[1])),
+    }
+
+def generate(users, expenses, seed):
+    import app
+    import storage
+    from benchmarks.datagen import generate
+    db = app.connect_to_db()
+    generate(db, users, expenses, seed)
+    storage.rebuild_rollups(db)
+    storage.rebuild_search_index(db)
+    db.close()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--expenses", type=int, default=100000)
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--steps", type=int, default=40, help="reruns per session")
+    parser.add_argument("--write-share", type=float, default=0.2, help="fraction of write-heavy sessions")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--db", help="an existing database to run against instead of a generated one "
+                                     "(writes are added to it)")
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        if args.worker[0] == "generate":
+            generate(args.users, args.expenses, args.seed)
+        else:
+            drive(int(args.worker[1]), args.processes, args.sessions, args.steps, args.write_share, args.seed)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db or os.path.join(tmp, "sessions.db")
+        if not args.db:
+            run_worker("benchmarks.sessions", db_path, "generate", "--users", str(args.users),
+                       "--expenses", str(args.expenses), "--seed", str(args.seed))
+        options = ["--processes", str(args.processes), "--sessions", str(args.sessions), "--steps", str(args.steps),
+                   "--write-share", str(args.write_share), "--seed", str(args.seed)]
+        with ThreadPoolExecutor(args.processes) as executor:
+            results = list(executor.map(
+                lambda worker: run_worker("benchmarks.sessions", db_path, "drive", str(worker), *options),
+                range(args.processes)))
+    summary = dict(report(results), sessions=args.sessions, processes=args.processes, write_share=args.write_share)
+
+    print(f"{args.sessions} sessions over {args.processes} processes, write share {args.write_share}: "
+          f"{summary['reruns_per_second']:.1f} reruns/s over {summary['seconds']:.1f}s, "
+          f"{summary['errors']} errors ({summary['lock_errors']} lock errors)")
+    print(f"{'':>18} {'reruns':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    rows = [("all", summary["all"])] + list(summary["scenarios"].items()) + list(summary["steps"].items())
+    for name, stats in rows:
+        print(f"{name:>18} {stats['reruns']:>7} {stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+              f"{stats['p99_ms']:>8.1f}")
+    for message, count in list(summary["error_messages"].items())[:10]:
+        print(f"{count:>6}  {message}")
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(summary, output, indent=2)
+        print(f"\nWrote {args.output}")
+
+if __name__ == "__main__":
+    main()
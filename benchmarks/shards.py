@@ -0,0 +1,96 @@
+# Write throughput as user data is spread over more SQLite files.
+#
+#   python -m benchmarks.shards --shards 1,2,4,8 --sessions 32 --writes 200
+#
+# Every session is a thread adding expenses for its own user back to back,
+# as the Save button does. "queued" is the app's path, through the writer
+# thread of the user's shard; "direct" commits each write on its own pooled
+# connection to that shard, so sessions contend for the file's write lock.
+# --synchronous full makes every commit wait for fsync, as a deployment
+# wanting each write durable would. Each run uses fresh database files in a
+# fresh interpreter.
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from benchmarks.common import CATEGORIES, run_worker
+from benchmarks.writes import INSERT, percentile
+
+def load(mode, sessions, writes, synchronous):
+    import app
+    import storage
+    storage.DB_PRAGMAS = tuple(pragma for pragma in storage.DB_PRAGMAS if "synchronous" not in pragma) + (
+        f"PRAGMA synchronous={synchronous}",)
+    repository = storage.ShardedRepository(app.get_shard_pools())
+    if mode == "direct":
+        def write(user_id, params):
+            storage.ExpenseRepository._write(repository.shard(user_id), INSERT, params)
+    else:
+        def write(user_id, params):
+            repository.shard(user_id)._write(INSERT, params)
+
+    latencies = []
+    errors = []
+    start = threading.Barrier(sessions)
+
+    def session(user_id):
+        category_ids = [repository.category_id(user_id, name, create=True) for name in CATEGORIES]
+        start.wait()
+        for i in range(writes):
+            began = time.perf_counter()
+            try:
+                write(user_id, (user_id, category_ids[i % len(category_ids)], f"expense {i}", 10.0))
+            except Exception as err:
+                errors.append(str(err))
+                continue
+            latencies.append(time.perf_counter() - began)
+
+    threads = [threading.Thread(target=session, args=(user_id,)) for user_id in range(1, sessions + 1)]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    users_per_shard = [0] * len(repository.shards)
+    for user_id in range(1, sessions + 1):
+        users_per_shard[storage.user_shard(user_id, len(repository.shards))] += 1
+    print(json.dumps({
+        "writes_per_second": len(latencies) / elapsed,
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+        "errors": len(errors),
+        "users_per_shard": users_per_shard,
+    }))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", default="1,2,4,8")
+    parser.add_argument("--sessions", type=int, default=32)
+    parser.add_argument("--writes", type=int, default=200, help="writes per session")
+    parser.add_argument("--synchronous", choices=["normal", "full"], default="normal")
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        load(args.worker[0], args.sessions, args.writes, args.synchronous)
+        return
+
+    print(f"{'shards':>6} {'mode':>7} {'writes/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}  users per shard")
+    for shards in (int(s) for s in args.shards.split(",")):
+        for mode in ("direct", "queued"):
+            with tempfile.TemporaryDirectory() as tmp:
+                result = run_worker("benchmarks.shards", os.path.join(tmp, "shards.db"), mode,
+                                    "--sessions", str(args.sessions), "--writes", str(args.writes),
+                                    "--synchronous", args.synchronous,
+                                    env={"EXPENSE_TRACKER_SHARDS": str(shards)})
+            print(f"{shards:>6} {mode:>7} {result['writes_per_second']:>9.0f} {result['p50_ms']:>8.2f} "
+                  f"{result['p99_ms']:>8.2f} {result['errors']:>7}  {result['users_per_shard']}")
+
+if __name__ == "__main__":
+    main()
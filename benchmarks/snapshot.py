@@ -0,0 +1,138 @@
+# The columnar snapshot against the SQL and DataFrame paths for the same
+# analytics.
+#
+#   python -m benchmarks.snapshot --sizes 1000:100000,2000:1000000
+#
+# Each size is generated with benchmarks.datagen into its own temporary
+# database. A fresh interpreter then exports the snapshot, times an
+# incremental refresh after a few writes, and times category, month and day
+# totals for the heaviest and a typical user each way: the rollup tables the
+# pages read, a GROUP BY over the raw rows, a pandas groupby over the user's
+# frame as ExpenseFrameCache loads it, and the snapshot. "all users" sums
+# every user's spending in one pass.
+import argparse
+import json
+import os
+import tempfile
+
+from benchmarks.common import Timer, run_worker
+from benchmarks.suite import time_calls
+
+def paths(app, snapshot, user_id):
+    repository = app.get_repository()
+
+    def sql(query, params):
+        db = app.connect_to_db()
+        rows = db.execute(query, params).fetchall()
+        db.close()
+        return rows
+
+    def frame():
+        return app.ExpenseFrameCache(repository, app.FRAME_CACHE_BYTES).get(user_id).frame
+
+    def frame_months():
+        data = frame()
+        dates = data["date"].astype("datetime64[ns]")
+        return data.groupby([dates.dt.strftime("%Y-%m"), "category"], observed=True)["amount"].sum()
+
+    return {
+        "categories": {
+            "rollups": lambda: repository.category_totals(user_id),
+            "sql": lambda: sql("SELECT category_id, SUM(amount) FROM expenses WHERE userid=? GROUP BY category_id",
+                               (user_id,)),
+            "frame": lambda: frame().groupby("category", observed=True)["amount"].sum(),
+            "snapshot": lambda: snapshot.category_totals(user_id),
+        },
+        "months": {
+            "rollups": lambda: repository.monthly_totals(user_id, "2023-01", "2024-12"),
+            "sql": lambda: sql("SELECT substr(date, 1, 7), category_id, SUM(amount) FROM expenses "
+                               "WHERE userid=? GROUP BY 1, 2", (user_id,)),
+            "frame": frame_months,
+            "snapshot": lambda: snapshot.monthly_totals(user_id, "2023-01", "2024-12"),
+        },
+        "days": {
+            "rollups": lambda: repository.daily_totals(user_id, "2023-01-01", "2024-12-31"),
+            "sql": lambda: sql("SELECT substr(date, 1, 10), SUM(amount) FROM expenses WHERE userid=? GROUP BY 1",
+                               (user_id,)),
+            "snapshot": lambda: snapshot.daily_totals(user_id, "2023-01-01", "2024-12-31"),
+        },
+    }
+
+def measure(repeats, budget):
+    import app
+    import storage
+    db = app.connect_to_db()
+    with Timer() as export:
+        storage.refresh_snapshot(db, storage.DB_PATH)
+    counts = db.execute("SELECT userid, COUNT(*) FROM expenses GROUP BY userid ORDER BY 2 DESC, 1").fetchall()
+    users = {"heavy": counts[0], "typical": counts[len(counts) // 2]}
+    # A few writes of the kind the pages make, then the refresh that picks them up
+    repository = app.get_repository()
+    for user_id, _ in counts[:50]:
+        repository.add_expense(user_id, "Food", "benchmark", 9.99)
+    edited = repository.expense_chunk(counts[0][0], {}, 0, 1)[0][0]
+    repository.update_expenses(counts[0][0], [edited], amount=1.0)
+    with Timer() as refresh:
+        refreshed = storage.refresh_snapshot(db, storage.DB_PATH)
+
+    directory = storage.snapshot_path()
+    snapshot = storage.ExpenseSnapshot(directory)
+    results = {
+        "export_seconds": export.seconds,
+        "refresh_seconds": refresh.seconds,
+        "refresh_rows": refreshed["rows"],
+        "snapshot_bytes": sum(os.path.getsize(os.path.join(root, name))
+                              for root, _, names in os.walk(directory) for name in names),
+        "open": time_calls(lambda: storage.ExpenseSnapshot(directory), repeats, budget),
+        "all users": {
+            "sql": time_calls(lambda: db.execute("SELECT userid, SUM(amount) FROM expenses GROUP BY userid")
+                              .fetchall(), repeats, budget),
+            "rollups": time_calls(lambda: db.execute("SELECT userid, total_expenses FROM user_totals").fetchall(),
+                                  repeats, budget),
+            "snapshot": time_calls(snapshot.user_totals, repeats, budget),
+        },
+        "users": {},
+    }
+    for label, (user_id, rows) in users.items():
+        results["users"][label] = {
+            "userid": user_id,
+            "rows": rows,
+            "analytics": {name: {path: time_calls(fn, repeats, budget) for path, fn in ways.items()}
+                          for name, ways in paths(app, snapshot, user_id).items()},
+        }
+    db.close()
+    print(json.dumps(results))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000:100000,2000:1000000", help="comma-separated users:expenses pairs")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--budget", type=float, default=2.0, help="seconds to spend per operation")
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        measure(args.repeats, args.budget)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for spec in args.sizes.split(","):
+            users, expenses = (int(part) for part in spec.split(":"))
+            db_path = os.path.join(tmp, f"snapshot_{users}_{expenses}.db")
+            run_worker("benchmarks.suite", db_path, "generate", str(users), str(expenses), "--seed", str(args.seed))
+            result = run_worker("benchmarks.snapshot", db_path, "measure",
+                                "--repeats", str(args.repeats), "--budget", str(args.budget))
+            print(f"\n{expenses} expenses / {users} users: exported in {result['export_seconds']:.2f}s to "
+                  f"{result['snapshot_bytes'] / 2**20:.1f} MiB (database {os.path.getsize(db_path) / 2**20:.1f} MiB); "
+                  f"refresh of {result['refresh_rows']} rows {1000 * result['refresh_seconds']:.1f} ms; "
+                  f"open {result['open']['median_ms']:.2f} ms")
+            print(f"  {'all users':>22} " + "  ".join(f"{path} {timing['median_ms']:.2f} ms"
+                                                       for path, timing in result["all users"].items()))
+            for label, user in result["users"].items():
+                for name, ways in user["analytics"].items():
+                    print(f"  {label:>8} {name:>13} " + "  ".join(f"{path} {timing['median_ms']:.2f} ms"
+                                                                  for path, timing in ways.items()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+# Cold-start cost of the app.
+#
+#   python -m benchmarks.startup --runs 5
+#
+# Measures, each in a fresh interpreter:
+#   - `import app` under -X importtime, with the cumulative time of the
+#     heavy optional dependencies if any of them got imported
+#   - time to first render of the home page through Streamlit's AppTest,
+#     and whether rendering it opened the database
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ["pandas", "matplotlib", "fpdf", "numpy"]
+
+FIRST_RENDER = """
+import json, os, sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("app.py", default_timeout=60)
+start = time.perf_counter()
+at.run()
+first = time.perf_counter() - start
+start = time.perf_counter()
+at.run()
+rerun = time.perf_counter() - start
+print(json.dumps({
+    "first_render_seconds": first,
+    "rerun_seconds": rerun,
+    "heavy_modules_loaded": [m for m in %r if m in sys.modules],
+    "database_opened": os.path.exists(os.environ["EXPENSE_TRACKER_DB"]),
+}))
+""" % HEAVY_MODULES
+
+def parse_importtime(stderr):
+    cumulative = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, total, name = line.split("|")
+        if total.strip().isdigit():
+            cumulative[name.strip()] = int(total) / 1e6
+    return cumulative
+
+def measure_import(env):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"],
+                            env=env, capture_output=True, text=True, check=True)
+    cumulative = parse_importtime(result.stderr)
+    return {
+        "import_app_seconds": cumulative.get("app", 0.0),
+        "import_streamlit_seconds": cumulative.get("streamlit", 0.0),
+        "heavy_imports": {m: cumulative[m] for m in HEAVY_MODULES if m in cumulative},
+    }
+
+def measure_first_render(env):
+    result = subprocess.run([sys.executable, "-c", FIRST_RENDER], env=env, capture_output=True, text=True,
+                            check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    imports = []
+    renders = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for run in range(args.runs):
+            env = dict(os.environ, EXPENSE_TRACKER_DB=os.path.join(tmp, f"startup_{run}.db"))
+            imports.append(measure_import(env))
+            renders.append(measure_first_render(env))
+
+    results = {
+        "runs": args.runs,
+        "import_app_seconds": statistics.median(r["import_app_seconds"] for r in imports),
+        "import_streamlit_seconds": statistics.median(r["import_streamlit_seconds"] for r in imports),
+        "heavy_imports": imports[-1]["heavy_imports"],
+        "first_render_seconds": statistics.median(r["first_render_seconds"] for r in renders),
+        "rerun_seconds": statistics.median(r["rerun_seconds"] for r in renders),
+        "heavy_modules_loaded_by_home": renders[-1]["heavy_modules_loaded"],
+        "database_opened_by_home": renders[-1]["database_opened"],
+    }
+    for name, value in results.items():
+        print(f"{name:>32}: {value:.3f}" if isinstance(value, float) else f"{name:>32}: {value}")
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == "__main__":
+    main()
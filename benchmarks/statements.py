@@ -0,0 +1,62 @@
+# Month-end statement throughput as manage.py statements gets more processes.
+#
+#   python -m benchmarks.statements --sizes 1000:100000 --jobs 1,2,4,8
+#
+# Each size is generated with benchmarks.datagen into its own temporary
+# database, then every user's PDF and CSV statement for December 2024 (the
+# last month of datagen's history) is written from scratch once per job
+# count, each time in a fresh interpreter. Speedup is against one process;
+# it cannot exceed the number of cores, which the output shows.
+import argparse
+import json
+import os
+import tempfile
+from datetime import date
+
+from benchmarks.common import Timer, run_worker
+
+START = date(2024, 12, 1)
+END = date(2024, 12, 31)
+
+def write_all(jobs, directory):
+    import app
+    import manage
+    db = app.connect_to_db()
+    user_ids = [row[0] for row in db.execute("SELECT userid FROM users ORDER BY userid")]
+    db.close()
+    with Timer() as timer:
+        _, users, written, failures = manage.write_statements(user_ids, directory, START, END, jobs)
+    print(json.dumps({"seconds": timer.seconds, "users": users, "bytes": written, "failures": len(failures)}))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000:100000", help="comma-separated users:expenses pairs")
+    parser.add_argument("--jobs", default=",".join(str(2**i) for i in range((os.cpu_count() or 1).bit_length())),
+                        help="comma-separated process counts (default: powers of two up to the core count)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        write_all(int(args.worker[0]), args.worker[1])
+        return
+
+    print(f"{os.cpu_count()} cores")
+    print(f"{'expenses':>10} {'users':>6} {'jobs':>5} {'seconds':>8} {'users/s':>8} {'MiB/s':>7} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for spec in args.sizes.split(","):
+            users, expenses = (int(part) for part in spec.split(":"))
+            db_path = os.path.join(tmp, f"statements_{users}_{expenses}.db")
+            run_worker("benchmarks.suite", db_path, "generate", str(users), str(expenses), "--seed", str(args.seed))
+            baseline = None
+            for jobs in (int(j) for j in args.jobs.split(",")):
+                directory = os.path.join(tmp, f"out_{users}_{expenses}_{jobs}")
+                result = run_worker("benchmarks.statements", db_path, str(jobs), directory)
+                baseline = baseline or result["seconds"]
+                print(f"{expenses:>10} {result['users']:>6} {jobs:>5} {result['seconds']:>8.2f} "
+                      f"{result['users'] / result['seconds']:>8.1f} "
+                      f"{result['bytes'] / 2**20 / result['seconds']:>7.2f} {baseline / result['seconds']:>7.2f}x"
+                      + (f"  ({result['failures']} failed)" if result["failures"] else ""))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+# Times the app's hot paths headlessly at several dataset sizes.
+#
+#   python -m benchmarks.suite --sizes 1000:10000,1000:100000,2000:1000000 --output results.json
+#   python -m benchmarks.suite --sizes 1000:10000 --compare results.json
+#
+# Each size is generated with benchmarks.datagen into its own temporary
+# database and measured in a fresh interpreter, for the heaviest user and a
+# typical (median) one. Results are written as JSON; --compare prints the
+# ratio of every timing to a previous results file. --archive-before moves the
+# older rows into yearly archives before measuring, to compare against a run
+# without it.
+import argparse
+import glob
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import date, datetime, timezone
+
+from benchmarks.common import run_worker
+
+def hot_paths(app, user_id):
+    def category_totals():
+        return app.get_repository().category_totals(user_id)
+
+    def category_group_by():
+        db = app.connect_to_db()
+        rows = db.execute("SELECT category_id, SUM(amount) FROM expenses WHERE userid=? GROUP BY category_id",
+                          (user_id,)).fetchall()
+        db.close()
+        return rows
+
+    # What the year trend would cost read from raw rows instead of buckets
+    def month_group_by():
+        db = app.connect_to_db()
+        rows = db.execute("""
+            SELECT substr(date, 1, 7), category_id, SUM(amount) FROM expenses
+            WHERE userid=? AND date >= ? AND date < ?
+            GROUP BY 1, 2
+        """, (user_id, "2024-01-01", "2025-01-01")).fetchall()
+        db.close()
+        return rows
+
+    # The substring scan a search box would need without the index. A term
+    # that matches nothing reads all of the user's rows.
+    def search_like(term):
+        db = app.connect_to_db()
+        rows = db.execute("""
+            SELECT expid, category_id, description, amount, date FROM expenses
+            WHERE userid=? AND description LIKE ?
+            ORDER BY date DESC, expid DESC
+            LIMIT 51
+        """, (user_id, f"%{term}%")).fetchall()
+        db.close()
+        return rows
+
+    def chart_render():
+        data = category_totals()
+        return app.render_chart("bar", [row[0] for row in data], [row[1] for row in data])
+
+    # A cache of its own each call, so every call loads the frame
+    def frame_load():
+        return app.ExpenseFrameCache(app.get_repository(), app.FRAME_CACHE_BYTES).get(user_id)
+
+    def frame_view(filters):
+        return app.get_frame_cache().get(user_id).view(filters)
+
+    app.get_chart(user_id, "bar")
+    frame_view({})
+    return {
+        "get_balance": lambda: app.get_balance(user_id),
+        "view_first_page": lambda: app.fetch_expense_page(user_id, {}, None, 50),
+        "view_category_page": lambda: app.fetch_expense_page(user_id, {"category": "Food"}, None, 50),
+        "sql_first_page": lambda: app.get_repository().expense_page(user_id, {}, None, 51),
+        "sql_recent_month_page": lambda: app.get_repository().expense_page(
+            user_id, {"start_date": date(2024, 12, 1), "end_date": date(2024, 12, 31)}, None, 51),
+        "sql_old_month_page": lambda: app.get_repository().expense_page(
+            user_id, {"start_date": date(2023, 3, 1), "end_date": date(2023, 3, 31)}, None, 51),
+        "sql_category_page": lambda: app.get_repository().expense_page(user_id, {"category": "Food"}, None, 51),
+        "frame_load": frame_load,
+        "frame_hit": lambda: app.get_frame_cache().get(user_id),
+        "frame_count": lambda: len(frame_view({"category": "Food"})),
+        "frame_prefix_view": lambda: app.frame_filter_mask(app.get_frame_cache().get(user_id).frame,
+                                                           description_prefix="co"),
+        "sql_count": lambda: app.get_repository().count_expenses(user_id, {"category": "Food"}),
+        "sql_prefix_count": lambda: app.get_repository().count_expenses(user_id, {"description_prefix": "co"}),
+        "frame_csv_export": lambda: sum(len(chunk) for chunk in app.get_frame_cache().get(user_id).iter_csv({})),
+        "category_totals": category_totals,
+        "category_group_by": category_group_by,
+        "csv_export": lambda: sum(len(chunk) for chunk in app.iter_expense_csv(user_id)),
+        "pdf_report": lambda: app.generate_pdf(user_id),
+        "chart_render": chart_render,
+        "chart_cached": lambda: app.get_chart(user_id, "bar"),
+        # datagen's history runs to the end of 2024
+        "trends_year": lambda: app.spending_trends(user_id, 12, "2024-12", 3000.0),
+        "month_group_by": month_group_by,
+        "search_page": lambda: app.fetch_expense_page(user_id, {"search": "coff"}, None, 50),
+        "search_category_page": lambda: app.fetch_expense_page(user_id, {"search": "coff", "category": "Food"},
+                                                               None, 50),
+        "search_miss_page": lambda: app.fetch_expense_page(user_id, {"search": "xyz"}, None, 50),
+        "search_count": lambda: app.get_repository().count_expenses(user_id, {"search": "coff"}),
+        "search_like": lambda: search_like("coff"),
+        "search_like_miss": lambda: search_like("xyz"),
+    }
+
+# Runs fn up to `repeats` times, stopping early once `budget` seconds are
+# spent, and returns the timings in milliseconds
+def time_calls(fn, repeats, budget):
+    timings = []
+    spent = 0.0
+    while len(timings) < repeats and spent < budget:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        timings.append(elapsed * 1000)
+        spent += elapsed
+    return {"median_ms": statistics.median(timings), "min_ms": min(timings), "runs": len(timings)}
+
+def measure(repeats, budget):
+    import app
+    db = app.connect_to_db()
+    # From the buckets, which count archived rows too
+    counts = db.execute("SELECT userid, SUM(expense_count) FROM monthly_totals GROUP BY userid "
+                        "ORDER BY 2 DESC, 1").fetchall()
+    db.close()
+    users = {"heavy": counts[0], "typical": counts[len(counts) // 2]}
+    results = {}
+    for label, (user_id, rows) in users.items():
+        results[label] = {
+            "userid": user_id,
+            "rows": rows,
+            "ops": {name: time_calls(fn, repeats, budget) for name, fn in hot_paths(app, user_id).items()},
+        }
+    print(json.dumps(results))
+
+def generate(users, expenses, seed, archive_before=None):
+    import app
+    import storage
+    from benchmarks.datagen import generate
+    db = app.connect_to_db()
+    generate(db, users, expenses, seed)
+    storage.rebuild_rollups(db)
+    storage.rebuild_search_index(db)
+    if archive_before:
+        storage.archive_expenses(db, storage.DB_PATH, archive_before)
+        db.execute("VACUUM main")
+    db.close()
+
+def metadata():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def compare(results, baseline):
+    previous = {(size["users"], size["expenses"]): size for size in baseline["sizes"]}
+    print(f"\nCompared with {baseline['meta'].get('commit')} ({baseline['meta']['timestamp']}); <1.00 is faster")
+    for size in results["sizes"]:
+        old = previous.get((size["users"], size["expenses"]))
+        if old is None:
+            continue
+        for label, user in size["users_measured"].items():
+            for name, timing in user["ops"].items():
+                before = old["users_measured"].get(label, {}).get("ops", {}).get(name)
+                if before:
+                    ratio = timing["median_ms"] / before["median_ms"]
+                    print(f"{size['expenses']:>10} {label:>8} {name:>20} {ratio:>6.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000:10000,1000:100000,2000:1000000",
+                        help="comma-separated users:expenses pairs")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=2.0, help="seconds to spend per operation")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="previous results file to compare against")
+    parser.add_argument("--archive-before", help="archive expenses dated before this day (YYYY-MM-DD) "
+                                                 "once generated; datagen's history is 2023-2024")
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        if args.worker[0] == "generate":
+            generate(int(args.worker[1]), int(args.worker[2]), args.seed, args.archive_before)
+        else:
+            measure(args.repeats, args.budget)
+        return
+
+    results = {"meta": dict(metadata(), archive_before=args.archive_before), "sizes": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        for spec in args.sizes.split(","):
+            users, expenses = (int(part) for part in spec.split(":"))
+            db_path = os.path.join(tmp, f"suite_{users}_{expenses}.db")
+            start = time.perf_counter()
+            archive = ["--archive-before", args.archive_before] if args.archive_before else []
+            run_worker("benchmarks.suite", db_path, "generate", str(users), str(expenses), "--seed", str(args.seed),
+                       *archive)
+            generate_seconds = time.perf_counter() - start
+            measured = run_worker("benchmarks.suite", db_path, "measure",
+                                  "--repeats", str(args.repeats), "--budget", str(args.budget))
+            results["sizes"].append({
+                "users": users,
+                "expenses": expenses,
+                "generate_seconds": generate_seconds,
+                "db_bytes": os.path.getsize(db_path),
+                "archive_bytes": sum(os.path.getsize(path) for path in glob.glob(
+                    os.path.splitext(db_path)[0] + ".archive*")),
+                "users_measured": measured,
+            })
+            for label, user in measured.items():
+                print(f"\n{expenses} expenses / {users} users, {label} user ({user['rows']} rows)")
+                for name, timing in user["ops"].items():
+                    print(f"  {name:>20} {timing['median_ms']:>10.2f} ms  (min {timing['min_ms']:.2f}, "
+                          f"{timing['runs']} runs)")
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"\nWrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as previous:
+            compare(results, json.load(previous))
+
+if __name__ == "__main__":
+    main()
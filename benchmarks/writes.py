@@ -0,0 +1,93 @@
+# Write throughput and latency with many sessions writing at once.
+#
+#   python -m benchmarks.writes --sessions 1,8,32 --writes 200
+#
+# Every session is a thread adding expenses back to back, as the Save button
+# does. "direct" opens a pooled connection and commits each write on its own,
+# the way the pages used to; "queued" goes through the writer thread's group
+# commit. Each run uses a fresh database in a fresh interpreter.
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from benchmarks.common import CATEGORIES, run_worker
+
+INSERT = "INSERT INTO expenses (userid, category_id, description, amount) VALUES (?, ?, ?, ?)"
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def load(mode, sessions, writes):
+    import app
+    import storage
+    repository = app.get_repository()
+    if mode == "direct":
+        def write(params):
+            storage.ExpenseRepository._write(repository, INSERT, params)
+    else:
+        def write(params):
+            repository._write(INSERT, params)
+
+    latencies = []
+    errors = []
+    start = threading.Barrier(sessions)
+
+    def session(user_id):
+        category_ids = [repository.category_id(user_id, name, create=True) for name in CATEGORIES]
+        start.wait()
+        for i in range(writes):
+            began = time.perf_counter()
+            try:
+                write((user_id, category_ids[i % len(category_ids)], f"expense {i}", 10.0))
+            except Exception as err:
+                errors.append(str(err))
+                continue
+            latencies.append(time.perf_counter() - began)
+
+    threads = [threading.Thread(target=session, args=(user_id,)) for user_id in range(1, sessions + 1)]
+    began = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+
+    print(json.dumps({
+        "writes_per_second": len(latencies) / elapsed,
+        "p50_ms": 1000 * statistics.median(latencies),
+        "p95_ms": 1000 * percentile(latencies, 0.95),
+        "p99_ms": 1000 * percentile(latencies, 0.99),
+        "errors": len(errors),
+        "commits": repository.writer.stats()["batches"] if mode == "queued" else len(latencies),
+    }))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", default="1,8,32")
+    parser.add_argument("--writes", type=int, default=200, help="writes per session")
+    parser.add_argument("--worker", nargs="+", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        load(args.worker[0], int(args.worker[1]), args.writes)
+        return
+
+    print(f"{'sessions':>8} {'mode':>7} {'writes/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'commits':>8} {'errors':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for sessions in (int(s) for s in args.sessions.split(",")):
+            for mode in ("direct", "queued"):
+                db_path = os.path.join(tmp, f"writes_{mode}_{sessions}.db")
+                result = run_worker("benchmarks.writes", db_path, mode, str(sessions),
+                                    "--writes", str(args.writes))
+                print(f"{sessions:>8} {mode:>7} {result['writes_per_second']:>9.0f} {result['p50_ms']:>8.2f} "
+                      f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['commits']:>8} "
+                      f"{result['errors']:>7}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1081 @@
+import argparse
+import csv
+import io
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date, timedelta
+
+import app
+import storage
+
+# Every query the pages issue against user data, with sample parameters.
+# A plan step starting with SCAN means SQLite walks a whole table or index,
+# except on a virtual table, where it is a lookup through the table's own
+# index (a MATCH against the search index, say).
+QUERY_PLAN_CHECKS = [
+    ("get_balance", "SELECT total_income, total_expenses FROM user_totals WHERE userid=?", (1,)),
+    ("login", """
+        SELECT userid, username, password, EXISTS (SELECT 1 FROM income WHERE user_id = users.userid)
+        FROM users WHERE email=?
+     """, ("a@b.co",)),
+    ("login income", "SELECT income_amount FROM income WHERE user_id=?", (1,)),
+    ("forgot password", "SELECT userid FROM users WHERE email=?", ("a@b.co",)),
+    ("reset password", "UPDATE users SET password=? WHERE email=?", ("x", "a@b.co")),
+    ("update income", "UPDATE income SET income_amount = ? WHERE user_id = ?", (1.0, 1)),
+    ("categories", "SELECT name, category_id FROM categories WHERE userid=? ORDER BY category_id", (1,)),
+    ("category lookup", "SELECT category_id FROM categories WHERE userid=? AND name=?", (1, "Food")),
+    ("add category", "INSERT OR IGNORE INTO categories (userid, name) VALUES (?, ?)", (1, "Food")),
+    ("delete expenses", "DELETE FROM expenses WHERE userid=? AND expid IN (?, ?)", (1, 10, 11)),
+    ("update expenses", """
+        UPDATE expenses SET
+            category_id = COALESCE(?, category_id),
+            description = COALESCE(?, description),
+            amount = COALESCE(?, amount)
+        WHERE userid=? AND expid IN (?, ?)
+     """, (1, None, None, 1, 10, 11)),
+    ("batch edit totals",
+     "SELECT category_id, amount, date FROM expenses WHERE userid=? AND expid IN (?, ?)", (1, 10, 11)),
+    ("view all", "SELECT category_id, description, amount, date FROM expenses WHERE userid=?", (1,)),
+    ("view category",
+     "SELECT category_id, description, amount, date FROM expenses WHERE userid=? AND category_id=?",
+     (1, 1)),
+    ("csv export page", """
+        SELECT expid, category_id, description, amount, date FROM expenses
+        WHERE userid=? AND date >= ? AND date < ? AND expid > ?
+        ORDER BY expid
+        LIMIT ?
+     """, (1, "2024-01-01", "2024-02-01", 0, 5000)),
+    ("csv export page by category", """
+        SELECT expid, category_id, description, amount, date FROM expenses
+        WHERE userid=? AND category_id=? AND expid > ?
+        ORDER BY expid
+        LIMIT ?
+     """, (1, 1, 0, 5000)),
+    ("table page", """
+        SELECT expid, category_id, description, amount, date FROM expenses
+        WHERE userid=? AND (date, expid) < (?, ?)
+        ORDER BY date DESC, expid DESC
+        LIMIT ?
+     """, (1, "2024-01-01", 10, 26)),
+    ("table page by category and amount", """
+        SELECT expid, category_id, description, amount, date FROM expenses
+        WHERE userid=? AND category_id=? AND amount >= ? AND (date, expid) < (?, ?)
+        ORDER BY date DESC, expid DESC
+        LIMIT ?
+     """, (1, 1, 5.0, "2024-01-01", 10, 26)),
+    ("chart totals", "SELECT userid, category_id, total FROM category_totals WHERE userid=?", (1,)),
+    ("pdf top category", """
+        SELECT userid, category_id, total
+        FROM category_totals
+        WHERE userid = ?
+        ORDER BY total DESC
+        LIMIT 1
+     """, (1,)),
+    ("monthly trend", """
+        SELECT month, NULLIF(category_id, 0), total FROM monthly_totals
+        WHERE userid=? AND month BETWEEN ? AND ?
+        ORDER BY month, category_id
+     """, (1, "2024-01", "2024-12")),
+    ("daily balance", """
+        SELECT day, SUM(total) FROM daily_totals
+        WHERE userid=? AND day BETWEEN ? AND ?
+        GROUP BY day
+        ORDER BY day
+     """, (1, "2024-01-01", "2024-12-31")),
+    ("spent before", "SELECT SUM(total) FROM monthly_totals WHERE userid=? AND month < ?", (1, "2024-01")),
+    ("search page", """
+        SELECT expid, category_id, description, amount, date
+        FROM expenses_fts CROSS JOIN expenses ON expid = expenses_fts.rowid
+        WHERE expenses_fts MATCH ? AND userid=? AND category_id=?
+        ORDER BY bm25(expenses_fts, 0.0, 1.0), expid DESC
+        LIMIT ? OFFSET ?
+     """, ('owner:u1 AND words:("coff" OR "coff"*)', 1, 1, 26, 0)),
+    ("search count", """
+        SELECT COUNT(*) FROM expenses
+        WHERE userid=? AND expid IN (SELECT rowid FROM expenses_fts WHERE expenses_fts MATCH ?)
+     """, (1, 'owner:u1 AND words:("coff" OR "coff"*)')),
+]
+
+def check_query_plans(db):
+    failures = []
+    for name, query, params in QUERY_PLAN_CHECKS:
+        plan = db.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+        steps = [row[3] for row in plan]
+        scans = [step for step in steps if step.startswith("SCAN") and "VIRTUAL TABLE" not in step]
+        print(f"{'FAIL' if scans else 'ok  '} {name}: {'; '.join(steps)}")
+        if scans:
+            failures.append(name)
+    return failures
+
+# Conformance checks every storage backend must pass. Each check works on
+# users it creates itself, under emails unique to the run, so they can be
+# pointed at any database; a scratch one is still the better choice.
+#
+# The checks' passwords are hashed, and checked, at a cheap cost;
+# cmd_check_storage makes it the app's for the run.
+CHECK_PASSWORD_ITERATIONS = 1000
+
+def new_user(repository, tag, name):
+    email = f"{name}-{tag}@conformance.test"
+    return repository.create_user(name, email, app.hash_password("secret", CHECK_PASSWORD_ITERATIONS)), email
+
+# What authenticate() returns, without its thread pool and rehashing
+def log_in(repository, email, password):
+    row = repository.find_login(email)
+    if row and app.check_password(password, row[2])[0]:
+        return row[0], row[1], row[3]
+    return None
+
+def expect(actual, expected, what):
+    if actual != expected:
+        raise AssertionError(f"{what}: expected {expected!r}, got {actual!r}")
+
+def check_users(repository, tag):
+    user_id, email = new_user(repository, tag, "alice")
+    expect(log_in(repository, email, "secret"), (user_id, "alice", False), "login")
+    expect(log_in(repository, email, "wrong"), None, "login with a wrong password")
+    expect(repository.find_login(f"nobody-{tag}@conformance.test"), None, "login with an unknown email")
+    expect(repository.find_user_by_email(email), user_id, "lookup by email")
+    expect(repository.find_user_by_email(f"nobody-{tag}@conformance.test"), None, "unknown email")
+    try:
+        repository.create_user("alice again", email, app.hash_password("other", CHECK_PASSWORD_ITERATIONS))
+    except storage.DuplicateEmailError:
+        pass
+    else:
+        raise AssertionError("registering an email twice did not raise DuplicateEmailError")
+    # A password stored before migration 15 matches and asks to be rehashed
+    repository.set_password(email, "plain$changed")
+    expect(app.check_password("changed", repository.find_login(email)[2]), (True, True), "plaintext password")
+    expect(app.check_password("secret", repository.find_login(email)[2]), (False, True),
+           "wrong plaintext password")
+    expect(repository.set_password(email, app.hash_password("changed", CHECK_PASSWORD_ITERATIONS)), 1,
+           "password rows updated")
+    expect(log_in(repository, email, "changed"), (user_id, "alice", False), "login after a password reset")
+
+def check_income(repository, tag):
+    user_id, email = new_user(repository, tag, "bob")
+    expect(repository.has_income(user_id), False, "income before any is recorded")
+    expect(repository.find_login(email)[3], False, "income flag at login before any is recorded")
+    expect(repository.get_totals(user_id), (0.0, 0.0), "totals of a new user")
+    repository.add_income(user_id, 1500.25)
+    expect(repository.has_income(user_id), True, "income after it is recorded")
+    expect(repository.find_login(email)[3], True, "income flag at login after it is recorded")
+    expect(repository.get_totals(user_id), (1500.25, 0.0), "totals after recording income")
+    repository.set_income(user_id, 2000.0)
+    expect(repository.get_totals(user_id), (2000.0, 0.0), "totals after updating income")
+
+def check_expense_rollups(repository, tag):
+    user_id, _ = new_user(repository, tag, "carol")
+    other_id, _ = new_user(repository, tag, "carl")
+    versions = [repository.data_version(user_id)]
+    for category, description, amount in (("Food", "lunch", 12.5), ("Food", "dinner", 30.0),
+                                          ("Rent", "march", 900.0), ("Travel", "bus", 2.5)):
+        repository.add_expense(user_id, category, description, amount)
+        versions.append(repository.data_version(user_id))
+    expect(sorted(set(versions)), versions, "data_version rising on every insert")
+    expect(repository.get_totals(user_id), (0.0, 945.0), "totals after inserts")
+    expect(repository.category_totals(user_id), [("Food", 42.5), ("Rent", 900.0), ("Travel", 2.5)],
+           "category totals")
+    expect(repository.top_category(user_id), ("Rent", 900.0), "top category")
+    expids = {row[2]: row[0] for row in repository.expense_page(user_id, {}, None, 10)}
+
+    version = repository.data_version(user_id)
+    expect(repository.update_expenses(user_id, [expids["lunch"]], description="brunch", amount=20.0), 1,
+           "rows updated")
+    expect(repository.category_totals(user_id), [("Food", 50.0), ("Rent", 900.0), ("Travel", 2.5)],
+           "totals after update")
+    expect(repository.data_version(user_id) > version, True, "data_version rising on update")
+    expect({row[2] for row in repository.expense_page(user_id, {"category": "Food"}, None, 10)},
+           {"brunch", "dinner"}, "descriptions after update")
+
+    # Recategorizing a selection moves its totals and empties Travel
+    expect(repository.update_expenses(user_id, [expids["dinner"], expids["bus"]], category="Rent"), 2,
+           "rows recategorized")
+    expect(repository.category_totals(user_id), [("Food", 20.0), ("Rent", 932.5)], "totals after recategorizing")
+    expect(repository.update_expenses(user_id, [expids["dinner"], expids["bus"]], amount=5.0), 2,
+           "amounts changed")
+    expect(repository.category_totals(user_id), [("Food", 20.0), ("Rent", 910.0)], "totals after amount change")
+    expect(repository.get_totals(user_id), (0.0, 930.0), "totals after batch updates")
+
+    # Another user's expids never match
+    expect(repository.delete_expenses(other_id, list(expids.values())), 0, "deleting another user's rows")
+    version = repository.data_version(user_id)
+    expect(repository.delete_expenses(user_id, [expids["march"], expids["bus"]]), 2, "rows deleted")
+    expect(repository.category_totals(user_id), [("Food", 20.0), ("Rent", 5.0)], "totals after delete")
+    expect(repository.get_totals(user_id), (0.0, 25.0), "totals after delete")
+    expect(repository.data_version(user_id) > version, True, "data_version rising on delete")
+    expect(repository.delete_expenses(user_id, [expids["dinner"]]), 1, "last row of a category deleted")
+    expect(repository.category_totals(user_id), [("Food", 20.0)], "emptied category removed")
+    expect(repository.delete_expenses(user_id, [expids["march"]]), 0, "deleting a missing expense")
+    expect(repository.delete_expenses(user_id, []), 0, "deleting an empty selection")
+
+def check_categories(repository, tag):
+    user_id, _ = new_user(repository, tag, "fred")
+    other_id, _ = new_user(repository, tag, "gina")
+    expect(repository.categories(user_id), {}, "categories of a new user")
+    expect(repository.category_id(user_id, "Pets"), None, "id of a missing category")
+    repository.add_category(user_id, "Pets")
+    repository.add_category(user_id, "Pets")
+    repository.add_expense(user_id, "Books", "novel", 9.0)
+    categories = repository.categories(user_id)
+    expect(list(categories), ["Pets", "Books"], "categories in the order they were added")
+    expect(repository.category_id(user_id, "Books"), categories["Books"], "id lookup")
+    repository.add_expense(other_id, "Books", "atlas", 30.0)
+    expect(repository.category_id(other_id, "Books") != categories["Books"], True, "ids are per user")
+    expect(repository.category_totals(other_id), [("Books", 30.0)], "other user's totals")
+    expect(repository.expense_page(user_id, {"category": "Books"}, None, 10)[0][1:4], ("Books", "novel", 9.0),
+           "row decoded to its category name")
+    expect(repository.expense_page(user_id, {"category": "Nope"}, None, 10), [], "filter on an unknown category")
+
+def check_import_and_filters(repository, tag):
+    user_id, _ = new_user(repository, tag, "dave")
+    other_id, _ = new_user(repository, tag, "erin")
+    repository.add_expense(other_id, "Food", "not dave's", 1.0)
+    rows = [
+        (user_id, "Food", "50% off pizza", 10.0, "2024-01-05 12:00:00"),
+        (user_id, "Food", "50x off pizza", 20.0, "2024-01-31 23:59:59"),
+        (user_id, "Travel", "train", 30.0, "2024-02-01 00:00:00"),
+        (user_id, "Food", "snack_bar", 40.0, "2024-02-01 00:00:00"),
+        (user_id, "Travel", "hotel", 50.0, "2024-03-10 08:30:00"),
+    ]
+    food = repository.category_id(user_id, "Food", create=True)
+    travel = repository.category_id(user_id, "Travel", create=True)
+    version = repository.data_version(user_id)
+    repository.import_batch(user_id, ((row[0], food if row[1] == "Food" else travel) + row[2:] for row in rows),
+                            [(user_id, food, 70.0, 3), (user_id, travel, 80.0, 2)], {
+        "daily_totals": [(user_id, "2024-01-05", food, 10.0, 1), (user_id, "2024-01-31", food, 20.0, 1),
+                         (user_id, "2024-02-01", food, 40.0, 1), (user_id, "2024-02-01", travel, 30.0, 1),
+                         (user_id, "2024-03-10", travel, 50.0, 1)],
+        "monthly_totals": [(user_id, "2024-01", food, 30.0, 2), (user_id, "2024-02", food, 40.0, 1),
+                           (user_id, "2024-02", travel, 30.0, 1), (user_id, "2024-03", travel, 50.0, 1)],
+    })
+    expect(repository.data_version(user_id) > version, True, "data_version rising on import")
+    expect(repository.get_totals(user_id), (0.0, 150.0), "totals after import")
+    expect(repository.category_totals(user_id), [("Food", 70.0), ("Travel", 80.0)], "category totals after import")
+    expect(repository.get_totals(other_id), (0.0, 1.0), "other user's totals untouched by import")
+
+    # Newest first, ties on date broken by expid, two rows per page
+    pages = []
+    after = None
+    while True:
+        page = repository.expense_page(user_id, {}, after, 2)
+        if not page:
+            break
+        pages.append([row[2] for row in page])
+        after = (page[-1][4], page[-1][0])
+    expect(pages, [["hotel", "snack_bar"], ["train", "50x off pizza"], ["50% off pizza"]], "table pages")
+
+    chunks = []
+    last_expid = 0
+    while True:
+        chunk = repository.expense_chunk(user_id, {}, last_expid, 2)
+        if not chunk:
+            break
+        chunks.append([row[3] for row in chunk])
+        last_expid = chunk[-1][0]
+    expect(chunks, [[10.0, 20.0], [30.0, 40.0], [50.0]], "export chunks")
+    expect(repository.expense_chunk(user_id, {}, 0, 1)[0][1:], rows[0][1:], "exported row")
+
+    filter_cases = [
+        ({"category": "Travel"}, {"train", "hotel"}),
+        ({"category": "All"}, {row[2] for row in rows}),
+        ({"start_date": date(2024, 2, 1)}, {"train", "snack_bar", "hotel"}),
+        ({"end_date": date(2024, 1, 31)}, {"50% off pizza", "50x off pizza"}),
+        ({"min_amount": 20.0, "max_amount": 40.0}, {"50x off pizza", "train", "snack_bar"}),
+        ({"description_prefix": "50%"}, {"50% off pizza"}),
+        ({"description_prefix": "snack_"}, {"snack_bar"}),
+        ({"category": "Food", "start_date": date(2024, 1, 10), "end_date": date(2024, 2, 29)},
+         {"50x off pizza", "snack_bar"}),
+    ]
+    for filters, expected in filter_cases:
+        found = {row[2] for row in repository.expense_page(user_id, filters, None, 10)}
+        expect(found, expected, f"filter {filters}")
+        expect(repository.count_expenses(user_id, filters), len(expected), f"count for {filters}")
+
+def check_time_buckets(repository, tag):
+    user_id, _ = new_user(repository, tag, "hana")
+    # An expense added now lands in the current month
+    repository.add_expense(user_id, "Food", "today", 4.0)
+    month = repository.expense_page(user_id, {}, None, 1)[0][4][:7]
+    expect(repository.monthly_totals(user_id, month, month), [(month, "Food", 4.0)], "bucket of a new expense")
+
+    food = repository.category_id(user_id, "Food")
+    travel = repository.category_id(user_id, "Travel", create=True)
+    rows = [
+        (user_id, food, "lunch", 10.0, "2024-01-05 12:00:00"),
+        (user_id, food, "dinner", 20.0, "2024-01-31 23:59:59"),
+        (user_id, travel, "train", 30.0, "2024-02-01 00:00:00"),
+        (user_id, food, "snack", 40.0, "2024-02-01 09:00:00"),
+    ]
+    repository.import_batch(user_id, rows, [(user_id, food, 70.0, 3), (user_id, travel, 30.0, 1)], {
+        "daily_totals": [(user_id, "2024-01-05", food, 10.0, 1), (user_id, "2024-01-31", food, 20.0, 1),
+                         (user_id, "2024-02-01", food, 40.0, 1), (user_id, "2024-02-01", travel, 30.0, 1)],
+        "monthly_totals": [(user_id, "2024-01", food, 30.0, 2), (user_id, "2024-02", food, 40.0, 1),
+                           (user_id, "2024-02", travel, 30.0, 1)],
+    })
+    expect(repository.monthly_totals(user_id, "2024-01", "2024-03"),
+           [("2024-01", "Food", 30.0), ("2024-02", "Food", 40.0), ("2024-02", "Travel", 30.0)],
+           "monthly totals after import")
+    expect(repository.daily_totals(user_id, "2024-01-31", "2024-02-29"),
+           [("2024-01-31", 20.0), ("2024-02-01", 70.0)], "daily totals after import")
+    expids = {row[2]: row[0] for row in repository.expense_page(user_id, {}, None, 10)}
+
+    repository.update_expenses(user_id, [expids["train"], expids["dinner"]], category="Food", amount=5.0)
+    expect(repository.monthly_totals(user_id, "2024-01", "2024-02"),
+           [("2024-01", "Food", 15.0), ("2024-02", "Food", 45.0)], "buckets after recategorizing")
+    repository.delete_expenses(user_id, [expids["dinner"]])
+    expect(repository.daily_totals(user_id, "2024-01-01", "2024-01-31"), [("2024-01-05", 10.0)],
+           "emptied day removed")
+    expect(repository.spent_before(user_id, "2024-02"), 10.0, "spending before a month")
+    expect(repository.spent_before(user_id, "2024-01"), 0.0, "spending before any expense")
+
+def check_search(repository, tag):
+    user_id, _ = new_user(repository, tag, "ivan")
+    other_id, _ = new_user(repository, tag, "jane")
+    for category, description in (("Food", "Coffee beans"), ("Food", "coffee"), ("Food", "iced coffee and a muffin"),
+                                  ("Travel", "coffee at the airport"), ("Food", "green tea")):
+        repository.add_expense(user_id, category, description, 3.0)
+    repository.add_expense(other_id, "Food", "coffee", 3.0)
+
+    def search(text, **filters):
+        return [row[2] for row in repository.search_page(user_id, {"search": text, **filters}, 0, 10)]
+
+    expect(search("coffee")[0], "coffee", "closest match ranked first")
+    expect(search("coff")[-1], "iced coffee and a muffin", "longest description ranked last")
+    expect(set(search("COFF")), {"Coffee beans", "coffee", "iced coffee and a muffin", "coffee at the airport"},
+           "prefix match, ignoring case and other users")
+    expect(search("coff muf"), ["iced coffee and a muffin"], "every word must match")
+    expect(search("coff", category="Travel"), ["coffee at the airport"], "search within a category")
+    expect(search('"tea" OR'), [], "quotes and operators taken as words")
+    expect(repository.count_expenses(user_id, {"search": "coff"}), 4, "count of matches")
+    expect({row[2] for row in repository.expense_page(user_id, {"search": "coff", "category": "Food"}, None, 10)},
+           {"Coffee beans", "coffee", "iced coffee and a muffin"}, "date-ordered page of matches")
+
+    pages = [[row[0] for row in repository.search_page(user_id, {"search": "coff"}, offset, 3)]
+             for offset in (0, 3)]
+    expect((len(pages[0]), len(pages[1]), len(set(pages[0] + pages[1]))), (3, 1, 4), "result pages")
+
+    expids = {row[2]: row[0] for row in repository.expense_page(user_id, {}, None, 10)}
+    repository.update_expenses(user_id, [expids["green tea"]], description="matcha latte")
+    expect(search("tea"), [], "old description unindexed on update")
+    expect(search("matcha"), ["matcha latte"], "new description indexed on update")
+    repository.delete_expenses(user_id, [expids["coffee"], expids["Coffee beans"]])
+    expect(set(search("coffee")), {"iced coffee and a muffin", "coffee at the airport"}, "deleted rows unindexed")
+
+def check_frame_cache(repository, tag):
+    user_id, _ = new_user(repository, tag, "kate")
+    other_id, _ = new_user(repository, tag, "liam")
+    for category, description, amount in (("Food", "Lunch", 12.5), ("Travel", "train", 30.0),
+                                          ("Food", "50% off pizza", 8.0), ("Food", None, 4.0)):
+        repository.add_expense(user_id, category, description, amount)
+    repository.add_expense(other_id, "Food", "not kate's", 1.0)
+    cache = app.ExpenseFrameCache(repository, 2**20)
+
+    # What iter_expense_csv() writes, read from this repository
+    def csv_text(filters):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(app.EXPORT_COLUMNS)
+        writer.writerows(row[1:] for row in repository.expense_chunk(user_id, filters, 0, 100))
+        return buffer.getvalue()
+
+    def expect_same(what):
+        frame = cache.get(user_id)
+        for filters in ({}, {"category": "Food"}, {"category": "Nope"}, {"description_prefix": "lu"},
+                        {"min_amount": 5.0, "max_amount": 20.0}, {"start_date": date.today()}):
+            expect(frame.page(filters, None, 10), repository.expense_page(user_id, filters, None, 10),
+                   f"{what}: page for {filters}")
+            expect(len(frame.view(filters)), repository.count_expenses(user_id, filters),
+                   f"{what}: count for {filters}")
+            expect("".join(frame.iter_csv(filters)), csv_text(filters), f"{what}: CSV for {filters}")
+        pages = []
+        after = None
+        while True:
+            page = frame.page({}, after, 3)
+            if not page:
+                break
+            pages += page
+            after = (page[-1][4], page[-1][0])
+        expect(pages, repository.expense_page(user_id, {}, None, 10), f"{what}: pages after a cursor")
+
+    expect_same("loaded")
+    expect(cache.get(user_id) is cache.get(user_id), True, "unchanged frame reused")
+    edit_version = repository.versions(user_id)[1]
+    repository.add_expense(user_id, "Health", "pills", 6.0)
+    # A backend whose inserts count as edits (MySQLRepository) reloads instead
+    appends = int(repository.versions(user_id)[1] == edit_version)
+    expect_same("appended")
+    expids = [row[0] for row in repository.expense_page(user_id, {}, None, 10)]
+    repository.update_expenses(user_id, expids[:2], category="Travel", amount=2.0)
+    expect_same("updated")
+    repository.delete_expenses(user_id, expids[2:3])
+    expect_same("deleted")
+    stats = cache.stats()
+    expect((stats["appends"], stats["loads"]), (appends, 4 - appends), "appends after inserts, reloads after edits")
+
+    cache.get(other_id)
+    cache.max_bytes = cache.stats()["bytes"]
+    repository.add_expense(other_id, "Food", "more", 1.0)
+    cache.get(other_id)
+    expect((cache.stats()["evictions"], cache.stats()["users"]), (1, 1), "least recently used frame evicted")
+    cache.max_bytes = 1
+    expect(cache.get(user_id), None, "frame over the cap not cached")
+
+STORAGE_CHECKS = [
+    ("users", check_users),
+    ("income", check_income),
+    ("expense rollups", check_expense_rollups),
+    ("categories", check_categories),
+    ("import and filters", check_import_and_filters),
+    ("time buckets", check_time_buckets),
+    ("search", check_search),
+    ("frame cache", check_frame_cache),
+]
+
+def check_storage(repository):
+    tag = uuid.uuid4().hex[:8]
+    failures = []
+    for name, check in STORAGE_CHECKS:
+        try:
+            check(repository, tag)
+        except Exception as err:
+            print(f"FAIL {name}: {type(err).__name__}: {err}")
+            failures.append(name)
+        else:
+            print(f"ok   {name}")
+    return failures
+
+# Pools for every shard of the database at `path`, opened and migrated as
+# they are first asked for
+class ShardFiles:
+    def __init__(self, path):
+        self.path = path
+        self.pools = {}
+
+    def connect(self, index):
+        if index not in self.pools:
+            self.pools[index] = storage.ConnectionPool(storage.shard_path(index, self.path), storage.Metrics())
+            storage.initialize_db(self.pools[index])
+        return self.pools[index].acquire()
+
+# Moves every user whose shard differs between the database's current shard
+# count and `shards`, then records the new count. The app must be stopped
+# meanwhile: it routes users by the count it started with. An interrupted
+# run can be repeated; see storage.move_user_data().
+def reshard(path, shards, dry_run=False):
+    files = ShardFiles(path)
+    directory = files.connect(0)
+    current = storage.get_shard_layout(directory)
+    user_ids = [row[0] for row in directory.execute("SELECT userid FROM users ORDER BY userid")]
+    moves = {}
+    for user_id in user_ids:
+        source, target = storage.user_shard(user_id, current), storage.user_shard(user_id, shards)
+        if source != target:
+            moves.setdefault((source, target), []).append(user_id)
+    # Archives are per shard file and are not moved
+    for index in range(current):
+        db = files.connect(index)
+        archived = db.execute("SELECT COUNT(*) FROM archives").fetchone()[0]
+        db.close()
+        if archived:
+            raise SystemExit(f"{storage.shard_path(index, path)} has archived expenses; "
+                             f"run manage.py restore-archive before resharding")
+    print(f"{current} -> {shards} shards: {sum(map(len, moves.values()))} of {len(user_ids)} users move")
+    for (source_index, target_index), movers in sorted(moves.items()):
+        source = files.connect(source_index)
+        target = None if dry_run else files.connect(target_index)
+        start = time.perf_counter()
+        rows = 0
+        for user_id in movers:
+            if dry_run:
+                rows += source.execute("SELECT COUNT(*) FROM expenses WHERE userid=?", (user_id,)).fetchone()[0]
+            else:
+                rows += storage.move_user_data(source, target, user_id)
+        print(f"  shard {source_index} -> {target_index}: {len(movers)} users, {rows} expenses"
+              + ("" if dry_run else f" in {time.perf_counter() - start:.1f}s"))
+        source.close()
+        if target is not None:
+            target.close()
+    if not dry_run:
+        storage.set_shard_layout(directory, shards)
+        # Moving renumbers expids, which snapshots count on
+        for index in range(max(current, shards)):
+            shutil.rmtree(storage.snapshot_path(storage.shard_path(index, path)), ignore_errors=True)
+        for index in range(shards, current):
+            print(f"  {storage.shard_path(index, path)} is now empty and can be deleted")
+    directory.close()
+
+def cmd_migrate(args):
+    for index, pool in enumerate(app.get_shard_pools()):
+        db = pool.acquire()
+        print(f"Shard {index} schema is at version {storage.get_schema_version(db)}")
+        db.close()
+    return 0
+
+# Opens the database without migrating it: dedupe-emails is what lets a
+# database with shared emails migrate
+def cmd_dedupe_emails(args):
+    db = storage.ConnectionPool(storage.DB_PATH, storage.Metrics()).acquire()
+    try:
+        renamed = storage.dedupe_emails(db)
+    finally:
+        db.close()
+    for user_id, email, new_email in renamed:
+        print(f"user {user_id}: {email} -> {new_email}")
+    print(f"Renamed {len(renamed)} accounts")
+    return 0
+
+def cmd_check_plans(args):
+    db = app.connect_to_db()
+    failures = check_query_plans(db)
+    db.close()
+    if failures:
+        print(f"{len(failures)} queries scan a full table or index")
+        return 1
+    return 0
+
+def cmd_check_rollups(args):
+    drifted = 0
+    for index, pool in enumerate(app.get_shard_pools()):
+        db = pool.acquire()
+        drift = storage.rebuild_rollups(db)
+        db.close()
+        for table, key, stored, expected in drift:
+            print(f"shard {index} {table} {key}: stored {stored}, expected {expected}")
+        drifted += len(drift)
+    print(f"Rollups rebuilt, {drifted} drifted rows")
+    return 1 if drifted else 0
+
+def cmd_rebuild_search(args):
+    count = 0
+    for pool in app.get_shard_pools():
+        db = pool.acquire()
+        count += storage.rebuild_search_index(db)
+        db.close()
+    print(f"Search index rebuilt, {count} expenses indexed")
+    return 0
+
+def cmd_reshard(args):
+    reshard(storage.DB_PATH, args.shards, args.dry_run)
+    return 0
+
+# The first day of the month `months` before the month of day
+def months_before(day, months):
+    month = day.year * 12 + day.month - 1 - months
+    return date(month // 12, month % 12 + 1, 1)
+
+def cmd_archive(args):
+    cutoff = (args.before or months_before(date.today(), args.keep_months)).isoformat()
+    print(f"Archiving expenses dated before {cutoff}")
+    for index, pool in enumerate(app.get_shard_pools()):
+        db = pool.acquire()
+        start = time.perf_counter()
+        archived = storage.archive_expenses(db, pool.path, cutoff)
+        for year, rows in archived.items():
+            print(f"  shard {index}: {rows} expenses from {year} to {storage.archive_path(year, pool.path)}")
+        hot = db.execute("SELECT COUNT(*) FROM expenses").fetchone()[0]
+        print(f"  shard {index}: {sum(archived.values())} archived in {time.perf_counter() - start:.1f}s, "
+              f"{hot} left in {pool.path}")
+        if args.vacuum:
+            start = time.perf_counter()
+            db.execute("VACUUM main")
+            print(f"  shard {index}: vacuumed to {os.path.getsize(pool.path) / 2**20:.0f} MiB "
+                  f"in {time.perf_counter() - start:.1f}s")
+        db.close()
+    return 0
+
+def cmd_restore_archive(args):
+    for index, pool in enumerate(app.get_shard_pools()):
+        db = pool.acquire()
+        listed = [row[0] for row in db.execute("SELECT year FROM archives ORDER BY year")]
+        for year in listed:
+            if args.year and year not in args.year:
+                continue
+            count = storage.restore_archive(db, pool.path, year)
+            print(f"shard {index}: {count} expenses from {year} restored; "
+                  f"{storage.archive_path(year, pool.path)} is empty and can be deleted once the app restarts")
+        db.close()
+    return 0
+
+def cmd_snapshot(args):
+    for index, pool in enumerate(app.get_shard_pools()):
+        db = pool.acquire()
+        start = time.perf_counter()
+        result = storage.refresh_snapshot(db, pool.path)
+        db.close()
+        print(f"shard {index}: {result['rows']} expenses of {result['users']} users exported "
+              f"({result['full_users']} in full) in {time.perf_counter() - start:.1f}s; "
+              f"{result['segments']} segments in {storage.snapshot_path(pool.path)}")
+    return 0
+
+# Everything the pages can read about a user, to compare before and after
+# resharding. Expids are left out since moving renumbers them.
+def user_snapshot(repository, user_id):
+    return {
+        "totals": repository.get_totals(user_id),
+        "categories": list(repository.categories(user_id)),
+        "category totals": repository.category_totals(user_id),
+        "months": repository.monthly_totals(user_id, "0000-00", "9999-99"),
+        "days": repository.daily_totals(user_id, "0000-00-00", "9999-99-99"),
+        "rows": [row[1:] for row in repository.expense_page(user_id, {}, None, 1000)],
+        "search": [row[1:] for row in repository.search_page(user_id, {"search": "coff"}, 0, 1000)],
+    }
+
+def check_resharding(path, shards):
+    def open_repository(count):
+        return storage.ShardedRepository([files.pools[index] for index in range(count)])
+
+    files = ShardFiles(path)
+    for index in range(shards + 1):
+        files.connect(index).close()
+    repository = open_repository(shards)
+    directory = files.connect(0)
+    user_ids = [row[0] for row in directory.execute("SELECT userid FROM users")]
+    directory.close()
+    before = {user_id: user_snapshot(repository, user_id) for user_id in user_ids}
+    for count in (shards + 1, 1, shards):
+        reshard(path, count)
+        repository = open_repository(count)
+        for user_id in user_ids:
+            expect(user_snapshot(repository, user_id), before[user_id], f"user {user_id} after resharding to {count}")
+        for index in range(count):
+            db = files.connect(index)
+            expect(storage.rebuild_rollups(db), [], f"rollup drift on shard {index} of {count}")
+            db.close()
+
+# What the pages read about a user, expids included, to compare before and
+# after archiving. Search results are compared as sets: each archive ranks
+# against its own index.
+def archive_snapshot(repository, user_id):
+    def walk(fetch):
+        rows = []
+        after = None
+        while True:
+            page = fetch(after)
+            if not page:
+                return rows
+            rows += page
+            after = page[-1]
+
+    filter_cases = [{}, {"category": "Food"}, {"start_date": date(2024, 2, 1)}, {"end_date": date(2024, 1, 31)},
+                    {"start_date": date.today()}, {"search": "coff"}]
+    return {
+        "totals": repository.get_totals(user_id),
+        "category totals": repository.category_totals(user_id),
+        "months": repository.monthly_totals(user_id, "0000-00", "9999-99"),
+        "pages": walk(lambda last: repository.expense_page(user_id, {}, last and (last[4], last[0]), 2)),
+        "chunks": walk(lambda last: repository.expense_chunk(user_id, {}, last[0] if last else 0, 2)),
+        "frame": app.ExpenseFrameCache(repository, 2**24).get(user_id).page({}, None, 1000),
+        "filtered": [repository.expense_page(user_id, filters, None, 1000) for filters in filter_cases],
+        "counts": [repository.count_expenses(user_id, filters) for filters in filter_cases],
+        "search": sorted(repository.search_page(user_id, {"search": "coff"}, 0, 1000)),
+    }
+
+# Archives every shard's expenses at two cutoffs, then restores them, and
+# checks that the pages read the same and the rollups rebuild to the same
+# totals throughout. Edits leave archived rows alone, pages asked for
+# editable rows leave them out, and ranges after a cutoff never read the
+# archives.
+def check_archiving(path, shards):
+    files = ShardFiles(path)
+    for index in range(shards):
+        files.connect(index).close()
+    repository = storage.ShardedRepository([files.pools[index] for index in range(shards)])
+    directory = files.connect(0)
+    user_ids = [row[0] for row in directory.execute("SELECT userid FROM users")]
+    directory.close()
+    before = {user_id: archive_snapshot(repository, user_id) for user_id in user_ids}
+
+    def each_shard(work):
+        for index in range(shards):
+            db = files.connect(index)
+            work(db, storage.shard_path(index, path))
+            expect(storage.rebuild_rollups(db), [], f"rollup drift on shard {index}")
+            db.close()
+
+    def restore(db, shard_path):
+        for year, in db.execute("SELECT year FROM archives").fetchall():
+            storage.restore_archive(db, shard_path, year)
+
+    tomorrow = (date.today() + timedelta(days=1)).isoformat()
+    for cutoff in ("2024-02-01", tomorrow):
+        each_shard(lambda db, shard_path: storage.archive_expenses(db, shard_path, cutoff))
+        for user_id in user_ids:
+            expect(archive_snapshot(repository, user_id), before[user_id], f"user {user_id} archived to {cutoff}")
+
+        reads = repository.stats()["archive_reads"]
+        for user_id in user_ids:
+            repository.expense_page(user_id, {"start_date": date.fromisoformat(cutoff)}, None, 10)
+        expect(repository.stats()["archive_reads"], reads, f"archive reads for a range after {cutoff}")
+
+    user_id = max(user_ids, key=lambda user_id: len(before[user_id]["pages"]))
+    expids = [row[0] for row in repository.expense_page(user_id, {}, None, 1000)]
+    expect(repository.delete_expenses(user_id, expids), 0, "archived expenses deleted")
+    expect(repository.expense_page(user_id, {"archived": False}, None, 1000), [], "archived expenses listed as editable")
+    each_shard(restore)
+    for user_id in user_ids:
+        expect(archive_snapshot(repository, user_id), before[user_id], f"user {user_id} after restoring")
+
+# Requests that share a batch with a failing one: an ordinary constraint
+# error and one whose conflict clause rolls back the whole transaction each
+# fail only their own request, and the others around it are committed
+def check_write_queue(path, shards):
+    files = ShardFiles(path)
+    files.connect(0).close()
+    repository = storage.SQLiteRepository(files.pools[0])
+    tag = uuid.uuid4().hex[:8]
+    taken_id, taken_email = new_user(repository, tag, "queue")
+    insert = "INSERT {} INTO users (userid, username, email, password) VALUES (?, ?, ?, 'x')"
+    for clause in ("", "OR ROLLBACK"):
+        release = threading.Event()
+        repository.writer.call(lambda db: release.wait(10))
+        emails = [f"queue-{name}-{clause or 'abort'}-{tag}@conformance.test" for name in ("before", "after")]
+        futures = [repository.writer.submit(insert.format(""), (None, "before", emails[0])),
+                   repository.writer.submit(insert.format(clause), (taken_id, "taken", taken_email)),
+                   repository.writer.submit(insert.format(""), (None, "after", emails[1]))]
+        release.set()
+        what = f"a batch with a failing {clause or 'plain'} insert"
+        expect(type(futures[1].exception(10)), sqlite3.IntegrityError, f"error of the failing request in {what}")
+        expect([future.exception(10) for future in (futures[0], futures[2])], [None, None],
+               f"errors of the other requests in {what}")
+        expect([repository.find_user_by_email(email) is not None for email in emails], [True, True],
+               f"rows committed in {what}")
+
+# A database from before migrations whose accounts share emails: migrating
+# it stops and names them, and once dedupe-emails has renamed all but the
+# oldest of each it migrates, with every account still able to log in
+def check_duplicate_emails(path, shards):
+    path = os.path.splitext(path)[0] + "-unmigrated.db"
+    db = storage.ConnectionPool(path, storage.Metrics()).acquire()
+    for statement in storage.MIGRATIONS[0][1]:
+        db.execute(statement)
+    db.executemany("INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+                   [("ann", "ann@conformance.test", "one"), ("ann 2", "ann@conformance.test", "two"),
+                    ("bea", "bea@conformance.test", "three"), ("ann 3", "ann@conformance.test", "four")])
+    db.commit()
+    db.close()
+    pool = storage.ConnectionPool(path, storage.Metrics())
+    try:
+        storage.initialize_db(pool)
+    except RuntimeError as err:
+        expect("ann@conformance.test (userids 1, 2, 4)" in str(err), True, f"accounts named in {err}")
+    else:
+        raise AssertionError("migrating shared emails did not stop")
+    db = pool.acquire()
+    expect(storage.get_schema_version(db), 0, "schema version after the stopped migration")
+    expect(storage.dedupe_emails(db), [(2, "ann@conformance.test", "duplicate-2-ann@conformance.test"),
+                                   (4, "ann@conformance.test", "duplicate-4-ann@conformance.test")], "renames")
+    db.close()
+    expect(storage.initialize_db(pool), storage.MIGRATIONS[-1][0], "schema version after deduplicating")
+    repository = storage.SQLiteRepository(pool)
+    for email, password, user_id in (("ann@conformance.test", "one", 1), ("duplicate-2-ann@conformance.test", "two", 2),
+                                     ("bea@conformance.test", "three", 3),
+                                     ("duplicate-4-ann@conformance.test", "four", 4)):
+        expect(log_in(repository, email, password), (user_id, repository.find_login(email)[1], False),
+               f"login as {email}")
+
+# Spending by category, month and day as the rollups hold it and as the
+# snapshot computes it, to the cent
+def rollup_figures(db, user_id):
+    return {
+        "categories": db.execute("SELECT category_id, ROUND(total, 2) FROM category_totals "
+                                 "WHERE userid=? AND expense_count > 0 ORDER BY category_id", (user_id,)).fetchall(),
+        "months": db.execute("SELECT month, NULLIF(category_id, 0), ROUND(total, 2) FROM monthly_totals "
+                             "WHERE userid=? AND expense_count > 0 ORDER BY month, category_id", (user_id,)).fetchall(),
+        "days": db.execute("SELECT day, ROUND(SUM(total), 2) FROM daily_totals "
+                           "WHERE userid=? AND expense_count > 0 GROUP BY day ORDER BY day", (user_id,)).fetchall(),
+    }
+
+def snapshot_figures(snapshot, user_id):
+    return {
+        "categories": [(category_id, round(total, 2)) for category_id, total in snapshot.category_totals(user_id)],
+        "months": [(month, category_id, round(total, 2))
+                   for month, category_id, total in snapshot.monthly_totals(user_id, "0001-01", "9999-12")],
+        "days": [(day, round(total, 2)) for day, total in snapshot.daily_totals(user_id, "0001-01-01", "9999-12-31")],
+    }
+
+# Refreshes every shard's snapshot through additions, edits, deletes,
+# archiving and restoring, and past the segment limit, and checks that it
+# adds up to what the rollups hold each time, and that the app reads it
+# only while it is current
+def check_snapshot(path, shards):
+    files = ShardFiles(path)
+    for index in range(shards):
+        files.connect(index).close()
+    repository = storage.ShardedRepository([files.pools[index] for index in range(shards)])
+    directory = files.connect(0)
+    user_ids = [row[0] for row in directory.execute("SELECT userid FROM users ORDER BY userid")]
+    directory.close()
+
+    def refresh(what):
+        for index in range(shards):
+            db = files.connect(index)
+            shard_path = storage.shard_path(index, path)
+            storage.refresh_snapshot(db, shard_path)
+            snapshot = storage.ExpenseSnapshot(storage.snapshot_path(shard_path))
+            for user_id, in db.execute("SELECT userid FROM user_totals").fetchall():
+                expect(snapshot_figures(snapshot, user_id), rollup_figures(db, user_id), f"user {user_id} {what}")
+                totals = app.snapshot_totals(repository, user_id)
+                expect(totals and [(name, round(total, 2)) for name, total in totals.category_totals(user_id)],
+                       [(name, round(total, 2)) for name, total in repository.category_totals(user_id) if total],
+                       f"user {user_id} app totals from the snapshot {what}")
+            ids, totals = snapshot.user_totals()
+            expect({user_id: round(total, 2) for user_id, total in zip(ids.tolist(), totals.tolist()) if total},
+                   dict(db.execute("SELECT userid, ROUND(total_expenses, 2) FROM user_totals "
+                                   "WHERE total_expenses != 0").fetchall()), f"totals on shard {index} {what}")
+            expect(len(snapshot.segments) <= storage.SNAPSHOT_MAX_SEGMENTS, True, f"segments on shard {index} {what}")
+            db.close()
+
+    refresh("when first exported")
+    user_id = next(user_id for user_id in user_ids if repository.count_expenses(user_id, {}) >= 2)
+    repository.add_expense(user_id, "Food", "snapshot", 1.25)
+    expids = [row[0] for row in repository.expense_chunk(user_id, {}, 0, 2)]
+    expect(repository.update_expenses(user_id, expids[:1], amount=7.5), 1, "snapshot row updated")
+    expect(repository.delete_expenses(user_id, expids[1:]), 1, "snapshot row deleted")
+    refresh("after edits")
+    for index in range(shards):
+        db = files.connect(index)
+        storage.archive_expenses(db, storage.shard_path(index, path), "2024-02-01")
+        db.close()
+    refresh("after archiving")
+    for index in range(shards):
+        db = files.connect(index)
+        for year, in db.execute("SELECT year FROM archives").fetchall():
+            storage.restore_archive(db, storage.shard_path(index, path), year)
+        db.close()
+    refresh("after restoring")
+    for round_number in range(storage.SNAPSHOT_MAX_SEGMENTS + 1):
+        repository.add_expense(user_ids[round_number % len(user_ids)], "Travel", "snapshot", 3.0)
+        expect(app.snapshot_totals(repository, user_ids[round_number % len(user_ids)]), None,
+               f"app totals from a snapshot older than addition {round_number + 1}")
+        refresh(f"after {round_number + 1} more additions")
+
+def cmd_check_storage(args):
+    app.PASSWORD_HASH_ITERATIONS = CHECK_PASSWORD_ITERATIONS
+    if args.backend == "mysql" and args.mysql_server:
+        repository = storage.MySQLRepository(storage.MYSQL_CONFIG, storage.Metrics())
+        repository.initialize()
+        return 1 if check_storage(repository) else 0
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.backend == "mysql":
+            import mysql_standin
+            config = dict(storage.MYSQL_CONFIG, database=os.path.join(tmp, "conformance_mysql.db"))
+            repository = storage.MySQLRepository(config, storage.Metrics(), connector=mysql_standin)
+            repository.initialize()
+            return 1 if check_storage(repository) else 0
+        path = os.path.join(tmp, "conformance.db")
+        files = ShardFiles(path)
+        for index in range(args.shards):
+            files.connect(index).close()
+        checks = [("archiving", check_archiving), ("snapshot", check_snapshot),
+                  ("write queue", check_write_queue), ("duplicate emails", check_duplicate_emails)]
+        if args.shards == 1:
+            failures = check_storage(storage.SQLiteRepository(files.pools[0]))
+        else:
+            directory = files.connect(0)
+            storage.set_shard_layout(directory, args.shards)
+            directory.close()
+            failures = check_storage(storage.ShardedRepository([files.pools[index] for index in range(args.shards)]))
+            checks.insert(0, ("resharding", check_resharding))
+        for name, check in checks:
+            try:
+                check(path, args.shards)
+            except Exception as err:
+                print(f"FAIL {name}: {type(err).__name__}: {err}")
+                failures.append(name)
+            else:
+                print(f"ok   {name}")
+        return 1 if failures else 0
+
+def cmd_export(args):
+    output = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for chunk in app.iter_expense_csv(args.user, category=args.category, search=args.search,
+                                          start_date=args.start, end_date=args.end):
+            output.write(chunk)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0
+
+# A user's statement files in directory, as (csv, pdf)
+def statement_paths(directory, user_id):
+    stem = os.path.join(directory, f"user{user_id}")
+    return f"{stem}.csv", f"{stem}.pdf"
+
+# Writes the chunks (bytes) to a file beside path and renames it into place
+# once synced, so path either holds a whole file or does not exist
+def write_atomically(path, chunks):
+    partial = f"{path}.partial"
+    with open(partial, "wb") as output:
+        for chunk in chunks:
+            output.write(chunk)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(partial, path)
+    return os.path.getsize(path)
+
+def statement_worker_init():
+    app.READ_ONLY = True
+
+# Runs in a worker process. The CSV streams straight to disk a chunk at a
+# time; the PDF is built in memory by fpdf, from rows streamed the same way.
+def write_statement(user_id, directory, start, end):
+    filters = {"start_date": start, "end_date": end}
+    csv_path, pdf_path = statement_paths(directory, user_id)
+    written = write_atomically(csv_path, (chunk.encode("utf-8") for chunk in app.iter_expense_csv(user_id, **filters)))
+    written += write_atomically(pdf_path, [app.generate_pdf(user_id, **filters)])
+    return written
+
+# Writes the statements of user_ids for start..end (inclusive) into directory
+# over `jobs` worker processes, skipping users whose files are already there,
+# so running it again after a crash picks up where it stopped. Workers are
+# spawned rather than forked so none inherits this process's connections or
+# writer thread; each opens its own read-only pool. progress(done, pending,
+# written bytes) is called as users finish. Returns (skipped, written users,
+# written bytes, failures as (user_id, error)).
+def write_statements(user_ids, directory, start, end, jobs, progress=None):
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.endswith(".partial"):
+            os.remove(os.path.join(directory, name))
+    pending = [user_id for user_id in user_ids
+               if not all(os.path.exists(path) for path in statement_paths(directory, user_id))]
+    written = 0
+    failures = []
+    with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=statement_worker_init) as executor:
+        futures = {executor.submit(write_statement, user_id, directory, start, end): user_id
+                   for user_id in pending}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                written += future.result()
+            except Exception as err:
+                failures.append((futures[future], err))
+            if progress:
+                progress(done, len(pending), written)
+    return len(user_ids) - len(pending), len(pending) - len(failures), written, failures
+
+def cmd_statements(args):
+    directory = args.output or os.path.join("statements", f"{args.start}_{args.end}")
+    user_ids = args.user
+    if not user_ids:
+        db = app.connect_to_db()
+        user_ids = [row[0] for row in db.execute("SELECT userid FROM users ORDER BY userid")]
+        db.close()
+    start = time.perf_counter()
+    last_report = 0.0
+
+    def report(done, pending, written):
+        nonlocal last_report
+        elapsed = time.perf_counter() - start
+        if done == pending or elapsed - last_report >= 1:
+            last_report = elapsed
+            print(f"{done}/{pending} users, {done / elapsed:,.1f} users/s, "
+                  f"{written / 2**20 / elapsed:,.1f} MiB/s", file=sys.stderr)
+
+    skipped, users, written, failures = write_statements(user_ids, directory, args.start, args.end, args.jobs,
+                                                         progress=report)
+    elapsed = time.perf_counter() - start
+    for user_id, err in failures:
+        print(f"user {user_id}: {err}")
+    print(f"Wrote statements for {users} users to {directory} in {elapsed:.1f}s "
+          f"({users / elapsed:,.1f} users/s, {written / 2**20:,.1f} MiB) over {args.jobs} processes; "
+          f"{skipped} already done, {len(failures)} failed")
+    return 1 if failures else 0
+
+def cmd_import(args):
+    def report(result, fraction):
+        done = f" ({fraction:.0%})" if fraction is not None else ""
+        print(f"{result.imported} imported, {result.rejected} rejected{done}", file=sys.stderr)
+
+    start = time.perf_counter()
+    with open(args.file, "rb") as source:
+        result = app.import_expenses_csv(args.user, source, args.batch_rows, progress=report)
+    elapsed = time.perf_counter() - start
+    for line, reason in result.rejects:
+        print(f"line {line}: {reason}")
+    print(f"Imported {result.imported} expenses in {elapsed:.2f}s "
+          f"({result.imported / elapsed:,.0f} rows/s), rejected {result.rejected}")
+    return 1 if result.rejected else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Expense tracker maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("migrate", help="apply pending schema migrations").set_defaults(func=cmd_migrate)
+    commands.add_parser("dedupe-emails", help="give all but the oldest account sharing an email a new one, "
+                                              "so the database can migrate").set_defaults(func=cmd_dedupe_emails)
+    commands.add_parser("check-plans", help="fail if any app query scans a whole table").set_defaults(
+        func=cmd_check_plans)
+    commands.add_parser("check-rollups", help="rebuild rollup tables and report drift").set_defaults(
+        func=cmd_check_rollups)
+    commands.add_parser("rebuild-search", help="reindex every expense description").set_defaults(
+        func=cmd_rebuild_search)
+
+    reshard_parser = commands.add_parser("reshard", help="move users between shard files for a new shard count")
+    reshard_parser.add_argument("--shards", type=int, required=True)
+    reshard_parser.add_argument("--dry-run", action="store_true", help="only report how many users would move")
+    reshard_parser.set_defaults(func=cmd_reshard)
+
+    archive = commands.add_parser("archive", help="move old expenses into yearly archive files")
+    archive.add_argument("--before", type=date.fromisoformat, help="archive expenses dated before this day")
+    archive.add_argument("--keep-months", type=int, default=storage.ARCHIVE_KEEP_MONTHS,
+                         help="without --before, keep this many months before the current one")
+    archive.add_argument("--vacuum", action="store_true", help="shrink the main database file afterwards")
+    archive.set_defaults(func=cmd_archive)
+
+    restore_archive = commands.add_parser("restore-archive", help="move archived expenses back")
+    restore_archive.add_argument("--year", type=int, action="append", help="only this year; may repeat")
+    restore_archive.set_defaults(func=cmd_restore_archive)
+
+    commands.add_parser("snapshot", help="bring the columnar analytics snapshot up to date").set_defaults(
+        func=cmd_snapshot)
+
+    check_storage = commands.add_parser(
+        "check-storage", help="run the storage conformance checks against a backend")
+    check_storage.add_argument("--backend", choices=["sqlite", "mysql"], default="sqlite",
+                               help="sqlite uses a scratch file; mysql a scratch mysql_standin database")
+    check_storage.add_argument("--mysql-server", action="store_true",
+                               help="run the mysql checks on the EXPENSE_TRACKER_MYSQL_* server instead")
+    check_storage.add_argument("--shards", type=int, default=1,
+                               help="spread the sqlite scratch database over this many files, then reshard it")
+    check_storage.set_defaults(func=cmd_check_storage)
+
+    export = commands.add_parser("export", help="stream a user's expenses as CSV")
+    export.add_argument("--user", type=int, required=True)
+    export.add_argument("--category")
+    export.add_argument("--search", help="only expenses whose description has these words or word starts")
+    export.add_argument("--start", type=date.fromisoformat, help="first day, YYYY-MM-DD")
+    export.add_argument("--end", type=date.fromisoformat, help="last day, YYYY-MM-DD")
+    export.add_argument("-o", "--output", help="file to write instead of stdout")
+    export.set_defaults(func=cmd_export)
+
+    statements = commands.add_parser("statements", help="write every user's PDF and CSV statement for a period")
+    statements.add_argument("--start", type=date.fromisoformat, required=True, help="first day, YYYY-MM-DD")
+    statements.add_argument("--end", type=date.fromisoformat, required=True, help="last day, YYYY-MM-DD")
+    statements.add_argument("--user", type=int, action="append", help="only this user; may repeat")
+    statements.add_argument("--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    statements.add_argument("-o", "--output", help="directory to write into, by default statements/<start>_<end>; "
+                                                   "run again with the same one to resume")
+    statements.set_defaults(func=cmd_statements)
+
+    bulk_import = commands.add_parser("import", help="bulk import expenses from a CSV export")
+    bulk_import.add_argument("--user", type=int, required=True)
+    bulk_import.add_argument("--batch-rows", type=int, default=storage.IMPORT_BATCH_ROWS)
+    bulk_import.add_argument("file")
+    bulk_import.set_defaults(func=cmd_import)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,440 @@
+# A stand-in for the parts of mysql.connector that MySQLRepository uses, so
+# `manage.py check-storage --backend mysql` can run where no MySQL server is
+# at hand. Each database is a SQLite file, and statements are rewritten from
+# MySQL's dialect into SQLite's on the way in: AUTO_INCREMENT keys, KEY
+# clauses, ON DUPLICATE KEY UPDATE, trigger bodies with IF blocks, @session
+# variables, UPDATE ... JOIN and MATCH ... AGAINST in boolean mode. Only the
+# dialect MYSQL_MIGRATIONS and MySQLRepository speak is understood.
+#
+# Where MySQLRepository depends on the connector's behaviour, the stand-in
+# copies it: pools raise when exhausted, prepared cursors take ? and plain
+# ones %s, a plain cursor's unread result blocks the connection, sessions
+# keep their variables and prepared statements unless the pool resets them,
+# MATCH needs a FULLTEXT index, and text compares ignoring case, as under
+# MySQL's default collation. UPDATE row counts are the rows matched, which
+# MySQL only reports with ClientFlag.FOUND_ROWS, so connecting without that
+# flag is refused.
+import itertools
+import re
+import sqlite3
+import threading
+import types
+import weakref
+
+class Error(Exception):
+    pass
+
+class InterfaceError(Error):
+    pass
+
+class PoolError(Error):
+    pass
+
+class DatabaseError(Error):
+    pass
+
+class InternalError(DatabaseError):
+    pass
+
+class IntegrityError(DatabaseError):
+    pass
+
+class ProgrammingError(DatabaseError):
+    pass
+
+class NotSupportedError(DatabaseError):
+    pass
+
+constants = types.SimpleNamespace(ClientFlag=types.SimpleNamespace(FOUND_ROWS=1 << 1))
+
+_connection_ids = itertools.count(1)
+# GET_LOCK() names, server-wide as in MySQL
+_named_locks = {}
+_named_locks_lock = threading.Lock()
+
+def get_lock(name, timeout):
+    with _named_locks_lock:
+        lock = _named_locks.setdefault(name, threading.Lock())
+    return int(lock.acquire(timeout=timeout))
+
+def release_lock(name):
+    lock = _named_locks.get(name)
+    if lock is None or not lock.locked():
+        return None
+    lock.release()
+    return 1
+
+def concat(*values):
+    if any(value is None for value in values):
+        return None
+    return "".join(str(value) for value in values)
+
+# Relevance of `text` to a boolean mode query: each + word must be present,
+# word* matches as a prefix, and a whole-word hit counts double. Scores are
+# divided by the text's word count, so shorter matches rank higher, roughly
+# as InnoDB's ranking does.
+def match_score(text, query):
+    words = re.findall(r"\w+", (text or "").lower())
+    if not words:
+        return 0
+    score = 0
+    for term in query.lower().split():
+        required = term.startswith("+")
+        term = term.lstrip("+")
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        hits = sum(2 if word == term else 1 for word in words
+                   if word == term or (prefix and word.startswith(term)))
+        if required and not hits:
+            return 0
+        score += hits
+    return score / len(words)
+
+# Splits text on commas outside parentheses
+def split_top_level(text):
+    parts, depth, start = [], 0, 0
+    for index, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "," and depth == 0:
+            parts.append(text[start:index])
+            start = index + 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+# The index of the parenthesis closing the one at `start`
+def closing_paren(text, start):
+    depth = 0
+    for index in range(start, len(text)):
+        if text[index] == "(":
+            depth += 1
+        elif text[index] == ")":
+            depth -= 1
+            if depth == 0:
+                return index
+    raise ProgrammingError(f"unbalanced parentheses in {text!r}")
+
+KEY_CLAUSE = re.compile(r"(UNIQUE\s+|FULLTEXT\s+)?(?:KEY|INDEX)\s+(\w+)\s*(\(.*\))$", re.I | re.S)
+MATCH = re.compile(r"\bMATCH\s*\((\w+)\)\s*AGAINST\s*\((\?)\s+IN\s+BOOLEAN\s+MODE\)", re.I)
+TRIGGER = re.compile(r"CREATE\s+TRIGGER\s+(IF\s+NOT\s+EXISTS\s+)?(\w+)\s+(BEFORE|AFTER)\s+(INSERT|UPDATE|DELETE)\s+"
+                     r"ON\s+(\w+)\s+FOR\s+EACH\s+ROW\s+(.*)$", re.I | re.S)
+
+# A column definition. Text columns compare ignoring case, as MySQL's
+# default collation does.
+def column(definition):
+    definition = re.sub(r"\b(?:BIG)?INT\s+PRIMARY\s+KEY\s+AUTO_INCREMENT\b", "INTEGER PRIMARY KEY AUTOINCREMENT",
+                        definition, flags=re.I)
+    definition = re.sub(r"\s+(AFTER\s+\w+|FIRST)$", "", definition, flags=re.I)
+    if re.search(r"\b(VARCHAR|CHAR|TEXT)\b", definition, re.I):
+        definition += " COLLATE NOCASE"
+    return definition
+
+# A KEY clause of `table` as statements. FULLTEXT indexes are only recorded,
+# for MATCH to find; match_score() reads the column itself.
+def index(table, key, if_not_exists=""):
+    kind, name, columns = key.groups()
+    kind = (kind or "").strip().upper()
+    if kind == "FULLTEXT":
+        return [f"INSERT OR REPLACE INTO standin_fulltext (name, table_name, columns) "
+                f"VALUES ('{name}', '{table}', '{columns[1:-1].strip()}')"]
+    unique = "UNIQUE " if kind == "UNIQUE" else ""
+    return [f"CREATE {unique}INDEX {if_not_exists}{name} ON {table} {columns}"]
+
+# Rewrites of single statements that need no restructuring
+def dialect(sql):
+    sql = re.sub(r"\bINSERT\s+IGNORE\b", "INSERT OR IGNORE", sql, flags=re.I)
+    sql = re.sub(r"\bLEFT\s*\(", "mysql_left(", sql, flags=re.I)
+    sql = re.sub(r"@(\w+)", r"session_var('\1')", sql)
+    sql = MATCH.sub(r"match_score(\1, \2)", sql)
+    upsert = re.search(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b", sql, re.I)
+    if upsert:
+        updates = re.sub(r"\bVALUES\s*\((\w+)\)", r"excluded.\1", sql[upsert.end():], flags=re.I)
+        sql = f"{sql[:upsert.start()]}ON CONFLICT DO UPDATE SET{updates}"
+    return sql
+
+# The statements of a trigger body, each with the IF conditions it runs under
+def trigger_statements(body):
+    statements, conditions, position = [], [], 0
+    for token in re.finditer(r"\bIF\b(.*?)\bTHEN\b|\bEND\s+IF\b\s*;?|;", body, re.I | re.S):
+        text = body[position:token.start()].strip()
+        if text:
+            statements.append((list(conditions), text))
+        if token.group(0).upper().startswith("IF"):
+            conditions.append(token.group(1).strip())
+        elif token.group(0).upper().startswith("END"):
+            conditions.pop()
+        position = token.end()
+    if body[position:].strip():
+        statements.append((list(conditions), body[position:].strip()))
+    return statements
+
+# A trigger statement made to run only when its conditions hold: SQLite
+# triggers have no IF, so the condition joins the statement's WHERE, and
+# INSERT ... VALUES becomes INSERT ... SELECT to have one
+def conditional(statement, conditions):
+    statement = dialect(statement)
+    if not conditions:
+        return statement
+    condition = " AND ".join(f"({dialect(condition)})" for condition in conditions)
+    insert = re.match(r"(INSERT\s+(?:OR\s+IGNORE\s+)?INTO\s+\w+\s*\([^)]*\))\s*VALUES\s*", statement, re.I)
+    if insert:
+        end = closing_paren(statement, insert.end())
+        return (f"{insert.group(1)} SELECT {statement[insert.end() + 1:end]} WHERE {condition}"
+                f"{statement[end + 1:]}")
+    where = re.search(r"\bWHERE\b", statement, re.I)
+    if where:
+        return f"{statement[:where.end()]} ({statement[where.end():].strip()}) AND {condition}"
+    return f"{statement} WHERE {condition}"
+
+# A MySQL statement as SQLite statements, the first taking the parameters
+def translate(sql):
+    sql = sql.strip().rstrip(";")
+    table = re.match(r"CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?(\w+)\s*\((.*)\)$", sql, re.I | re.S)
+    if table:
+        if_not_exists, name, body = table.groups()
+        if_not_exists = "IF NOT EXISTS " if if_not_exists else ""
+        definitions, after = [], []
+        for item in split_top_level(body):
+            key = KEY_CLAUSE.match(item)
+            if key:
+                after += index(name, key, if_not_exists)
+            else:
+                definitions.append(column(item))
+        return [f"CREATE TABLE {if_not_exists}{name} ({', '.join(definitions)})"] + after
+    trigger = TRIGGER.match(sql)
+    if trigger:
+        if_not_exists, name, timing, event, table, body = trigger.groups()
+        block = re.match(r"BEGIN\b(.*)\bEND$", body.strip(), re.I | re.S)
+        statements = trigger_statements(block.group(1) if block else body)
+        return [f"CREATE TRIGGER {'IF NOT EXISTS ' if if_not_exists else ''}{name} {timing} {event} ON {table} "
+                f"FOR EACH ROW BEGIN " + " ".join(conditional(statement, conditions) + ";"
+                                                  for conditions, statement in statements) + " END"]
+    alter = re.match(r"ALTER\s+TABLE\s+(\w+)\s+(.*)$", sql, re.I | re.S)
+    if alter:
+        name, clauses = alter.groups()
+        statements = []
+        for clause in split_top_level(clauses):
+            key = re.match(r"ADD\s+(.*)$", clause, re.I | re.S)
+            key = key and KEY_CLAUSE.match(key.group(1))
+            add = re.match(r"ADD\s+(?:COLUMN\s+)?(.*)$", clause, re.I | re.S)
+            drop = re.match(r"DROP\s+(COLUMN|INDEX|KEY)\s+(\w+)$", clause, re.I)
+            if key:
+                statements += index(name, key)
+            elif drop and drop.group(1).upper() == "COLUMN":
+                statements.append(f"ALTER TABLE {name} DROP COLUMN {drop.group(2)}")
+            elif drop:
+                statements += [f"DROP INDEX IF EXISTS {drop.group(2)}",
+                               f"DELETE FROM standin_fulltext WHERE name = '{drop.group(2)}'"]
+            elif add:
+                statements.append(f"ALTER TABLE {name} ADD COLUMN {column(add.group(1))}")
+            else:
+                raise NotSupportedError(f"ALTER TABLE clause {clause!r}")
+        return statements
+    join = re.match(r"UPDATE\s+(\w+)\s+JOIN\s+(\w+)\s+ON\s+(.*?)\s+SET\s+(.*)$", sql, re.I | re.S)
+    if join:
+        target, other, on, assignments = join.groups()
+        assignments = re.sub(rf"\b{target}\.(\w+)\s*=", r"\1 =", assignments)
+        return [f"UPDATE {target} SET {assignments} FROM {other} WHERE {on}"]
+    return [dialect(sql)]
+
+# Maps a sqlite3 error to the connector's
+def mysql_error(err):
+    if isinstance(err, sqlite3.IntegrityError):
+        return IntegrityError(str(err))
+    if isinstance(err, sqlite3.OperationalError) and "syntax error" in str(err):
+        return ProgrammingError(str(err))
+    return DatabaseError(str(err))
+
+class StandInCursor:
+    arraysize = 1
+
+    def __init__(self, connection, prepared):
+        self._connection = connection
+        self._prepared = prepared
+        self._session = connection.session
+        self._rows = []
+        self._position = 0
+        self.unread = False
+        self.rowcount = -1
+        self.lastrowid = None
+        self.description = None
+
+    # Prepared cursors take ? or %s; a plain cursor only interpolates %s,
+    # and every parameter must have one
+    def _operation(self, operation, params):
+        if self._prepared:
+            operation = operation.replace("%s", "?")
+            if self._session != self._connection.session:
+                raise ProgrammingError("Statement not prepared on this session")
+        elif params and operation.count("%s") != len(params):
+            raise ProgrammingError("Not all parameters were used in the SQL statement")
+        return operation.replace("%s", "?")
+
+    def execute(self, operation, params=()):
+        self._connection.check_unread(self)
+        params = tuple(params)
+        operation = self._operation(operation, params)
+        self._rows, self._position, self.unread = [], 0, False
+        self.description = None
+        variable = re.match(r"SET\s+@(\w+)\s*=\s*(.*)$", operation.strip(), re.I | re.S)
+        try:
+            if variable:
+                value = self._connection.db.execute(f"SELECT {dialect(variable.group(2))}", params).fetchone()[0]
+                self._connection.variables[variable.group(1)] = value
+                self.rowcount = 0
+                return
+            statements = self._connection.translate(operation)
+            cursor = self._connection.db.execute(statements[0], params)
+            self.description = cursor.description
+            self._rows = cursor.fetchall() if cursor.description else []
+            self.rowcount = len(self._rows) if cursor.description else cursor.rowcount
+            self.lastrowid = cursor.lastrowid
+            for statement in statements[1:]:
+                self._connection.db.execute(statement)
+        except sqlite3.Error as err:
+            raise mysql_error(err) from err
+        self.unread = self.description is not None
+
+    def executemany(self, operation, seq_of_params):
+        self._connection.check_unread(self)
+        seq_of_params = [tuple(params) for params in seq_of_params]
+        operation = self._operation(operation, seq_of_params[0] if seq_of_params else ())
+        statements = self._connection.translate(operation)
+        try:
+            self.rowcount = self._connection.db.executemany(statements[0], seq_of_params).rowcount
+        except sqlite3.Error as err:
+            raise mysql_error(err) from err
+
+    def fetchall(self):
+        rows = self._rows[self._position:]
+        self._position = len(self._rows)
+        self.unread = False
+        return rows
+
+    def fetchmany(self, size=None):
+        rows = self._rows[self._position:self._position + (size or self.arraysize)]
+        self._position += len(rows)
+        self.unread = self.unread and bool(rows)
+        return rows
+
+    def fetchone(self):
+        rows = self.fetchmany(1)
+        return rows[0] if rows else None
+
+    def close(self):
+        self._rows = []
+        self.unread = False
+
+class StandInConnection:
+    def __init__(self, database, autocommit):
+        if not autocommit:
+            raise NotSupportedError("the stand-in only runs with autocommit=True")
+        self.connection_id = next(_connection_ids)
+        # Bumped when the pool resets the session, dropping what it prepared
+        self.session = 0
+        self.variables = {}
+        self._cursors = weakref.WeakSet()
+        self._translated = {}
+        self.db = sqlite3.connect(database, isolation_level=None, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.create_function("mysql_left", 2, lambda text, length: None if text is None else str(text)[:length])
+        self.db.create_function("CONCAT", -1, concat)
+        self.db.create_function("GET_LOCK", 2, get_lock)
+        self.db.create_function("RELEASE_LOCK", 1, release_lock)
+        self.db.create_function("session_var", 1, self.variables.get)
+        self.db.create_function("match_score", 2, match_score)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS standin_fulltext (
+                name TEXT PRIMARY KEY, table_name TEXT NOT NULL, columns TEXT NOT NULL
+            )
+        """)
+
+    @property
+    def in_transaction(self):
+        return self.db.in_transaction
+
+    def translate(self, operation):
+        statements = self._translated.get(operation)
+        if statements is None:
+            statements = translate(operation)
+            for name in (match.group(1) for match in MATCH.finditer(operation)):
+                if not self.db.execute("SELECT 1 FROM standin_fulltext WHERE columns = ?", (name,)).fetchone():
+                    raise ProgrammingError("Can't find FULLTEXT index matching the column list")
+            self._translated[operation] = statements
+        return statements
+
+    # A plain cursor's unread result must be read before the connection runs
+    # anything else; a prepared cursor's is dropped
+    def check_unread(self, cursor):
+        for other in self._cursors:
+            if other.unread:
+                if not other._prepared:
+                    raise InternalError("Unread result found")
+                other.close()
+
+    def cursor(self, buffered=None, prepared=None):
+        cursor = StandInCursor(self, bool(prepared))
+        self._cursors.add(cursor)
+        return cursor
+
+    def start_transaction(self):
+        if self.db.in_transaction:
+            raise ProgrammingError("Transaction already in progress")
+        self.db.execute("BEGIN IMMEDIATE")
+
+    def commit(self):
+        if self.db.in_transaction:
+            self.db.execute("COMMIT")
+
+    def rollback(self):
+        if self.db.in_transaction:
+            self.db.execute("ROLLBACK")
+
+    def reset_session(self):
+        self.rollback()
+        self.variables.clear()
+        self.session += 1
+        self._cursors = weakref.WeakSet()
+
+# What the pool hands out; close() gives the connection back
+class PooledStandInConnection:
+    def __init__(self, pool, cnx):
+        self._pool = pool
+        self._cnx = cnx
+
+    def __getattr__(self, name):
+        if self._cnx is None:
+            raise InterfaceError("connection is closed")
+        return getattr(self._cnx, name)
+
+    def close(self):
+        if self._cnx is not None:
+            self._pool.add_connection(self._cnx)
+            self._cnx = None
+
+class MySQLConnectionPool:
+    def __init__(self, pool_name=None, pool_size=5, pool_reset_session=True, database=None, autocommit=False,
+                 client_flags=(), **config):
+        if constants.ClientFlag.FOUND_ROWS not in client_flags:
+            raise NotSupportedError("the stand-in counts rows matched; connect with ClientFlag.FOUND_ROWS")
+        self.pool_name = pool_name
+        self.pool_size = pool_size
+        self._reset_session = pool_reset_session
+        self._lock = threading.Lock()
+        self._idle = [StandInConnection(database, autocommit) for _ in range(pool_size)]
+
+    def get_connection(self):
+        with self._lock:
+            if not self._idle:
+                raise PoolError("Failed getting connection; pool exhausted")
+            return PooledStandInConnection(self, self._idle.pop())
+
+    def add_connection(self, cnx):
+        if self._reset_session:
+            cnx.reset_session()
+        with self._lock:
+            self._idle.append(cnx)
+
+pooling = types.SimpleNamespace(MySQLConnectionPool=MySQLConnectionPool)
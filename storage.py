@@ -0,0 +1,2694 @@
+# Storage for the expense tracker: connection pools, the SQLite and MySQL
+# schemas and their migrations, the repositories every page query goes
+# through, the write queue, sharding, archives and the analytics snapshot.
+# Nothing here uses Streamlit; app.py builds the process-wide pools and
+# repository from it.
+import sqlite3
+import os
+import pathlib
+import re
+import shutil
+import threading
+import time
+import json
+import queue
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import timedelta
+
+DB_PATH = os.environ.get('EXPENSE_TRACKER_DB', 'expense_tracker.db')
+# Number of SQLite files user data is spread over; see ShardedRepository.
+# Changing it on an existing database takes `manage.py reshard`.
+SHARD_COUNT = int(os.environ.get('EXPENSE_TRACKER_SHARDS', '1'))
+POOL_SIZE = 8
+DB_CACHE_KIB = 16000
+
+# Pragmas applied to every new connection. WAL lets readers and the writer
+# work concurrently; NORMAL sync is durable enough in WAL mode.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{DB_CACHE_KIB}",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+TRACE_STATEMENTS = os.environ.get('EXPENSE_TRACKER_TRACE') == '1'
+
+# 'sqlite' keeps everything in DB_PATH (and its shards, see SHARD_COUNT);
+# 'mysql' lets several app nodes share
+# one MySQL 8.0.29+ (or MariaDB) database
+BACKEND = os.environ.get('EXPENSE_TRACKER_BACKEND', 'sqlite')
+MYSQL_CONFIG = {
+    "host": os.environ.get('EXPENSE_TRACKER_MYSQL_HOST', 'localhost'),
+    "port": int(os.environ.get('EXPENSE_TRACKER_MYSQL_PORT', '3306')),
+    "user": os.environ.get('EXPENSE_TRACKER_MYSQL_USER', 'expense_tracker'),
+    "password": os.environ.get('EXPENSE_TRACKER_MYSQL_PASSWORD', ''),
+    "database": os.environ.get('EXPENSE_TRACKER_MYSQL_DATABASE', 'expense_tracker'),
+}
+# Group commit of page writes: at most WRITE_BATCH_MAX requests per
+# transaction. A batch is whatever queued up while the previous one ran,
+# plus anything arriving within WRITE_MAX_DELAY seconds; waiting longer than
+# 0 cost more latency than it saved in benchmarks/writes.py.
+WRITE_BATCH_MAX = 256
+WRITE_MAX_DELAY = 0
+
+# Prepared statements kept open per MySQL connection
+MYSQL_STATEMENT_CACHE = 64
+
+# Expenses dated before a cutoff can be moved out of the expenses table into
+# one archive file per year (see archive_expenses()). `manage.py archive`
+# keeps this many months hot unless given a cutoff. A connection keeps at
+# most ARCHIVES_ATTACHED archives attached, SQLite's default limit.
+ARCHIVE_KEEP_MONTHS = 12
+ARCHIVE_BATCH_ROWS = 20000
+ARCHIVES_ATTACHED = 10
+
+# Rows per transaction of a bulk import, or of moving a user between shards
+IMPORT_BATCH_ROWS = 50000
+# Page cache for the importing connection, in KiB; index maintenance
+# dominates bulk inserts and mostly needs index pages kept in memory
+IMPORT_CACHE_KIB = 262144
+
+# Query and page timings for the debug panel, shared by the whole process.
+# Queries are keyed by their SQL text, which is always parameterized.
+class Metrics:
+    def __init__(self):
+        self.queries = {}
+        self.pages = {}
+        self._lock = threading.Lock()
+
+    def record_query(self, sql, seconds, rows=0, statements=0, calls=1):
+        key = " ".join(sql.split())
+        with self._lock:
+            stats = self.queries.setdefault(key, {"calls": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                  "rows": 0, "statements": 0})
+            stats["calls"] += calls
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["rows"] += rows
+            stats["statements"] += statements
+
+    def record_page(self, page, seconds):
+        with self._lock:
+            stats = self.pages.setdefault(page, {"renders": 0, "seconds": 0.0, "max_seconds": 0.0})
+            stats["renders"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return ({sql: dict(stats) for sql, stats in self.queries.items()},
+                    {page: dict(stats) for page, stats in self.pages.items()})
+
+# Counts every statement SQLite starts, through the trace callback. That
+# includes each statement run inside a trigger, so a single INSERT shows the
+# rollup work it causes. The callback costs a Python call per statement
+# (about a quarter of bulk import throughput), so it is opt-in.
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = 0
+        # Archive schemas attached, least recently used first
+        self.attached = OrderedDict()
+        if TRACE_STATEMENTS:
+            self.set_trace_callback(self._trace)
+
+    def _trace(self, statement):
+        self.statements += 1
+
+# Times execute plus the fetches that follow it and reports both to Metrics
+class InstrumentedCursor:
+    def __init__(self, cursor, conn, metrics):
+        self._cursor = cursor
+        self._conn = conn
+        self._metrics = metrics
+        self._sql = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def _run(self, method, sql, params):
+        statements = self._conn.statements
+        started = time.perf_counter()
+        method(sql, params)
+        self._sql = sql
+        self._metrics.record_query(sql, time.perf_counter() - started, max(self._cursor.rowcount, 0),
+                                   self._conn.statements - statements)
+        return self
+
+    def execute(self, sql, params=()):
+        return self._run(self._cursor.execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self._run(self._cursor.executemany, sql, seq_of_params)
+
+    def _fetch(self, method, *args):
+        started = time.perf_counter()
+        result = method(*args)
+        rows = len(result) if isinstance(result, list) else int(result is not None)
+        if self._sql is not None:
+            self._metrics.record_query(self._sql, time.perf_counter() - started, rows, calls=0)
+        return result
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetch(self._cursor.fetchmany, size or self._cursor.arraysize)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+# Connection returned by ConnectionPool.acquire(); close() hands it back to the pool
+class PooledConnection:
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self):
+        return InstrumentedCursor(self._conn.cursor(), self._conn, self._pool.metrics)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self._conn.commit()
+        self.close()
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._conn)
+            self._conn = None
+
+class ConnectionPool:
+    def __init__(self, path, metrics, size=POOL_SIZE, read_only=False):
+        self.path = path
+        self.metrics = metrics
+        self.size = size
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self.read_only:
+            conn = sqlite3.connect(pathlib.Path(self.path).absolute().as_uri() + "?mode=ro", uri=True,
+                                   check_same_thread=False, factory=TracedConnection)
+        else:
+            conn = sqlite3.connect(self.path, check_same_thread=False, factory=TracedConnection)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                self.hits += 1
+                return PooledConnection(self, self._idle.pop())
+            self.misses += 1
+        return PooledConnection(self, self._open())
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "idle": len(self._idle)}
+
+# Shard 0 is DB_PATH itself, so an unsharded database is a one-shard one;
+# shard n is DB_PATH with .shard<n> before its extension
+def shard_path(index, path=DB_PATH):
+    if index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+# Jump consistent hash (Lamping and Veach): the bucket of an integer key
+# among `buckets`, stable across processes and Python versions. Going from
+# n to n + 1 buckets only moves the keys that land on the new one.
+def jump_hash(key, buckets):
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) % 2**64
+        jump = int((bucket + 1) * (2**31 / ((key >> 33) + 1)))
+    return bucket
+
+def user_shard(user_id, shards=SHARD_COUNT):
+    return jump_hash(int(user_id), shards)
+
+# The archive of one year of expenses of the database at `path`, named like
+# shards: expense_tracker.archive2023.db
+def archive_path(year, path=DB_PATH):
+    root, ext = os.path.splitext(path)
+    return f"{root}.archive{year}{ext}"
+
+def archive_schema(year):
+    return f"archive_{year}"
+
+# Attaches to db the archives of the database at `path` for `years` that it
+# does not have yet, detaching the least recently used others to stay within
+# ARCHIVES_ATTACHED. db must not be in a transaction. Returns their schema
+# names.
+def attach_archives(db, path, years):
+    attached = db.attached
+    schemas = [archive_schema(year) for year in years]
+    for year, schema in zip(years, schemas):
+        if schema in attached:
+            attached.move_to_end(schema)
+            continue
+        while len(attached) >= ARCHIVES_ATTACHED:
+            stale = next(name for name in attached if name not in schemas)
+            db.execute(f"DETACH DATABASE {stale}")
+            del attached[stale]
+        db.execute(f"ATTACH DATABASE ? AS {schema}", (archive_path(year, path),))
+        attached[schema] = True
+    return schemas
+
+# Rollup tables holding per-user and per-(user, category) totals. Triggers
+# keep them current inside the same transaction as every write to income
+# and expenses, so balance and chart reads never aggregate raw rows.
+ROLLUP_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS user_totals (
+        userid INTEGER PRIMARY KEY,
+        total_income REAL NOT NULL DEFAULT 0,
+        total_expenses REAL NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS category_totals (
+        userid INTEGER NOT NULL,
+        category VARCHAR(255) NOT NULL,
+        total REAL NOT NULL DEFAULT 0,
+        expense_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (userid, category)
+    ) WITHOUT ROWID
+    """,
+]
+
+ROLLUP_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_income_insert AFTER INSERT ON income BEGIN
+        INSERT INTO user_totals (userid, total_income) VALUES (NEW.user_id, COALESCE(NEW.income_amount, 0))
+        ON CONFLICT (userid) DO UPDATE SET total_income = total_income + excluded.total_income;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_income_delete AFTER DELETE ON income BEGIN
+        UPDATE user_totals SET total_income = total_income - COALESCE(OLD.income_amount, 0)
+        WHERE userid = OLD.user_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_income_update AFTER UPDATE OF user_id, income_amount ON income BEGIN
+        UPDATE user_totals SET total_income = total_income - COALESCE(OLD.income_amount, 0)
+        WHERE userid = OLD.user_id;
+        INSERT INTO user_totals (userid, total_income) VALUES (NEW.user_id, COALESCE(NEW.income_amount, 0))
+        ON CONFLICT (userid) DO UPDATE SET total_income = total_income + excluded.total_income;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_insert AFTER INSERT ON expenses BEGIN
+        INSERT INTO user_totals (userid, total_expenses) VALUES (NEW.userid, COALESCE(NEW.amount, 0))
+        ON CONFLICT (userid) DO UPDATE SET total_expenses = total_expenses + excluded.total_expenses;
+        INSERT INTO category_totals (userid, category, total, expense_count)
+        VALUES (NEW.userid, NEW.category, COALESCE(NEW.amount, 0), 1)
+        ON CONFLICT (userid, category) DO UPDATE SET
+            total = total + excluded.total,
+            expense_count = expense_count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_delete AFTER DELETE ON expenses BEGIN
+        UPDATE user_totals SET total_expenses = total_expenses - COALESCE(OLD.amount, 0)
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category = OLD.category;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category = OLD.category AND expense_count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_update AFTER UPDATE OF userid, category, amount ON expenses BEGIN
+        UPDATE user_totals SET total_expenses = total_expenses - COALESCE(OLD.amount, 0)
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category = OLD.category;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category = OLD.category AND expense_count <= 0;
+        INSERT INTO user_totals (userid, total_expenses) VALUES (NEW.userid, COALESCE(NEW.amount, 0))
+        ON CONFLICT (userid) DO UPDATE SET total_expenses = total_expenses + excluded.total_expenses;
+        INSERT INTO category_totals (userid, category, total, expense_count)
+        VALUES (NEW.userid, NEW.category, COALESCE(NEW.amount, 0), 1)
+        ON CONFLICT (userid, category) DO UPDATE SET
+            total = total + excluded.total,
+            expense_count = expense_count + 1;
+    END
+    """,
+]
+
+# Bumped on every expense write so caches keyed by it go stale. Each trigger
+# upserts on its own, independent of the order SQLite fires triggers in.
+DATA_VERSION_TRIGGERS = [
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_version_insert AFTER INSERT ON expenses BEGIN
+        INSERT INTO user_totals (userid, data_version) VALUES (NEW.userid, 1)
+        ON CONFLICT (userid) DO UPDATE SET data_version = data_version + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_version_delete AFTER DELETE ON expenses BEGIN
+        UPDATE user_totals SET data_version = data_version + 1 WHERE userid = OLD.userid;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_version_update AFTER UPDATE ON expenses BEGIN
+        UPDATE user_totals SET data_version = data_version + 1 WHERE userid = OLD.userid;
+        INSERT INTO user_totals (userid, data_version) VALUES (NEW.userid, 1)
+        ON CONFLICT (userid) DO UPDATE SET data_version = data_version + 1;
+    END
+    """,
+]
+
+# Bulk imports insert a row into bulk_load inside their write transaction and
+# apply the rollups once per batch, so the per-row insert triggers stand
+# aside while it exists. No other connection can see the row: it is deleted
+# before the transaction commits.
+BULK_LOAD_TRIGGERS = [
+    "CREATE TABLE IF NOT EXISTS bulk_load (userid INTEGER PRIMARY KEY)",
+    "DROP TRIGGER IF EXISTS trg_expenses_insert",
+    """
+    CREATE TRIGGER trg_expenses_insert AFTER INSERT ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        INSERT INTO user_totals (userid, total_expenses) VALUES (NEW.userid, COALESCE(NEW.amount, 0))
+        ON CONFLICT (userid) DO UPDATE SET total_expenses = total_expenses + excluded.total_expenses;
+        INSERT INTO category_totals (userid, category, total, expense_count)
+        VALUES (NEW.userid, NEW.category, COALESCE(NEW.amount, 0), 1)
+        ON CONFLICT (userid, category) DO UPDATE SET
+            total = total + excluded.total,
+            expense_count = expense_count + 1;
+    END
+    """,
+    "DROP TRIGGER IF EXISTS trg_expenses_version_insert",
+    """
+    CREATE TRIGGER trg_expenses_version_insert AFTER INSERT ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        INSERT INTO user_totals (userid, data_version) VALUES (NEW.userid, 1)
+        ON CONFLICT (userid) DO UPDATE SET data_version = data_version + 1;
+    END
+    """,
+]
+
+# Batch edits from the table view use the same marker: the per-row update
+# and delete triggers stand aside, and the batch moves the totals of the
+# rows it touched and bumps data_version once
+BULK_EDIT_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS trg_expenses_delete",
+    """
+    CREATE TRIGGER trg_expenses_delete AFTER DELETE ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        UPDATE user_totals SET total_expenses = total_expenses - COALESCE(OLD.amount, 0)
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category = OLD.category;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category = OLD.category AND expense_count <= 0;
+    END
+    """,
+    "DROP TRIGGER IF EXISTS trg_expenses_update",
+    """
+    CREATE TRIGGER trg_expenses_update AFTER UPDATE OF userid, category, amount ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        UPDATE user_totals SET total_expenses = total_expenses - COALESCE(OLD.amount, 0)
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category = OLD.category;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category = OLD.category AND expense_count <= 0;
+        INSERT INTO user_totals (userid, total_expenses) VALUES (NEW.userid, COALESCE(NEW.amount, 0))
+        ON CONFLICT (userid) DO UPDATE SET total_expenses = total_expenses + excluded.total_expenses;
+        INSERT INTO category_totals (userid, category, total, expense_count)
+        VALUES (NEW.userid, NEW.category, COALESCE(NEW.amount, 0), 1)
+        ON CONFLICT (userid, category) DO UPDATE SET
+            total = total + excluded.total,
+            expense_count = expense_count + 1;
+    END
+    """,
+    "DROP TRIGGER IF EXISTS trg_expenses_version_delete",
+    """
+    CREATE TRIGGER trg_expenses_version_delete AFTER DELETE ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        UPDATE user_totals SET data_version = data_version + 1 WHERE userid = OLD.userid;
+    END
+    """,
+    "DROP TRIGGER IF EXISTS trg_expenses_version_update",
+    """
+    CREATE TRIGGER trg_expenses_version_update AFTER UPDATE ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        UPDATE user_totals SET data_version = data_version + 1 WHERE userid = OLD.userid;
+        INSERT INTO user_totals (userid, data_version) VALUES (NEW.userid, 1)
+        ON CONFLICT (userid) DO UPDATE SET data_version = data_version + 1;
+    END
+    """,
+]
+
+# Spending is also bucketed by day and by month, per category, so trend views
+# read a few hundred bucket rows instead of the user's raw history. A bucket
+# is named by the first `length` characters of the expense date; uncategorized
+# spending goes in category 0, which no category ever has.
+# (table, bucket column, prefix length)
+TIME_BUCKETS = [
+    ("daily_totals", "day", 10),
+    ("monthly_totals", "month", 7),
+]
+
+# Recomputes the rollups from the raw tables
+ROLLUP_SOURCE_QUERIES = {
+    "user_totals": """
+        SELECT userid, SUM(income), SUM(expenses) FROM (
+            SELECT user_id AS userid, COALESCE(income_amount, 0) AS income, 0 AS expenses FROM income
+            UNION ALL
+            SELECT userid, 0, COALESCE(amount, 0) FROM expenses
+        )
+        GROUP BY userid
+    """,
+    "category_totals": """
+        SELECT userid, category_id, SUM(COALESCE(amount, 0)), COUNT(*)
+        FROM expenses
+        WHERE category_id IS NOT NULL
+        GROUP BY userid, category_id
+    """,
+}
+for table, bucket, length in TIME_BUCKETS:
+    ROLLUP_SOURCE_QUERIES[table] = f"""
+        SELECT userid, substr(date, 1, {length}), COALESCE(category_id, 0), SUM(COALESCE(amount, 0)), COUNT(*)
+        FROM expenses
+        GROUP BY 1, 2, 3
+    """
+
+# Adds signed (userid, bucket, category_id, total, expense_count) deltas to
+# a time bucket table
+BUCKET_UPSERT = """
+    INSERT INTO {table} (userid, {bucket}, category_id, total, expense_count) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (userid, {bucket}, category_id) DO UPDATE SET
+        total = total + excluded.total,
+        expense_count = expense_count + excluded.expense_count
+"""
+
+# Migration 3's backfill, against the schema as it was then
+ROLLUP_BACKFILL = [
+    "DELETE FROM user_totals",
+    "INSERT INTO user_totals (userid, total_income, total_expenses) " + ROLLUP_SOURCE_QUERIES["user_totals"],
+    "DELETE FROM category_totals",
+    """
+    INSERT INTO category_totals (userid, category, total, expense_count)
+    SELECT userid, category, SUM(COALESCE(amount, 0)), COUNT(*)
+    FROM expenses
+    WHERE category IS NOT NULL
+    GROUP BY userid, category
+    """,
+]
+
+# Categories become a per-user dictionary: expenses and category_totals
+# hold a small integer category_id instead of repeating the name. The
+# expense rollup triggers are recreated against category_id, keeping the
+# bulk_load guard.
+CATEGORY_IDS = [
+    """
+    CREATE TABLE categories (
+        category_id INTEGER PRIMARY KEY,
+        userid INTEGER NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        UNIQUE (userid, name)
+    )
+    """,
+    """
+    INSERT INTO categories (userid, name)
+    SELECT DISTINCT userid, category FROM expenses WHERE category IS NOT NULL ORDER BY userid, category
+    """,
+    "ALTER TABLE expenses ADD COLUMN category_id INTEGER REFERENCES categories (category_id)",
+    """
+    UPDATE expenses SET category_id = (
+        SELECT category_id FROM categories
+        WHERE categories.userid = expenses.userid AND categories.name = expenses.category
+    )
+    WHERE category IS NOT NULL
+    """,
+    "DROP TRIGGER trg_expenses_insert",
+    "DROP TRIGGER trg_expenses_update",
+    "DROP TRIGGER trg_expenses_delete",
+    "DROP INDEX idx_expenses_user_category",
+    "ALTER TABLE expenses DROP COLUMN category",
+    "CREATE INDEX idx_expenses_user_category ON expenses (userid, category_id, amount)",
+    "DROP TABLE category_totals",
+    """
+    CREATE TABLE category_totals (
+        userid INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        total REAL NOT NULL DEFAULT 0,
+        expense_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (userid, category_id)
+    ) WITHOUT ROWID
+    """,
+    "INSERT INTO category_totals (userid, category_id, total, expense_count) "
+    + ROLLUP_SOURCE_QUERIES["category_totals"],
+    """
+    CREATE TRIGGER trg_expenses_insert AFTER INSERT ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        INSERT INTO user_totals (userid, total_expenses) VALUES (NEW.userid, COALESCE(NEW.amount, 0))
+        ON CONFLICT (userid) DO UPDATE SET total_expenses = total_expenses + excluded.total_expenses;
+        INSERT INTO category_totals (userid, category_id, total, expense_count)
+        SELECT NEW.userid, NEW.category_id, COALESCE(NEW.amount, 0), 1 WHERE NEW.category_id IS NOT NULL
+        ON CONFLICT (userid, category_id) DO UPDATE SET
+            total = total + excluded.total,
+            expense_count = expense_count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER trg_expenses_delete AFTER DELETE ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        UPDATE user_totals SET total_expenses = total_expenses - COALESCE(OLD.amount, 0)
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category_id = OLD.category_id;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category_id = OLD.category_id AND expense_count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER trg_expenses_update AFTER UPDATE OF userid, category_id, amount ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        UPDATE user_totals SET total_expenses = total_expenses - COALESCE(OLD.amount, 0)
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category_id = OLD.category_id;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category_id = OLD.category_id AND expense_count <= 0;
+        INSERT INTO user_totals (userid, total_expenses) VALUES (NEW.userid, COALESCE(NEW.amount, 0))
+        ON CONFLICT (userid) DO UPDATE SET total_expenses = total_expenses + excluded.total_expenses;
+        INSERT INTO category_totals (userid, category_id, total, expense_count)
+        SELECT NEW.userid, NEW.category_id, COALESCE(NEW.amount, 0), 1 WHERE NEW.category_id IS NOT NULL
+        ON CONFLICT (userid, category_id) DO UPDATE SET
+            total = total + excluded.total,
+            expense_count = expense_count + 1;
+    END
+    """,
+]
+
+# Creates the time bucket tables and their triggers, which stand aside for
+# bulk loads and batch edits like the others
+def time_bucket_migration():
+    statements = []
+    for table, bucket, length in TIME_BUCKETS:
+        new_key = f"NEW.userid, substr(NEW.date, 1, {length}), COALESCE(NEW.category_id, 0)"
+        old_match = (f"userid = OLD.userid AND {bucket} = substr(OLD.date, 1, {length}) "
+                     f"AND category_id = COALESCE(OLD.category_id, 0)")
+        add_new = f"""
+            INSERT INTO {table} (userid, {bucket}, category_id, total, expense_count)
+            VALUES ({new_key}, COALESCE(NEW.amount, 0), 1)
+            ON CONFLICT (userid, {bucket}, category_id) DO UPDATE SET
+                total = total + excluded.total,
+                expense_count = expense_count + 1;
+        """
+        remove_old = f"""
+            UPDATE {table} SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+            WHERE {old_match};
+            DELETE FROM {table} WHERE {old_match} AND expense_count <= 0;
+        """
+        statements += [
+            f"""
+            CREATE TABLE {table} (
+                userid INTEGER NOT NULL,
+                {bucket} TEXT NOT NULL,
+                category_id INTEGER NOT NULL,
+                total REAL NOT NULL DEFAULT 0,
+                expense_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (userid, {bucket}, category_id)
+            ) WITHOUT ROWID
+            """,
+            f"INSERT INTO {table} (userid, {bucket}, category_id, total, expense_count) "
+            + ROLLUP_SOURCE_QUERIES[table],
+            f"""
+            CREATE TRIGGER trg_{table}_insert AFTER INSERT ON expenses
+            WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN {add_new} END
+            """,
+            f"""
+            CREATE TRIGGER trg_{table}_delete AFTER DELETE ON expenses
+            WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN {remove_old} END
+            """,
+            f"""
+            CREATE TRIGGER trg_{table}_update AFTER UPDATE OF userid, category_id, amount, date ON expenses
+            WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN {remove_old} {add_new} END
+            """,
+        ]
+    return statements
+
+# Full-text index over descriptions. It is contentless, keeping no copy of
+# the text, and indexes each row's owner as a token of its own column, so a
+# search is narrowed to the user's rows inside the index rather than by
+# joining every match in the table back to expenses. Bulk loads index their
+# rows with one SEARCH_INDEX_AFTER statement per batch, which is several
+# times faster than the insert trigger firing per row; edits of any size go
+# through the triggers. Prefixes of up to six characters are indexed, so the
+# start of a word reads one list of rows instead of merging the lists of
+# every word it starts.
+SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE expenses_fts USING fts5(owner, words, content='', prefix='2 3 4 5 6')",
+    "INSERT INTO expenses_fts (rowid, owner, words) SELECT expid, 'u' || userid, description FROM expenses",
+    """
+    CREATE TRIGGER trg_expenses_fts_insert AFTER INSERT ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        INSERT INTO expenses_fts (rowid, owner, words) VALUES (NEW.expid, 'u' || NEW.userid, NEW.description);
+    END
+    """,
+    # A contentless index can only drop a row given the values it was
+    # indexed with
+    """
+    CREATE TRIGGER trg_expenses_fts_delete AFTER DELETE ON expenses BEGIN
+        INSERT INTO expenses_fts (expenses_fts, rowid, owner, words)
+        VALUES ('delete', OLD.expid, 'u' || OLD.userid, OLD.description);
+    END
+    """,
+    """
+    CREATE TRIGGER trg_expenses_fts_update AFTER UPDATE OF userid, description ON expenses BEGIN
+        INSERT INTO expenses_fts (expenses_fts, rowid, owner, words)
+        VALUES ('delete', OLD.expid, 'u' || OLD.userid, OLD.description);
+        INSERT INTO expenses_fts (rowid, owner, words) VALUES (NEW.expid, 'u' || NEW.userid, NEW.description);
+    END
+    """,
+]
+
+SEARCH_INDEX_AFTER = """
+    INSERT INTO expenses_fts (rowid, owner, words)
+    SELECT expid, 'u' || userid, description FROM expenses WHERE expid > ?
+"""
+
+# edit_version counts the writes that change or remove existing rows. While
+# it stands still the user's rows have only been added to, and since expids
+# commit in order, a copy of them is brought up to date by reading the rows
+# past the highest expid it holds. Batch edits bump it themselves.
+EDIT_VERSION = [
+    "ALTER TABLE user_totals ADD COLUMN edit_version INTEGER NOT NULL DEFAULT 0",
+    "DROP TRIGGER IF EXISTS trg_expenses_version_delete",
+    """
+    CREATE TRIGGER trg_expenses_version_delete AFTER DELETE ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        UPDATE user_totals SET data_version = data_version + 1, edit_version = edit_version + 1
+        WHERE userid = OLD.userid;
+    END
+    """,
+    "DROP TRIGGER IF EXISTS trg_expenses_version_update",
+    """
+    CREATE TRIGGER trg_expenses_version_update AFTER UPDATE ON expenses
+    WHEN NOT EXISTS (SELECT 1 FROM bulk_load) BEGIN
+        UPDATE user_totals SET data_version = data_version + 1, edit_version = edit_version + 1
+        WHERE userid = OLD.userid;
+        INSERT INTO user_totals (userid, data_version, edit_version) VALUES (NEW.userid, 1, 1)
+        ON CONFLICT (userid) DO UPDATE SET data_version = data_version + 1, edit_version = edit_version + 1;
+    END
+    """,
+]
+
+# The number of shards user data is laid out for. Only shard 0's row is
+# read; see app.get_shard_pools().
+SHARD_LAYOUT = [
+    "CREATE TABLE shard_layout (shards INTEGER NOT NULL)",
+    "INSERT INTO shard_layout (shards) VALUES (1)",
+]
+
+# Archived expenses leave the expenses table with the rollup triggers
+# suspended, so the rollups still count them. archives records each yearly
+# archive file and the date its rows all precede; archived_days sums the
+# archived rows per day and category (0 when uncategorized), which is
+# everything the rollups are rebuilt from once the rows are gone.
+ARCHIVES = [
+    "CREATE TABLE archives (year INTEGER PRIMARY KEY, cutoff TEXT NOT NULL)",
+    """
+    CREATE TABLE archived_days (
+        userid INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        category_id INTEGER NOT NULL,
+        total REAL NOT NULL DEFAULT 0,
+        expense_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (userid, day, category_id)
+    ) WITHOUT ROWID
+    """,
+]
+
+# Passwords were stored as typed before migration 15. It marks each one as
+# plaintext; check_password() still accepts them, and the login replaces
+# them with a hash.
+PASSWORD_HASHES = [
+    "UPDATE users SET password = 'plain$' || password WHERE password IS NOT NULL",
+]
+
+# The schema of a yearly archive file: expenses as they were in the main
+# table, keeping their expids, with the indexes the pages read by and a
+# search index of their own
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS expenses (
+        expid INTEGER PRIMARY KEY,
+        userid INTEGER,
+        category_id INTEGER,
+        description TEXT,
+        amount REAL,
+        date TIMESTAMP
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_expenses_user_expid ON expenses (userid, expid)",
+    "CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (userid, date, expid)",
+    "CREATE INDEX IF NOT EXISTS idx_expenses_user_category ON expenses (userid, category_id, amount)",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5(owner, words, content='', prefix='2 3 4 5 6')",
+]
+
+# The rows of archived_days the rollups count, shaped like
+# ROLLUP_SOURCE_QUERIES
+ARCHIVED_ROLLUP_QUERIES = {
+    "user_totals": "SELECT userid, 0, SUM(total) FROM archived_days GROUP BY userid",
+    "category_totals": """
+        SELECT userid, category_id, SUM(total), SUM(expense_count) FROM archived_days
+        WHERE category_id != 0
+        GROUP BY userid, category_id
+    """,
+}
+for table, bucket, length in TIME_BUCKETS:
+    ARCHIVED_ROLLUP_QUERIES[table] = f"""
+        SELECT userid, substr(day, 1, {length}), category_id, SUM(total), SUM(expense_count) FROM archived_days
+        GROUP BY 1, 2, 3
+    """
+
+# Number of key columns of each rollup; the two after them are totals
+ROLLUP_KEYS = {"user_totals": 1, "category_totals": 2}
+ROLLUP_KEYS.update((table, 3) for table, _, _ in TIME_BUCKETS)
+
+# What each rollup should hold: the expenses still in the table plus the
+# archived ones
+ROLLUP_EXPECTED_QUERIES = {}
+for table, keys in ROLLUP_KEYS.items():
+    key_columns = ", ".join(f"k{i}" for i in range(keys))
+    ROLLUP_EXPECTED_QUERIES[table] = f"""
+        WITH source ({key_columns}, a, b) AS (
+            {ROLLUP_SOURCE_QUERIES[table]}
+            UNION ALL
+            {ARCHIVED_ROLLUP_QUERIES[table]}
+        )
+        SELECT {key_columns}, SUM(a), SUM(b) FROM source GROUP BY {key_columns}
+    """
+
+# Used by rebuild_rollups() once data_version exists. Keeps each user's
+# data_version and bumps it, since rebuilt totals may differ from what
+# cached output was rendered from.
+ROLLUP_REBUILD = [
+    "UPDATE user_totals SET total_income = 0, total_expenses = 0, data_version = data_version + 1",
+    "INSERT INTO user_totals (userid, total_income, total_expenses, data_version) "
+    "SELECT *, 1 FROM (" + ROLLUP_EXPECTED_QUERIES["user_totals"] + ") WHERE true "
+    "ON CONFLICT (userid) DO UPDATE SET "
+    "total_income = excluded.total_income, total_expenses = excluded.total_expenses",
+    "DELETE FROM category_totals",
+    "INSERT INTO category_totals (userid, category_id, total, expense_count) "
+    + ROLLUP_EXPECTED_QUERIES["category_totals"],
+]
+for table, bucket, _ in TIME_BUCKETS:
+    ROLLUP_REBUILD += [
+        f"DELETE FROM {table}",
+        f"INSERT INTO {table} (userid, {bucket}, category_id, total, expense_count) "
+        + ROLLUP_EXPECTED_QUERIES[table],
+    ]
+
+# Registration did not check for a taken email before migration 2, so an
+# older database can hold several accounts under one. [(email, [userid, ...])],
+# oldest account first.
+def duplicate_emails(db):
+    rows = db.execute("""
+        SELECT email, group_concat(userid) FROM users
+        WHERE email IS NOT NULL
+        GROUP BY email HAVING COUNT(*) > 1
+        ORDER BY email
+    """).fetchall()
+    return [(email, sorted(int(user_id) for user_id in user_ids.split(","))) for email, user_ids in rows]
+
+# Stops migration 2 with the accounts listed instead of failing on the
+# unique index with no hint of which rows are in the way
+def require_unique_emails(db):
+    duplicates = duplicate_emails(db)
+    if duplicates:
+        listed = "; ".join(f"{email} (userids {', '.join(map(str, user_ids))})" for email, user_ids in duplicates)
+        raise RuntimeError(f"Accounts share an email, so emails cannot be made unique: {listed}. "
+                           "Run manage.py dedupe-emails to move all but the oldest account of each "
+                           "to a new email, then start again.")
+
+# Gives every account but the oldest of each shared email the email
+# 'duplicate-<userid>-<email>', and returns (userid, old email, new email)
+# for each
+def dedupe_emails(db):
+    renamed = []
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for email, user_ids in duplicate_emails(db):
+            for user_id in user_ids[1:]:
+                new_email = f"duplicate-{user_id}-{email}"
+                db.execute("UPDATE users SET email=? WHERE userid=?", (new_email, user_id))
+                renamed.append((user_id, email, new_email))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return renamed
+
+# Schema migrations, applied in order and recorded in schema_version.
+# Never edit a released migration; append a new one instead. A step is a
+# statement or a function called with the connection.
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            userid INTEGER PRIMARY KEY AUTOINCREMENT,
+            username VARCHAR(255),
+            email VARCHAR(255),
+            password VARCHAR(255)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS expenses (
+            expid INTEGER PRIMARY KEY AUTOINCREMENT,
+            userid INTEGER,
+            category VARCHAR(255),
+            description TEXT,
+            amount REAL,
+            date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (userid) REFERENCES users(userid)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS income (
+            income_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            income_amount DECIMAL(10, 2),
+            FOREIGN KEY (user_id) REFERENCES users(userid)
+        )
+        """,
+    ]),
+    (2, [
+        # Covers the balance SUM, the category filter and the category GROUP BY
+        "CREATE INDEX IF NOT EXISTS idx_expenses_user_category ON expenses (userid, category, amount)",
+        "CREATE INDEX IF NOT EXISTS idx_income_user ON income (user_id, income_amount)",
+        require_unique_emails,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_email ON users (email)",
+    ]),
+    (3, ROLLUP_TABLES + ROLLUP_TRIGGERS + ROLLUP_BACKFILL),
+    (4, [
+        # Keyset pagination over a user's rows in expid order
+        "CREATE INDEX IF NOT EXISTS idx_expenses_user_expid ON expenses (userid, expid)",
+    ]),
+    (5, ["ALTER TABLE user_totals ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0"] + DATA_VERSION_TRIGGERS),
+    (6, [
+        # Keyset pagination of the table view on (date, expid)
+        "CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (userid, date, expid)",
+    ]),
+    (7, BULK_LOAD_TRIGGERS),
+    (8, BULK_EDIT_TRIGGERS),
+    (9, CATEGORY_IDS),
+    (10, time_bucket_migration()),
+    (11, SEARCH_INDEX),
+    (12, EDIT_VERSION),
+    (13, SHARD_LAYOUT),
+    (14, ARCHIVES),
+    (15, PASSWORD_HASHES),
+]
+
+def get_schema_version(db):
+    return db.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+
+def get_shard_layout(db):
+    return db.execute("SELECT shards FROM shard_layout").fetchone()[0]
+
+def set_shard_layout(db, shards):
+    db.execute("UPDATE shard_layout SET shards = ?", (shards,))
+    db.commit()
+
+def migrate_db(db):
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # IMMEDIATE takes the write lock up front so two processes starting
+    # together cannot both apply the same migration
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        current = get_schema_version(db)
+        for version, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                if callable(statement):
+                    statement(db)
+                else:
+                    db.execute(statement)
+            db.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return get_schema_version(db)
+
+# Rebuilds the rollups from the raw tables and archived_days and returns
+# every row that had drifted, as (table, key, stored, expected)
+def rebuild_rollups(db, tolerance=0.005):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        drift = []
+        stored_queries = {
+            "user_totals": "SELECT userid, total_income, total_expenses FROM user_totals",
+            "category_totals": "SELECT userid, category_id, total, expense_count FROM category_totals",
+        }
+        for table, bucket, _ in TIME_BUCKETS:
+            stored_queries[table] = f"SELECT userid, {bucket}, category_id, total, expense_count FROM {table}"
+        for table, key_columns in ROLLUP_KEYS.items():
+            expected = {row[:key_columns]: row[key_columns:]
+                        for row in db.execute(ROLLUP_EXPECTED_QUERIES[table])}
+            stored = {row[:key_columns]: row[key_columns:]
+                      for row in db.execute(stored_queries[table])}
+            for key in expected.keys() | stored.keys():
+                want = expected.get(key)
+                have = stored.get(key)
+                if want is None or have is None or any(abs(a - b) > tolerance for a, b in zip(want, have)):
+                    drift.append((table, key, have, want))
+        for statement in ROLLUP_REBUILD:
+            db.execute(statement)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return drift
+
+# Reindexes every description, for an index that no longer matches the
+# table. Returns the number of rows indexed.
+def rebuild_search_index(db):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("INSERT INTO expenses_fts (expenses_fts) VALUES ('delete-all')")
+        count = db.execute(SEARCH_INDEX_AFTER, (0,)).rowcount
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return count
+
+# Removes everything stored for one user on a shard except their users row.
+# Run with the bulk_load marker set, so only the search index is updated
+# per row.
+USER_DATA_DELETES = [
+    "DELETE FROM expenses WHERE userid=?",
+    "DELETE FROM income WHERE user_id=?",
+    "DELETE FROM categories WHERE userid=?",
+    "DELETE FROM category_totals WHERE userid=?",
+] + [f"DELETE FROM {table} WHERE userid=?" for table, _, _ in TIME_BUCKETS] + [
+    "DELETE FROM user_totals WHERE userid=?",
+]
+
+# Moves one user's income, categories, expenses and rollups from the source
+# shard to the target, for resharding. Categories and expenses are given new
+# ids on the target in their old order, and the rollups are copied with the
+# ids mapped rather than recomputed. The target commits first: if the source
+# never does, the user still lives there and moving again replaces the copy.
+# Returns the number of expenses moved.
+def move_user_data(source, target, user_id):
+    for db in (target, source):
+        db.execute("BEGIN IMMEDIATE")
+    try:
+        for db in (target, source):
+            db.execute("INSERT INTO bulk_load (userid) VALUES (?)", (user_id,))
+        for statement in USER_DATA_DELETES:
+            target.execute(statement, (user_id,))
+
+        target.executemany("INSERT INTO income (user_id, income_amount) VALUES (?, ?)", source.execute(
+            "SELECT user_id, income_amount FROM income WHERE user_id=? ORDER BY income_id", (user_id,)).fetchall())
+        # Uncategorized bucket rows use category 0
+        category_ids = {0: 0}
+        for category_id, name in source.execute(
+                "SELECT category_id, name FROM categories WHERE userid=? ORDER BY category_id", (user_id,)).fetchall():
+            category_ids[category_id] = target.execute("INSERT INTO categories (userid, name) VALUES (?, ?)",
+                                                       (user_id, name)).lastrowid
+
+        last_expid = target.execute("SELECT COALESCE(MAX(expid), 0) FROM expenses").fetchone()[0]
+        rows = source.execute("SELECT category_id, description, amount, date FROM expenses WHERE userid=? "
+                              "ORDER BY expid", (user_id,))
+        moved = 0
+        while True:
+            batch = rows.fetchmany(IMPORT_BATCH_ROWS)
+            if not batch:
+                break
+            target.executemany("INSERT INTO expenses (userid, category_id, description, amount, date) "
+                               "VALUES (?, ?, ?, ?, ?)",
+                               [(user_id, category_ids.get(row[0]), *row[1:]) for row in batch])
+            moved += len(batch)
+        target.execute(SEARCH_INDEX_AFTER, (last_expid,))
+
+        totals = source.execute("SELECT total_income, total_expenses, data_version, edit_version FROM user_totals "
+                                "WHERE userid=?", (user_id,)).fetchone()
+        if totals:
+            # Both versions move on, so nothing cached from the source is reused
+            target.execute("""
+                INSERT INTO user_totals (userid, total_income, total_expenses, data_version, edit_version)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (userid) DO UPDATE SET
+                    total_income = excluded.total_income,
+                    total_expenses = excluded.total_expenses,
+                    data_version = excluded.data_version,
+                    edit_version = excluded.edit_version
+            """, (user_id, totals[0], totals[1], totals[2] + 1, totals[3] + 1))
+        target.executemany(
+            "INSERT INTO category_totals (userid, category_id, total, expense_count) VALUES (?, ?, ?, ?)",
+            [(user_id, category_ids[row[0]], *row[1:]) for row in source.execute(
+                "SELECT category_id, total, expense_count FROM category_totals WHERE userid=?", (user_id,))])
+        for table, bucket, _ in TIME_BUCKETS:
+            target.executemany(
+                f"INSERT INTO {table} (userid, {bucket}, category_id, total, expense_count) VALUES (?, ?, ?, ?, ?)",
+                [(user_id, row[0], category_ids[row[1]], *row[2:]) for row in source.execute(
+                    f"SELECT {bucket}, category_id, total, expense_count FROM {table} WHERE userid=?", (user_id,))])
+
+        for statement in USER_DATA_DELETES:
+            source.execute(statement, (user_id,))
+        for db in (target, source):
+            db.execute("DELETE FROM bulk_load")
+        target.commit()
+        source.commit()
+    except Exception:
+        target.rollback()
+        source.rollback()
+        raise
+    return moved
+
+# Archiving a batch of expids (in temp.archive_batch) takes separate
+# transactions, since SQLite commits the main database and an attached WAL
+# one separately. ARCHIVE_COPY copies the rows into the archive with schema
+# `schema`, replacing any copy a stopped run left. ARCHIVE_REMOVE then takes
+# the rows still matching their copy, adds them to archived_days and deletes
+# them from expenses with the per-row rollup triggers suspended, so the
+# rollups keep counting them while the search index trigger drops them from
+# the main index. ARCHIVE_STALE last drops the copies of rows that were
+# edited in between and so stayed. Until ARCHIVE_REMOVE commits a row is in
+# both places; reads skip the second copy, and the data version bump makes
+# cached counts taken meanwhile stale.
+ARCHIVE_COPY = [
+    """
+    INSERT INTO {schema}.expenses_fts (expenses_fts, rowid, owner, words)
+    SELECT 'delete', expid, 'u' || userid, description FROM {schema}.expenses
+    WHERE expid IN (SELECT expid FROM temp.archive_batch)
+    """,
+    "DELETE FROM {schema}.expenses WHERE expid IN (SELECT expid FROM temp.archive_batch)",
+    """
+    INSERT INTO {schema}.expenses (expid, userid, category_id, description, amount, date)
+    SELECT expid, userid, category_id, description, amount, date FROM main.expenses
+    WHERE expid IN (SELECT expid FROM temp.archive_batch)
+    """,
+    """
+    INSERT INTO {schema}.expenses_fts (rowid, owner, words)
+    SELECT expid, 'u' || userid, description FROM {schema}.expenses
+    WHERE expid IN (SELECT expid FROM temp.archive_batch)
+    """,
+]
+
+ARCHIVE_REMOVE = [
+    "DELETE FROM temp.archive_moved",
+    """
+    INSERT INTO temp.archive_moved (expid)
+    SELECT expid FROM main.expenses AS hot JOIN {schema}.expenses AS copy USING (expid)
+    WHERE expid IN (SELECT expid FROM temp.archive_batch)
+        AND hot.userid IS copy.userid AND hot.category_id IS copy.category_id
+        AND hot.description IS copy.description AND hot.amount IS copy.amount AND hot.date IS copy.date
+    """,
+    """
+    INSERT INTO archived_days (userid, day, category_id, total, expense_count)
+    SELECT userid, substr(date, 1, 10), COALESCE(category_id, 0), SUM(COALESCE(amount, 0)), COUNT(*)
+    FROM main.expenses
+    WHERE expid IN (SELECT expid FROM temp.archive_moved)
+    GROUP BY 1, 2, 3
+    ON CONFLICT (userid, day, category_id) DO UPDATE SET
+        total = total + excluded.total,
+        expense_count = expense_count + excluded.expense_count
+    """,
+    """
+    UPDATE user_totals SET data_version = data_version + 1
+    WHERE userid IN (SELECT userid FROM main.expenses WHERE expid IN (SELECT expid FROM temp.archive_moved))
+    """,
+    "INSERT OR IGNORE INTO bulk_load (userid) VALUES (0)",
+    "DELETE FROM main.expenses WHERE expid IN (SELECT expid FROM temp.archive_moved)",
+    "DELETE FROM bulk_load",
+]
+
+ARCHIVE_STALE = [
+    """
+    INSERT INTO {schema}.expenses_fts (expenses_fts, rowid, owner, words)
+    SELECT 'delete', expid, 'u' || userid, description FROM {schema}.expenses
+    WHERE expid IN (SELECT expid FROM temp.archive_batch) AND expid IN (SELECT expid FROM main.expenses)
+    """,
+    """
+    DELETE FROM {schema}.expenses
+    WHERE expid IN (SELECT expid FROM temp.archive_batch) AND expid IN (SELECT expid FROM main.expenses)
+    """,
+]
+
+def create_archive(path):
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=WAL")
+    for statement in ARCHIVE_SCHEMA:
+        db.execute(statement)
+    db.commit()
+    db.close()
+
+# Runs statements on db in one transaction
+def run_transaction(db, statements, begin="BEGIN"):
+    db.execute(begin)
+    try:
+        for statement in statements:
+            db.execute(statement)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+# Moves the expenses of the database at `path` dated before cutoff
+# ('YYYY-MM-DD') into its yearly archives, ARCHIVE_BATCH_ROWS at a time so
+# the app's writes wait on at most one batch. An archive is only read once
+# archives lists its year, so whatever an unlisted one holds is left from a
+# stopped run or a restore and is cleared first. Calls progress(year, rows)
+# after each batch and returns {year: rows archived}.
+def archive_expenses(db, path, cutoff, progress=None):
+    by_year = {}
+    for expid, year in db.execute("SELECT expid, substr(date, 1, 4) FROM expenses WHERE date < ? ORDER BY expid",
+                                  (cutoff,)).fetchall():
+        by_year.setdefault(int(year), []).append(expid)
+    listed = {row[0] for row in db.execute("SELECT year FROM archives").fetchall()}
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS archive_batch (expid INTEGER PRIMARY KEY)")
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS archive_moved (expid INTEGER PRIMARY KEY)")
+    archived = {}
+    for year, expids in sorted(by_year.items()):
+        create_archive(archive_path(year, path))
+        schema, = attach_archives(db, path, [year])
+        if year not in listed:
+            run_transaction(db, [f"DELETE FROM {schema}.expenses",
+                                 f"INSERT INTO {schema}.expenses_fts (expenses_fts) VALUES ('delete-all')"])
+        archived[year] = 0
+        for start in range(0, len(expids), ARCHIVE_BATCH_ROWS):
+            batch = expids[start:start + ARCHIVE_BATCH_ROWS]
+            db.execute("DELETE FROM temp.archive_batch")
+            db.executemany("INSERT INTO temp.archive_batch (expid) VALUES (?)", [(expid,) for expid in batch])
+            db.commit()
+            run_transaction(db, [statement.format(schema=schema) for statement in ARCHIVE_COPY])
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                for statement in ARCHIVE_REMOVE:
+                    db.execute(statement.format(schema=schema))
+                moved = db.execute("SELECT COUNT(*) FROM temp.archive_moved").fetchone()[0]
+                db.execute("""
+                    INSERT INTO archives (year, cutoff) VALUES (?, ?)
+                    ON CONFLICT (year) DO UPDATE SET cutoff = MAX(cutoff, excluded.cutoff)
+                """, (year, min(cutoff, f"{year + 1}-01-01")))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            if moved < len(batch):
+                run_transaction(db, [statement.format(schema=schema) for statement in ARCHIVE_STALE])
+            archived[year] += moved
+            if progress:
+                progress(year, archived[year])
+    return archived
+
+# Moves every row of one yearly archive back into expenses under its old
+# expid and takes the year out of archived_days and archives, then empties
+# the archive. App processes may still have the file attached, so it is
+# emptied rather than deleted. Returns the number of rows restored.
+def restore_archive(db, path, year):
+    schema, = attach_archives(db, path, [year])
+    # Rows still in the main table were never counted as archived
+    missing = f"FROM {schema}.expenses WHERE expid NOT IN (SELECT expid FROM main.expenses)"
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        db.execute("INSERT OR IGNORE INTO bulk_load (userid) VALUES (0)")
+        db.execute("""
+            UPDATE user_totals SET data_version = data_version + 1
+            WHERE userid IN (SELECT userid FROM archived_days WHERE day >= ? AND day < ?)
+        """, (f"{year}-01-01", f"{year + 1}-01-01"))
+        db.execute(f"INSERT INTO main.expenses_fts (rowid, owner, words) "
+                   f"SELECT expid, 'u' || userid, description {missing}")
+        count = db.execute(f"INSERT INTO main.expenses (expid, userid, category_id, description, amount, date) "
+                           f"SELECT expid, userid, category_id, description, amount, date {missing}").rowcount
+        db.execute("DELETE FROM bulk_load")
+        db.execute("DELETE FROM archived_days WHERE day >= ? AND day < ?", (f"{year}-01-01", f"{year + 1}-01-01"))
+        db.execute("DELETE FROM archives WHERE year=?", (year,))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    run_transaction(db, [f"DELETE FROM {schema}.expenses",
+                         f"INSERT INTO {schema}.expenses_fts (expenses_fts) VALUES ('delete-all')"])
+    return count
+
+# Columnar snapshot of a database's expenses for analytics, in
+# snapshot_path(): typed .npy arrays read back memory-mapped, so a user's
+# rows are a zero-copy slice that numpy reduces without building a Python
+# object per row. Amounts are whole cents and dates days since 1970-01-01.
+SNAPSHOT_COLUMNS = {"expid": "int64", "userid": "int32", "category_id": "int32", "cents": "int64", "day": "int32"}
+# The day of an expense without a parseable date
+SNAPSHOT_NO_DAY = -2**31
+SNAPSHOT_FETCH_ROWS = 100000
+# Refreshes past this many segments are merged back into one
+SNAPSHOT_MAX_SEGMENTS = 8
+# Rank is 0 for the main table and 1 for an archive, so a row read from both
+# while it is being archived keeps its main copy
+SNAPSHOT_SELECT = f"""
+    SELECT {{rank}}, expid, userid, COALESCE(category_id, 0), CAST(ROUND(COALESCE(amount, 0) * 100) AS INTEGER),
+           COALESCE(CAST(julianday(substr(date, 1, 10)) - 2440587.5 AS INTEGER), {SNAPSHOT_NO_DAY})
+    FROM {{schema}}.expenses WHERE {{where}}
+"""
+
+def snapshot_path(path=DB_PATH):
+    root, _ = os.path.splitext(path)
+    return f"{root}.snapshot"
+
+# The rows matching where (over expenses in main and the listed archives) as
+# an (n, 5) int64 array in SNAPSHOT_COLUMNS order, each expid once
+def read_snapshot_rows(db, path, years, where, params=()):
+    import numpy as np
+    chunks = [np.empty((0, 6), dtype=np.int64)]
+    for start in range(0, max(len(years), 1), ARCHIVES_ATTACHED):
+        schemas = attach_archives(db, path, years[start:start + ARCHIVES_ATTACHED])
+        if start == 0:
+            schemas.insert(0, "main")
+        cursor = db.execute(" UNION ALL ".join(SNAPSHOT_SELECT.format(rank=int(schema != "main"), schema=schema,
+                                                                      where=where) for schema in schemas),
+                            [*params] * len(schemas))
+        while rows := cursor.fetchmany(SNAPSHOT_FETCH_ROWS):
+            chunks.append(np.array(rows, dtype=np.int64))
+    rows = np.concatenate(chunks)
+    if years:
+        rows = rows[np.lexsort((rows[:, 0], rows[:, 1]))]
+        rows = rows[np.unique(rows[:, 1], return_index=True)[1]]
+    return rows[:, 1:]
+
+def write_snapshot_segment(directory, name, rows, full_users, state):
+    import numpy as np
+    rows = rows[np.lexsort((rows[:, 0], rows[:, 1]))]
+    users = np.union1d(rows[:, 1], full_users)
+    arrays = {column: rows[:, index].astype(dtype) for index, (column, dtype) in enumerate(SNAPSHOT_COLUMNS.items())}
+    arrays["users"] = users
+    arrays["offsets"] = np.append(np.searchsorted(rows[:, 1], users), len(rows))
+    arrays["full"] = np.isin(users, full_users)
+    for column, values in state.items():
+        arrays[f"state_{column}"] = values
+    partial = os.path.join(directory, f"{name}.partial")
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    for array_name, values in arrays.items():
+        np.save(os.path.join(partial, f"{array_name}.npy"), values)
+    os.rename(partial, os.path.join(directory, name))
+
+# A snapshot as of its last refresh. Segments are written oldest first; each
+# holds, per user, the rows added since the one before, or all of the user's
+# rows where `full` is set, after the user's rows were edited or deleted.
+class ExpenseSnapshot:
+    def __init__(self, directory):
+        import numpy as np
+        self.directory = directory
+        with open(os.path.join(directory, "manifest.json")) as manifest:
+            self.manifest = json.load(manifest)
+        self.segments = []
+        for name in self.manifest["segments"]:
+            segment = {}
+            for array_name in os.listdir(os.path.join(directory, name)):
+                segment[array_name[:-4]] = np.load(os.path.join(directory, name, array_name), mmap_mode="r")
+            self.segments.append(segment)
+
+    @property
+    def state(self):
+        return {column[6:]: values for column, values in self.segments[-1].items() if column.startswith("state_")}
+
+    # The user's (data_version, edit_version) as of the last refresh, or None
+    # for a user it does not know
+    def versions(self, user_id):
+        import numpy as np
+        state = self.state
+        index = np.searchsorted(state["userid"], user_id)
+        if index == len(state["userid"]) or state["userid"][index] != user_id:
+            return None
+        return int(state["data_version"][index]), int(state["edit_version"][index])
+
+    # The user's columns in expid order: views into the mapped files while
+    # one segment holds all of the user's rows, copies otherwise
+    def columns(self, user_id):
+        import numpy as np
+        slices = []
+        for segment in reversed(self.segments):
+            users = segment["users"]
+            index = np.searchsorted(users, user_id)
+            if index < len(users) and users[index] == user_id:
+                start, stop = segment["offsets"][index], segment["offsets"][index + 1]
+                slices.append({column: segment[column][start:stop] for column in SNAPSHOT_COLUMNS})
+                if segment["full"][index]:
+                    break
+        if len(slices) == 1:
+            return slices[0]
+        if not slices:
+            return {column: np.empty(0, dtype=dtype) for column, dtype in SNAPSHOT_COLUMNS.items()}
+        return {column: np.concatenate([part[column] for part in reversed(slices)]) for column in SNAPSHOT_COLUMNS}
+
+    # [(category_id, total)] by category id, uncategorized spending left out
+    # as in category_totals
+    def category_totals(self, user_id):
+        import numpy as np
+        columns = self.columns(user_id)
+        ids, codes = np.unique(columns["category_id"], return_inverse=True)
+        cents = np.bincount(codes, weights=columns["cents"], minlength=len(ids))
+        return [(int(category_id), total / 100) for category_id, total in zip(ids, cents) if category_id != 0]
+
+    # [(month, category_id, total)] for the months first..last ('YYYY-MM') in
+    # month and category order, shaped like monthly_totals before names
+    def monthly_totals(self, user_id, first_month, last_month):
+        import numpy as np
+        columns = self.columns(user_id)
+        months = columns["day"].astype("datetime64[D]").astype("datetime64[M]")
+        keep = (columns["day"] != SNAPSHOT_NO_DAY) & (months >= np.datetime64(first_month, "M")) & (
+            months <= np.datetime64(last_month, "M"))
+        if not keep.any():
+            return []
+        # One bucket per (month, category), numbered month by month
+        categories, codes = np.unique(columns["category_id"][keep], return_inverse=True)
+        months = months[keep].astype(np.int64)
+        first = months.min()
+        buckets = (months - first) * len(categories) + codes
+        counts = np.bincount(buckets)
+        cents = np.bincount(buckets, weights=columns["cents"][keep])
+        used = np.flatnonzero(counts)
+        return [(str(np.datetime64(int(first + bucket // len(categories)), "M")),
+                 int(categories[bucket % len(categories)]) or None, cents[bucket] / 100) for bucket in used]
+
+    # [(day, total)] across categories for the days first..last ('YYYY-MM-DD')
+    def daily_totals(self, user_id, first_day, last_day):
+        import numpy as np
+        columns = self.columns(user_id)
+        first, last = (np.datetime64(day, "D").astype(np.int64) for day in (first_day, last_day))
+        keep = (columns["day"] >= first) & (columns["day"] <= last)
+        days, codes = np.unique(columns["day"][keep], return_inverse=True)
+        cents = np.bincount(codes, weights=columns["cents"][keep], minlength=len(days))
+        return [(str(np.datetime64(int(day), "D")), total / 100) for day, total in zip(days, cents)]
+
+    # Each segment's rows that are still current: those of users no newer
+    # segment holds in full. Yields (segment, mask or None for all rows).
+    def live_rows(self):
+        import numpy as np
+        replaced = np.empty(0, dtype=np.int64)
+        live = []
+        for segment in reversed(self.segments):
+            live.append((segment, np.isin(segment["userid"], replaced) if len(replaced) else None))
+            replaced = np.union1d(replaced, segment["users"][segment["full"]])
+        for segment, mask in reversed(live):
+            yield segment, None if mask is None else ~mask
+
+    # Every user's spending in one pass: (userids, totals), by userid
+    def user_totals(self):
+        import numpy as np
+        users = []
+        cents = []
+        for segment, mask in self.live_rows():
+            amounts = segment["cents"] if mask is None else np.where(mask, segment["cents"], 0)
+            sums = np.concatenate([[0], np.cumsum(amounts)])
+            offsets = segment["offsets"]
+            users.append(segment["users"])
+            cents.append(sums[offsets[1:]] - sums[offsets[:-1]])
+        ids, codes = np.unique(np.concatenate(users or [np.empty(0, np.int64)]), return_inverse=True)
+        totals = np.bincount(codes, weights=np.concatenate(cents or [np.empty(0)]), minlength=len(ids))
+        return ids, totals / 100
+
+# Where each of keys sits in sorted_keys, and whether it is there at all
+def sorted_positions(sorted_keys, keys):
+    import numpy as np
+    index = np.searchsorted(sorted_keys, keys)
+    found = index < len(sorted_keys)
+    found[found] = sorted_keys[index[found]] == keys[found]
+    return index, found
+
+# Points the manifest at `names` and deletes every other segment
+def write_snapshot_manifest(directory, names, next_segment):
+    partial = os.path.join(directory, "manifest.json.partial")
+    with open(partial, "w") as manifest:
+        json.dump({"segments": names, "next_segment": next_segment}, manifest)
+    os.replace(partial, os.path.join(directory, "manifest.json"))
+    for name in os.listdir(directory):
+        if name.startswith("segment") and name not in names:
+            shutil.rmtree(os.path.join(directory, name))
+
+# Brings the snapshot of the database at `path` up to date with one new
+# segment. Rows are read per user the way ExpenseFrameCache reads them: only
+# those past the user's last exported expid while their edit_version stands
+# still, all of them again once it moves or the user leaves the file. Past
+# SNAPSHOT_MAX_SEGMENTS the segments are merged into one. Returns {"rows",
+# "users", "full_users", "segments"}; nothing is written when no user
+# changed.
+def refresh_snapshot(db, path, directory=None):
+    import numpy as np
+    directory = directory or snapshot_path(path)
+    os.makedirs(directory, exist_ok=True)
+    try:
+        snapshot = ExpenseSnapshot(directory)
+    except FileNotFoundError:
+        snapshot = None
+    # Versions are read before rows, so a write in between is either in the
+    # rows already or read next time, never missed
+    versions = np.array(db.execute("SELECT userid, data_version, edit_version FROM user_totals ORDER BY userid")
+                        .fetchall(), dtype=np.int64).reshape(-1, 3)
+    years = [row[0] for row in db.execute("SELECT year FROM archives ORDER BY year")]
+    state = {"userid": versions[:, 0], "data_version": versions[:, 1], "edit_version": versions[:, 2]}
+
+    if snapshot is None:
+        rows = read_snapshot_rows(db, path, years, "1")
+        full_users = np.union1d(versions[:, 0], rows[:, 1])
+        changed = len(full_users)
+        state["last_expid"] = np.zeros(len(versions), dtype=np.int64)
+        names, next_segment = [], 0
+    else:
+        old = snapshot.state
+        index, known = sorted_positions(old["userid"], versions[:, 0])
+
+        def previous(column):
+            values = np.zeros(len(versions), dtype=np.int64)
+            values[known] = old[column][index[known]]
+            return values
+
+        edited = ~known | (previous("edit_version") != versions[:, 2])
+        added = ~edited & (previous("data_version") != versions[:, 1])
+        full_users = np.union1d(versions[edited, 0], np.setdiff1d(old["userid"], versions[:, 0]))
+        state["last_expid"] = previous("last_expid")
+        chunks = [np.empty((0, 5), dtype=np.int64)]
+        for user_id in versions[edited, 0].tolist():
+            chunks.append(read_snapshot_rows(db, path, years, "userid=?", (user_id,)))
+        for user_id, last_expid in zip(versions[added, 0].tolist(), state["last_expid"][added].tolist()):
+            chunks.append(read_snapshot_rows(db, path, years, "userid=? AND expid > ?", (user_id, last_expid)))
+        rows = np.concatenate(chunks)
+        changed = len(full_users) + int(added.sum())
+        names, next_segment = list(snapshot.manifest["segments"]), snapshot.manifest["next_segment"]
+        if not changed:
+            return {"rows": 0, "users": 0, "full_users": 0, "segments": len(names)}
+
+    # A user's last exported expid is the highest read for them, starting
+    # over for those read in full
+    state["last_expid"][np.isin(state["userid"], full_users)] = 0
+    index, found = sorted_positions(state["userid"], rows[:, 1])
+    np.maximum.at(state["last_expid"], index[found], rows[found, 0])
+
+    names.append(f"segment{next_segment:06d}")
+    write_snapshot_segment(directory, names[-1], rows, full_users, state)
+    write_snapshot_manifest(directory, names, next_segment + 1)
+    next_segment += 1
+    if len(names) > SNAPSHOT_MAX_SEGMENTS:
+        snapshot = ExpenseSnapshot(directory)
+        live = [np.stack([segment[column] if mask is None else segment[column][mask] for column in SNAPSHOT_COLUMNS],
+                         axis=1).astype(np.int64) for segment, mask in snapshot.live_rows()]
+        merged = np.concatenate(live)
+        names = [f"segment{next_segment:06d}"]
+        write_snapshot_segment(directory, names[0], merged, np.union1d(state["userid"], merged[:, 1]), state)
+        write_snapshot_manifest(directory, names, next_segment + 1)
+    return {"rows": len(rows), "users": changed, "full_users": len(full_users), "segments": len(names)}
+
+def initialize_db(pool):
+    db = pool.acquire()
+    try:
+        if not pool.read_only:
+            return migrate_db(db)
+        # A read-only connection cannot migrate, and an older schema would
+        # be missing tables the queries need
+        version = get_schema_version(db)
+        if version < MIGRATIONS[-1][0]:
+            raise RuntimeError(f"{pool.path} is at schema version {version}; run manage.py migrate first")
+        return version
+    finally:
+        db.close()
+
+# Builds the WHERE clause shared by the table view and the exports.
+# end_date and the amount bounds are inclusive.
+def expense_filters(user_id, category_id=None, start_date=None, end_date=None,
+                    min_amount=None, max_amount=None, description_prefix=None):
+    clauses = ["userid=?"]
+    params = [user_id]
+    if category_id is not None:
+        clauses.append("category_id=?")
+        params.append(category_id)
+    if start_date:
+        clauses.append("date >= ?")
+        params.append(start_date.isoformat())
+    if end_date:
+        clauses.append("date < ?")
+        params.append((end_date + timedelta(days=1)).isoformat())
+    if min_amount is not None:
+        clauses.append("amount >= ?")
+        params.append(min_amount)
+    if max_amount is not None:
+        clauses.append("amount <= ?")
+        params.append(max_amount)
+    if description_prefix:
+        # '!' needs no escaping in either SQLite or MySQL string literals
+        clauses.append("description LIKE ? ESCAPE '!'")
+        params.append(re.sub(r"([!%_])", r"!\1", description_prefix) + "%")
+    return " AND ".join(clauses), params
+
+# The words of search box text, split where the search index splits them
+def search_terms(text):
+    return re.findall(r"[^\W_]+", text or "")
+
+# Storage backends. Every query the pages issue goes through one repository
+# so the app can run on a local SQLite file or on a shared MySQL server.
+# Statements use ? placeholders, which sqlite3 and MySQL prepared statements
+# both accept; a backend only overrides what its dialect spells differently.
+
+class DuplicateEmailError(Exception):
+    pass
+
+class ExpenseRepository:
+    integrity_errors = ()
+    # The date column as selected for display and keyset cursors: always
+    # 'YYYY-MM-DD HH:MM:SS' text, whatever type the backend stores it as
+    date_column = "date"
+    insert_ignore = "INSERT OR IGNORE"
+    # Restricts a query to rows matching _search_match(), in the search
+    # index of the schema the rows are read from
+    search_filter = "expid IN (SELECT rowid FROM {schema}.expenses_fts WHERE expenses_fts MATCH ?)"
+
+    def __init__(self):
+        # Category ids are never reused or renamed, so both directions of
+        # the dictionary can be cached for the life of the process
+        self._category_names = {}
+        self._category_ids = {}
+
+    def connect(self):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    # Inserts (userid, category_id, description, amount, date) rows and adds
+    # their precomputed totals to the rollups: totals are category_totals
+    # rows, buckets maps each TIME_BUCKETS table to its rows
+    def import_batch(self, user_id, rows, totals, buckets):
+        raise NotImplementedError
+
+    def _fetchall(self, sql, params):
+        db = self.connect()
+        try:
+            return db.execute(sql, params).fetchall()
+        finally:
+            db.close()
+
+    def _fetchone(self, sql, params):
+        rows = self._fetchall(sql, params)
+        return rows[0] if rows else None
+
+    # Runs one write and returns the number of rows it changed
+    def _write(self, sql, params):
+        db = self.connect()
+        try:
+            count = db.execute(sql, params).rowcount
+            db.commit()
+        finally:
+            db.close()
+        return count
+
+    # (userid, username, stored password, has income) for the login form,
+    # in one lookup through the email index
+    def find_login(self, email):
+        row = self._fetchone("""
+            SELECT userid, username, password, EXISTS (SELECT 1 FROM income WHERE user_id = users.userid)
+            FROM users WHERE email=?
+        """, (email,))
+        return (row[0], row[1], row[2], bool(row[3])) if row else None
+
+    def find_user_by_email(self, email):
+        row = self._fetchone("SELECT userid FROM users WHERE email=?", (email,))
+        return row[0] if row else None
+
+    # Passwords are stored as given: pass them through app.hash_password()
+    def create_user(self, username, email, password_hash):
+        db = self.connect()
+        try:
+            user_id = db.execute("INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+                                 (username, email, password_hash)).lastrowid
+            db.commit()
+        except self.integrity_errors:
+            raise DuplicateEmailError(email) from None
+        finally:
+            db.close()
+        return user_id
+
+    def set_password(self, email, password_hash):
+        return self._write("UPDATE users SET password=? WHERE email=?", (password_hash, email))
+
+    def has_income(self, user_id):
+        return self._fetchone("SELECT income_amount FROM income WHERE user_id=?", (user_id,)) is not None
+
+    def add_income(self, user_id, amount):
+        self._write("INSERT INTO income (user_id, income_amount) VALUES (?, ?)", (user_id, amount))
+
+    def set_income(self, user_id, amount):
+        return self._write("UPDATE income SET income_amount = ? WHERE user_id = ?", (amount, user_id))
+
+    # (total income, total expenses) from the rollups
+    def get_totals(self, user_id):
+        row = self._fetchone("SELECT total_income, total_expenses FROM user_totals WHERE userid=?", (user_id,))
+        return (float(row[0]), float(row[1])) if row else (0.0, 0.0)
+
+    def data_version(self, user_id):
+        row = self._fetchone("SELECT data_version FROM user_totals WHERE userid=?", (user_id,))
+        return row[0] if row else 0
+
+    # (data_version, edit_version); see EDIT_VERSION
+    def versions(self, user_id):
+        row = self._fetchone("SELECT data_version, edit_version FROM user_totals WHERE userid=?", (user_id,))
+        return tuple(row) if row else (0, 0)
+
+    # The user's categories as {name: category_id}, oldest first
+    def categories(self, user_id):
+        rows = self._fetchall("SELECT name, category_id FROM categories WHERE userid=? ORDER BY category_id",
+                              (user_id,))
+        self._category_names.update((category_id, name) for name, category_id in rows)
+        self._category_ids.update(((user_id, name), category_id) for name, category_id in rows)
+        return dict(rows)
+
+    def add_category(self, user_id, name):
+        self._write(f"{self.insert_ignore} INTO categories (userid, name) VALUES (?, ?)", (user_id, name))
+
+    # The id of the user's category, or None when it does not exist and
+    # create is false
+    def category_id(self, user_id, name, create=False):
+        category_id = self._category_ids.get((user_id, name))
+        if category_id is None:
+            if create:
+                self.add_category(user_id, name)
+            row = self._fetchone("SELECT category_id FROM categories WHERE userid=? AND name=?", (user_id, name))
+            if row is None:
+                return None
+            category_id = self._category_ids[user_id, name] = row[0]
+            self._category_names[category_id] = name
+        return category_id
+
+    # Replaces the category_id in column 1 of each row with its name
+    def _with_names(self, user_id, rows):
+        names = self._category_names
+        if any(row[1] not in names for row in rows if row[1] is not None):
+            self.categories(user_id)
+        return [(row[0], names.get(row[1])) + tuple(row[2:]) for row in rows]
+
+    # expense_filters() for the filters the pages pass, which name the
+    # category and may hold search box text
+    def _expense_filters(self, user_id, filters, schema="main"):
+        filters = dict(filters)
+        category = filters.pop("category", None)
+        terms = search_terms(filters.pop("search", None))
+        filters.pop("archived", None)
+        if category and category != "All":
+            # No category has id 0, so an unknown name matches nothing
+            filters["category_id"] = self.category_id(user_id, category) or 0
+        where, params = expense_filters(user_id, **filters)
+        if terms:
+            where += " AND " + self.search_filter.format(schema=schema)
+            params.append(self._search_match(user_id, terms))
+        return where, params
+
+    # Every word searched for must start a word of the description; matching
+    # a whole word as well ranks higher. Words are quoted so none is read as
+    # an operator.
+    def _search_match(self, user_id, terms):
+        return f"owner:u{user_id} AND " + " AND ".join(f'words:("{term}" OR "{term}"*)' for term in terms)
+
+    def add_expense(self, user_id, category, description, amount):
+        self._write("INSERT INTO expenses (userid, category_id, description, amount) VALUES (?, ?, ?, ?)",
+                    (user_id, self.category_id(user_id, category, create=True), description, amount))
+
+    # Batch edits by expid, each one statement and so one transaction. Only
+    # the user's own rows match; None leaves a field unchanged.
+    def delete_expenses(self, user_id, expids):
+        return self._write_ids("DELETE FROM expenses WHERE userid=? AND expid IN ({ids})", (), user_id, expids)
+
+    def update_expenses(self, user_id, expids, category=None, description=None, amount=None):
+        category_id = self.category_id(user_id, category, create=True) if category else None
+        return self._write_ids("""
+            UPDATE expenses SET
+                category_id = COALESCE(?, category_id),
+                description = COALESCE(?, description),
+                amount = COALESCE(?, amount)
+            WHERE userid=? AND expid IN ({ids})
+        """, (category_id, description, amount), user_id, expids)
+
+    def _write_ids(self, sql, params, user_id, expids):
+        if not expids:
+            return 0
+        return self._write(sql.format(ids=", ".join("?" * len(expids))), [*params, user_id, *expids])
+
+    # Table view page, newest first, after the (date, expid) cursor
+    def expense_page(self, user_id, filters, after, limit):
+        where, params = self._expense_filters(user_id, filters)
+        if after:
+            where += " AND (date, expid) < (?, ?)"
+            params += list(after)
+        return self._with_names(user_id, self._fetchall(f"""
+            SELECT expid, category_id, description, amount, {self.date_column} FROM expenses
+            WHERE {where}
+            ORDER BY date DESC, expid DESC
+            LIMIT ?
+        """, params + [limit]))
+
+    # Export chunk in expid order, after the given expid
+    def expense_chunk(self, user_id, filters, after_expid, limit):
+        where, params = self._expense_filters(user_id, filters)
+        return self._with_names(user_id, self._fetchall(f"""
+            SELECT expid, category_id, description, amount, {self.date_column} FROM expenses
+            WHERE {where} AND expid > ?
+            ORDER BY expid
+            LIMIT ?
+        """, params + [after_expid, limit]))
+
+    # Search results page, best match first, after skipping `offset` rows.
+    # The other filters apply as in expense_page().
+    def search_page(self, user_id, filters, offset, limit):
+        filters = dict(filters)
+        terms = search_terms(filters.pop("search", None))
+        where, params = self._expense_filters(user_id, filters)
+        return self._with_names(user_id, self._fetchall(f"""
+            SELECT expid, category_id, description, amount, {self.date_column}
+            FROM expenses_fts CROSS JOIN expenses ON expid = expenses_fts.rowid
+            WHERE expenses_fts MATCH ? AND {where}
+            ORDER BY bm25(expenses_fts, 0.0, 1.0), expid DESC
+            LIMIT ? OFFSET ?
+        """, [self._search_match(user_id, terms), *params, limit, offset]))
+
+    def count_expenses(self, user_id, filters):
+        where, params = self._expense_filters(user_id, filters)
+        return self._fetchone(f"SELECT COUNT(*) FROM expenses WHERE {where}", params)[0]
+
+    # [(category, total)] in category order
+    def category_totals(self, user_id):
+        rows = self._fetchall("SELECT userid, category_id, total FROM category_totals WHERE userid=?", (user_id,))
+        return sorted((name, total) for _, name, total in self._with_names(user_id, rows))
+
+    def top_category(self, user_id):
+        row = self._fetchone("""
+            SELECT userid, category_id, total
+            FROM category_totals
+            WHERE userid = ?
+            ORDER BY total DESC
+            LIMIT 1
+        """, (user_id,))
+        return self._with_names(user_id, [row])[0][1:] if row else None
+
+    # [(month, category, total)] for the months first..last ('YYYY-MM') in
+    # month order; uncategorized spending has category None
+    def monthly_totals(self, user_id, first_month, last_month):
+        return self._with_names(user_id, self._fetchall("""
+            SELECT month, NULLIF(category_id, 0), total FROM monthly_totals
+            WHERE userid=? AND month BETWEEN ? AND ?
+            ORDER BY month, category_id
+        """, (user_id, first_month, last_month)))
+
+    # [(day, total)] across categories for the days first..last ('YYYY-MM-DD')
+    def daily_totals(self, user_id, first_day, last_day):
+        return self._fetchall("""
+            SELECT day, SUM(total) FROM daily_totals
+            WHERE userid=? AND day BETWEEN ? AND ?
+            GROUP BY day
+            ORDER BY day
+        """, (user_id, first_day, last_day))
+
+    def spent_before(self, user_id, month):
+        row = self._fetchone("SELECT SUM(total) FROM monthly_totals WHERE userid=? AND month < ?", (user_id, month))
+        return float(row[0] or 0)
+
+# Runs the pages' writes on one thread and one connection. Requests that
+# arrive together share a transaction, so many sessions writing at once take
+# the write lock and commit once per batch instead of once per click. Each
+# request runs under its own savepoint: a failing one is rolled back and its
+# error is set on its future without failing the rest of the batch. An error
+# that ends the whole transaction (a ROLLBACK conflict clause, a full disk)
+# takes the savepoint with it; the batch then runs again without that
+# request. Only when the transaction cannot begin or commit does every
+# request get the error, and then none of them was written.
+class WriteQueue:
+    def __init__(self, pool, max_batch=WRITE_BATCH_MAX, max_delay=WRITE_MAX_DELAY):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.writes = 0
+        self.batches = 0
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self._thread.start()
+
+    # Returns a future for (rowcount, lastrowid), set once the write commits
+    def submit(self, sql, params=()):
+        def write(db):
+            cursor = db.execute(sql, params)
+            return cursor.rowcount, cursor.lastrowid
+        return self.call(write)
+
+    # Runs work(db) inside a batch; the future gets its return value
+    def call(self, work):
+        future = Future()
+        self._queue.put((work, future))
+        return future
+
+    # Blocks for the first request, then gathers whatever else arrives within
+    # the latency budget
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get(timeout=max(deadline - time.perf_counter(), 0)))
+            except queue.Empty:
+                break
+        return batch
+
+    # The result or error of each request in the batch
+    def _apply(self, db, batch):
+        results = [None] * len(batch)
+        pending = list(range(len(batch)))
+        while True:
+            failed = None
+            try:
+                db.execute("BEGIN IMMEDIATE")
+                for index in pending:
+                    db.execute("SAVEPOINT write_request")
+                    try:
+                        results[index] = batch[index][0](db)
+                    except Exception as err:
+                        results[index] = err
+                        try:
+                            db.execute("ROLLBACK TO write_request")
+                        except sqlite3.Error:
+                            failed = index
+                            raise err
+                    db.execute("RELEASE write_request")
+                db.commit()
+                return results
+            except Exception as err:
+                if db.in_transaction:
+                    db.rollback()
+                if failed is None:
+                    for index in pending:
+                        results[index] = err
+                    return results
+                pending.remove(failed)
+
+    def _run(self):
+        db = self.pool.acquire()
+        while True:
+            batch = self._collect()
+            results = self._apply(db, batch)
+            self.writes += len(batch)
+            self.batches += 1
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def stats(self):
+        return {"writes": self.writes, "batches": self.batches}
+
+# Rows whose expid has not come before, in order. A row is in both the main
+# table and an archive only while it is being archived.
+def unique_expids(rows):
+    seen = set()
+    return [row for row in rows if not (row[0] in seen or seen.add(row[0]))]
+
+class SQLiteRepository(ExpenseRepository):
+    integrity_errors = (sqlite3.IntegrityError,)
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+        self.writer = WriteQueue(pool)
+        self.archive_reads = 0
+        self._lock = threading.Lock()
+
+    def connect(self):
+        return self.pool.acquire()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.pool.stats(), archive_reads=self.archive_reads)
+
+    # The archives the date range of filters reaches, newest first, as
+    # (year, cutoff). With `before` ('YYYY-MM-DD...'), only those that can
+    # hold rows dated before it. "archived": False in filters reads none, for
+    # callers that only want rows they can still edit.
+    def _archives(self, db, filters, before=None):
+        if filters.get("archived") is False:
+            return []
+        start, end = filters.get("start_date"), filters.get("end_date")
+        last = min(end.year if end else 9999, int(before[:4]) if before else 9999)
+        # Every row of an archive is dated before its cutoff
+        return [(year, cutoff) for year, cutoff in db.execute("SELECT year, cutoff FROM archives ORDER BY year DESC")
+                if (not start or cutoff > start.isoformat()) and year <= last]
+
+    # The rows of `select`, formatted with each schema in turn: the main
+    # database unless main is false, then the archives of `years`. Up to
+    # ARCHIVES_ATTACHED archives go in one compound query ending with `tail`,
+    # so with more the caller merges the groups' rows.
+    def _union(self, db, years, select, params, tail="", tail_params=(), main=True):
+        if years:
+            with self._lock:
+                self.archive_reads += 1
+        rows = []
+        for start in range(0, max(len(years), 1), ARCHIVES_ATTACHED):
+            schemas = attach_archives(db, self.pool.path, years[start:start + ARCHIVES_ATTACHED])
+            if main and start == 0:
+                schemas.insert(0, "main")
+            if schemas:
+                rows += db.execute(" UNION ALL ".join(select.format(schema=schema) for schema in schemas) + tail,
+                                   [*params] * len(schemas) + [*tail_params]).fetchall()
+        return rows
+
+    # The main table's page first; archives are read only when their rows
+    # could belong on it, because the main table ran out of rows or its page
+    # reaches back past an archive's cutoff
+    def expense_page(self, user_id, filters, after, limit):
+        where, params = self._expense_filters(user_id, filters, schema="{schema}")
+        if after:
+            where += " AND (date, expid) < (?, ?)"
+            params += list(after)
+        select = f"SELECT expid, category_id, description, amount, date FROM {{schema}}.expenses WHERE {where}"
+        tail = " ORDER BY date DESC, expid DESC LIMIT ?"
+        db = self.connect()
+        try:
+            rows = self._union(db, [], select, params, tail, [limit])
+            archives = self._archives(db, filters, after[0] if after else None)
+            if archives and (len(rows) < limit or (rows[-1][4] or "") < max(cutoff for _, cutoff in archives)):
+                rows += self._union(db, [year for year, _ in archives], select, params, tail, [limit], main=False)
+                rows = unique_expids(sorted(rows, key=lambda row: (row[4] or "", row[0]), reverse=True))[:limit]
+        finally:
+            db.close()
+        return self._with_names(user_id, rows)
+
+    def expense_chunk(self, user_id, filters, after_expid, limit):
+        where, params = self._expense_filters(user_id, filters, schema="{schema}")
+        select = (f"SELECT expid, category_id, description, amount, date FROM {{schema}}.expenses "
+                  f"WHERE {where} AND expid > ?")
+        db = self.connect()
+        try:
+            years = [year for year, _ in self._archives(db, filters)]
+            rows = self._union(db, years, select, params + [after_expid], " ORDER BY expid LIMIT ?", [limit])
+            if years:
+                rows = unique_expids(sorted(rows, key=lambda row: row[0]))[:limit]
+        finally:
+            db.close()
+        return self._with_names(user_id, rows)
+
+    # Each archive ranks matches against its own search index, which weighs
+    # words by how common they are in that year rather than overall
+    def search_page(self, user_id, filters, offset, limit):
+        filters = dict(filters)
+        terms = search_terms(filters.pop("search", None))
+        where, params = self._expense_filters(user_id, filters, schema="{schema}")
+        select = f"""
+            SELECT expid, category_id, description, amount, date, bm25(expenses_fts, 0.0, 1.0) AS rank
+            FROM {{schema}}.expenses_fts CROSS JOIN {{schema}}.expenses ON expid = expenses_fts.rowid
+            WHERE expenses_fts MATCH ? AND {where}
+        """
+        params = [self._search_match(user_id, terms), *params]
+        db = self.connect()
+        try:
+            years = [year for year, _ in self._archives(db, filters)]
+            if years:
+                rows = self._union(db, years, select, params, " ORDER BY rank, expid DESC LIMIT ?", [offset + limit])
+                rows = unique_expids(sorted(rows, key=lambda row: (row[5], -row[0])))[offset:offset + limit]
+            else:
+                rows = self._union(db, years, select, params, " ORDER BY rank, expid DESC LIMIT ? OFFSET ?",
+                                   [limit, offset])
+        finally:
+            db.close()
+        return self._with_names(user_id, [row[:5] for row in rows])
+
+    def count_expenses(self, user_id, filters):
+        where, params = self._expense_filters(user_id, filters, schema="{schema}")
+        db = self.connect()
+        try:
+            years = [year for year, _ in self._archives(db, filters)]
+            return sum(row[0] for row in self._union(db, years, f"SELECT COUNT(*) FROM {{schema}}.expenses "
+                                                                f"WHERE {where}", params))
+        finally:
+            db.close()
+
+    # Single-row writes wait for the writer thread to commit them
+    def _write(self, sql, params):
+        return self.writer.submit(sql, params).result()[0]
+
+    def _write_ids(self, sql, params, user_id, expids):
+        if not expids:
+            return 0
+        ids = ", ".join("?" * len(expids))
+        return self.writer.call(lambda db: self._edit_batch(db, sql.format(ids=ids), [*params, user_id, *expids],
+                                                            user_id, ids, expids)).result()
+
+    # Runs a batch edit with the per-row triggers suspended (see
+    # BULK_EDIT_TRIGGERS), then moves the totals of the rows it touched from
+    # their old categories, dates and amounts to their new ones
+    def _edit_batch(self, db, sql, params, user_id, ids, expids):
+        # Summed here rather than with GROUP BY, which would make SQLite walk
+        # the user's whole (userid, category) index instead of looking up the
+        # selected expids. Returns {rollup table: {key: (total, rows)}}.
+        def selected_totals():
+            totals = {table: {} for table in ["category_totals"] + [table for table, _, _ in TIME_BUCKETS]}
+            rows = db.execute(f"SELECT category_id, amount, date FROM expenses WHERE userid=? AND expid IN ({ids})",
+                              [user_id, *expids]).fetchall()
+            for category, amount, when in rows:
+                keys = [("category_totals", (category,))]
+                keys += [(table, (when[:length], category or 0)) for table, _, length in TIME_BUCKETS]
+                for table, key in keys:
+                    total, count = totals[table].get(key, (0.0, 0))
+                    totals[table][key] = (total + (amount or 0), count + 1)
+            return totals
+
+        def deltas(table):
+            return ([(user_id, *key, -total, -rows) for key, (total, rows) in before[table].items()]
+                    + [(user_id, *key, total, rows) for key, (total, rows) in after[table].items()])
+
+        db.execute("INSERT INTO bulk_load (userid) VALUES (?)", (user_id,))
+        before = selected_totals()
+        count = db.execute(sql, params).rowcount
+        after = selected_totals()
+        if count:
+            db.executemany("""
+                INSERT INTO category_totals (userid, category_id, total, expense_count) VALUES (?, ?, ?, ?)
+                ON CONFLICT (userid, category_id) DO UPDATE SET
+                    total = total + excluded.total,
+                    expense_count = expense_count + excluded.expense_count
+            """, [delta for delta in deltas("category_totals") if delta[1] is not None])
+            db.execute("DELETE FROM category_totals WHERE userid=? AND expense_count <= 0", (user_id,))
+            for table, bucket, _ in TIME_BUCKETS:
+                db.executemany(BUCKET_UPSERT.format(table=table, bucket=bucket), deltas(table))
+                # Only buckets the rows left can have emptied
+                db.executemany(f"""
+                    DELETE FROM {table} WHERE userid=? AND {bucket}=? AND category_id=? AND expense_count <= 0
+                """, [(user_id, *key) for key in before[table]])
+            # Every row has a day bucket, categorized or not
+            db.execute("""
+                UPDATE user_totals SET
+                    total_expenses = total_expenses + ?,
+                    data_version = data_version + 1,
+                    edit_version = edit_version + 1
+                WHERE userid=?
+            """, (sum(delta[3] for delta in deltas("daily_totals")), user_id))
+        db.execute("DELETE FROM bulk_load")
+        return count
+
+    def create_user(self, username, email, password_hash):
+        future = self.writer.submit("INSERT INTO users (username, email, password) VALUES (?, ?, ?)",
+                                    (username, email, password_hash))
+        try:
+            return future.result()[1]
+        except self.integrity_errors:
+            raise DuplicateEmailError(email) from None
+
+    # Inserts one import batch with the per-row triggers suspended (see
+    # BULK_LOAD_TRIGGERS) and adds its totals to the rollups in the same
+    # transaction
+    def import_batch(self, user_id, rows, totals, buckets):
+        db = self.connect()
+        db.execute(f"PRAGMA cache_size=-{IMPORT_CACHE_KIB}")
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("INSERT INTO bulk_load (userid) VALUES (?)", (user_id,))
+            last_expid = db.execute("SELECT COALESCE(MAX(expid), 0) FROM expenses").fetchone()[0]
+            db.executemany("INSERT INTO expenses (userid, category_id, description, amount, date) "
+                           "VALUES (?, ?, ?, ?, ?)", rows)
+            db.execute(SEARCH_INDEX_AFTER, (last_expid,))
+            db.executemany("""
+                INSERT INTO category_totals (userid, category_id, total, expense_count) VALUES (?, ?, ?, ?)
+                ON CONFLICT (userid, category_id) DO UPDATE SET
+                    total = total + excluded.total,
+                    expense_count = expense_count + excluded.expense_count
+            """, totals)
+            for table, bucket, _ in TIME_BUCKETS:
+                db.executemany(BUCKET_UPSERT.format(table=table, bucket=bucket), buckets[table])
+            db.execute("""
+                INSERT INTO user_totals (userid, total_expenses, data_version) VALUES (?, ?, 1)
+                ON CONFLICT (userid) DO UPDATE SET
+                    total_expenses = total_expenses + excluded.total_expenses,
+                    data_version = data_version + 1
+            """, (user_id, sum(total for _, _, total, _ in totals)))
+            db.execute("DELETE FROM bulk_load")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
+            db.close()
+
+# The MySQL schema, equivalent to the SQLite one after migration 8. The
+# triggers keep user_totals and category_totals current the same way; bulk
+# imports set the session variable @bulk_load to suspend the insert trigger.
+# SQLite never enforced the foreign keys, so they are left out here too.
+MYSQL_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS users (
+        userid INT PRIMARY KEY AUTO_INCREMENT,
+        username VARCHAR(255),
+        email VARCHAR(255),
+        password VARCHAR(255),
+        UNIQUE KEY idx_users_email (email)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS expenses (
+        expid BIGINT PRIMARY KEY AUTO_INCREMENT,
+        userid INT,
+        category VARCHAR(255),
+        description TEXT,
+        amount DOUBLE,
+        date DATETIME DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_expenses_user_category (userid, category, amount),
+        KEY idx_expenses_user_expid (userid, expid),
+        KEY idx_expenses_user_date (userid, date, expid)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS income (
+        income_id INT PRIMARY KEY AUTO_INCREMENT,
+        user_id INT,
+        income_amount DECIMAL(10, 2),
+        KEY idx_income_user (user_id, income_amount)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_totals (
+        userid INT PRIMARY KEY,
+        total_income DOUBLE NOT NULL DEFAULT 0,
+        total_expenses DOUBLE NOT NULL DEFAULT 0,
+        data_version BIGINT NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS category_totals (
+        userid INT NOT NULL,
+        category VARCHAR(255) NOT NULL,
+        total DOUBLE NOT NULL DEFAULT 0,
+        expense_count INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (userid, category)
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_income_insert AFTER INSERT ON income FOR EACH ROW
+        INSERT INTO user_totals (userid, total_income) VALUES (NEW.user_id, COALESCE(NEW.income_amount, 0))
+        ON DUPLICATE KEY UPDATE total_income = total_income + VALUES(total_income)
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_income_delete AFTER DELETE ON income FOR EACH ROW
+        UPDATE user_totals SET total_income = total_income - COALESCE(OLD.income_amount, 0)
+        WHERE userid = OLD.user_id
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_income_update AFTER UPDATE ON income FOR EACH ROW BEGIN
+        UPDATE user_totals SET total_income = total_income - COALESCE(OLD.income_amount, 0)
+        WHERE userid = OLD.user_id;
+        INSERT INTO user_totals (userid, total_income) VALUES (NEW.user_id, COALESCE(NEW.income_amount, 0))
+        ON DUPLICATE KEY UPDATE total_income = total_income + VALUES(total_income);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_insert AFTER INSERT ON expenses FOR EACH ROW BEGIN
+        IF @bulk_load IS NULL THEN
+            INSERT INTO user_totals (userid, total_expenses, data_version)
+            VALUES (NEW.userid, COALESCE(NEW.amount, 0), 1)
+            ON DUPLICATE KEY UPDATE
+                total_expenses = total_expenses + VALUES(total_expenses),
+                data_version = data_version + 1;
+            INSERT INTO category_totals (userid, category, total, expense_count)
+            VALUES (NEW.userid, NEW.category, COALESCE(NEW.amount, 0), 1)
+            ON DUPLICATE KEY UPDATE total = total + VALUES(total), expense_count = expense_count + 1;
+        END IF;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_delete AFTER DELETE ON expenses FOR EACH ROW BEGIN
+        UPDATE user_totals SET
+            total_expenses = total_expenses - COALESCE(OLD.amount, 0),
+            data_version = data_version + 1
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category = OLD.category;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category = OLD.category AND expense_count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_expenses_update AFTER UPDATE ON expenses FOR EACH ROW BEGIN
+        UPDATE user_totals SET
+            total_expenses = total_expenses - COALESCE(OLD.amount, 0),
+            data_version = data_version + 1
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category = OLD.category;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category = OLD.category AND expense_count <= 0;
+        INSERT INTO user_totals (userid, total_expenses, data_version)
+        VALUES (NEW.userid, COALESCE(NEW.amount, 0), 1)
+        ON DUPLICATE KEY UPDATE
+            total_expenses = total_expenses + VALUES(total_expenses),
+            data_version = data_version + 1;
+        INSERT INTO category_totals (userid, category, total, expense_count)
+        VALUES (NEW.userid, NEW.category, COALESCE(NEW.amount, 0), 1)
+        ON DUPLICATE KEY UPDATE total = total + VALUES(total), expense_count = expense_count + 1;
+    END
+    """,
+]
+
+# Migration 9 for MySQL: categories become per-user integer ids
+MYSQL_CATEGORY_IDS = [
+    """
+    CREATE TABLE categories (
+        category_id INT PRIMARY KEY AUTO_INCREMENT,
+        userid INT NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        UNIQUE KEY idx_categories_user_name (userid, name)
+    )
+    """,
+    """
+    INSERT INTO categories (userid, name)
+    SELECT DISTINCT userid, category FROM expenses WHERE category IS NOT NULL ORDER BY userid, category
+    """,
+    "ALTER TABLE expenses ADD COLUMN category_id INT AFTER userid",
+    """
+    UPDATE expenses JOIN categories
+        ON categories.userid = expenses.userid AND categories.name = expenses.category
+    SET expenses.category_id = categories.category_id
+    """,
+    "DROP TRIGGER trg_expenses_insert",
+    "DROP TRIGGER trg_expenses_update",
+    "DROP TRIGGER trg_expenses_delete",
+    """
+    ALTER TABLE expenses
+        DROP INDEX idx_expenses_user_category,
+        DROP COLUMN category,
+        ADD KEY idx_expenses_user_category (userid, category_id, amount)
+    """,
+    "DROP TABLE category_totals",
+    """
+    CREATE TABLE category_totals (
+        userid INT NOT NULL,
+        category_id INT NOT NULL,
+        total DOUBLE NOT NULL DEFAULT 0,
+        expense_count INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (userid, category_id)
+    )
+    """,
+    """
+    INSERT INTO category_totals (userid, category_id, total, expense_count)
+    SELECT userid, category_id, SUM(COALESCE(amount, 0)), COUNT(*)
+    FROM expenses
+    WHERE category_id IS NOT NULL
+    GROUP BY userid, category_id
+    """,
+    """
+    CREATE TRIGGER trg_expenses_insert AFTER INSERT ON expenses FOR EACH ROW BEGIN
+        IF @bulk_load IS NULL THEN
+            INSERT INTO user_totals (userid, total_expenses, data_version)
+            VALUES (NEW.userid, COALESCE(NEW.amount, 0), 1)
+            ON DUPLICATE KEY UPDATE
+                total_expenses = total_expenses + VALUES(total_expenses),
+                data_version = data_version + 1;
+            IF NEW.category_id IS NOT NULL THEN
+                INSERT INTO category_totals (userid, category_id, total, expense_count)
+                VALUES (NEW.userid, NEW.category_id, COALESCE(NEW.amount, 0), 1)
+                ON DUPLICATE KEY UPDATE total = total + VALUES(total), expense_count = expense_count + 1;
+            END IF;
+        END IF;
+    END
+    """,
+    """
+    CREATE TRIGGER trg_expenses_delete AFTER DELETE ON expenses FOR EACH ROW BEGIN
+        UPDATE user_totals SET
+            total_expenses = total_expenses - COALESCE(OLD.amount, 0),
+            data_version = data_version + 1
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category_id = OLD.category_id;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category_id = OLD.category_id AND expense_count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER trg_expenses_update AFTER UPDATE ON expenses FOR EACH ROW BEGIN
+        UPDATE user_totals SET
+            total_expenses = total_expenses - COALESCE(OLD.amount, 0),
+            data_version = data_version + 1
+        WHERE userid = OLD.userid;
+        UPDATE category_totals SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+        WHERE userid = OLD.userid AND category_id = OLD.category_id;
+        DELETE FROM category_totals
+        WHERE userid = OLD.userid AND category_id = OLD.category_id AND expense_count <= 0;
+        INSERT INTO user_totals (userid, total_expenses, data_version)
+        VALUES (NEW.userid, COALESCE(NEW.amount, 0), 1)
+        ON DUPLICATE KEY UPDATE
+            total_expenses = total_expenses + VALUES(total_expenses),
+            data_version = data_version + 1;
+        IF NEW.category_id IS NOT NULL THEN
+            INSERT INTO category_totals (userid, category_id, total, expense_count)
+            VALUES (NEW.userid, NEW.category_id, COALESCE(NEW.amount, 0), 1)
+            ON DUPLICATE KEY UPDATE total = total + VALUES(total), expense_count = expense_count + 1;
+        END IF;
+    END
+    """,
+]
+
+# Migration 10 for MySQL: the time bucket tables and their triggers
+def mysql_time_bucket_migration():
+    statements = []
+    for table, bucket, length in TIME_BUCKETS:
+        old_match = (f"userid = OLD.userid AND {bucket} = LEFT(CAST(OLD.date AS CHAR), {length}) "
+                     f"AND category_id = COALESCE(OLD.category_id, 0)")
+        add_new = f"""
+            INSERT INTO {table} (userid, {bucket}, category_id, total, expense_count)
+            VALUES (NEW.userid, LEFT(CAST(NEW.date AS CHAR), {length}), COALESCE(NEW.category_id, 0),
+                    COALESCE(NEW.amount, 0), 1)
+            ON DUPLICATE KEY UPDATE total = total + VALUES(total), expense_count = expense_count + 1;
+        """
+        remove_old = f"""
+            UPDATE {table} SET total = total - COALESCE(OLD.amount, 0), expense_count = expense_count - 1
+            WHERE {old_match};
+            DELETE FROM {table} WHERE {old_match} AND expense_count <= 0;
+        """
+        statements += [
+            f"""
+            CREATE TABLE {table} (
+                userid INT NOT NULL,
+                {bucket} CHAR({length}) NOT NULL,
+                category_id INT NOT NULL,
+                total DOUBLE NOT NULL DEFAULT 0,
+                expense_count INT NOT NULL DEFAULT 0,
+                PRIMARY KEY (userid, {bucket}, category_id)
+            )
+            """,
+            f"""
+            INSERT INTO {table} (userid, {bucket}, category_id, total, expense_count)
+            SELECT userid, LEFT(CAST(date AS CHAR), {length}), COALESCE(category_id, 0),
+                   SUM(COALESCE(amount, 0)), COUNT(*)
+            FROM expenses
+            GROUP BY 1, 2, 3
+            """,
+            f"""
+            CREATE TRIGGER trg_{table}_insert AFTER INSERT ON expenses FOR EACH ROW BEGIN
+                IF @bulk_load IS NULL THEN {add_new} END IF;
+            END
+            """,
+            f"CREATE TRIGGER trg_{table}_delete AFTER DELETE ON expenses FOR EACH ROW BEGIN {remove_old} END",
+            f"CREATE TRIGGER trg_{table}_update AFTER UPDATE ON expenses FOR EACH ROW BEGIN {remove_old} {add_new} END",
+        ]
+    return statements
+
+# Migration 11 for MySQL: descriptions are searched through a FULLTEXT index
+MYSQL_SEARCH_INDEX = [
+    "ALTER TABLE expenses ADD FULLTEXT INDEX idx_expenses_description (description)",
+]
+
+# Migration 15 for MySQL; see PASSWORD_HASHES
+MYSQL_PASSWORD_HASHES = [
+    "UPDATE users SET password = CONCAT('plain$', password) WHERE password IS NOT NULL",
+]
+
+MYSQL_BUCKET_UPSERT = """
+    INSERT INTO {table} (userid, {bucket}, category_id, total, expense_count) VALUES (%s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE total = total + VALUES(total), expense_count = expense_count + VALUES(expense_count)
+"""
+
+# MySQL schema versions, numbered after the SQLite migration they catch up
+# with. Version 8 is MYSQL_SCHEMA, which databases created before schema
+# versions were recorded already have; its statements are all IF NOT EXISTS.
+MYSQL_MIGRATIONS = [
+    (8, MYSQL_SCHEMA),
+    (9, MYSQL_CATEGORY_IDS),
+    (10, mysql_time_bucket_migration()),
+    (11, MYSQL_SEARCH_INDEX),
+    (15, MYSQL_PASSWORD_HASHES),
+]
+
+# Connection checked out of MySQLRepository. Each statement is prepared once
+# per server connection and its cursor reused on later checkouts; the pool
+# does not reset sessions between checkouts, which would deallocate them.
+class MySQLPooledConnection:
+    statements = 0  # MySQL has no per-statement trace to count with
+
+    def __init__(self, repository, cnx):
+        self._repository = repository
+        self._cnx = cnx
+
+    def _prepared(self, sql):
+        cache = self._repository.prepared.setdefault(self._cnx.connection_id, OrderedDict())
+        entry = cache.get(sql)
+        if entry is None:
+            # The cursor re-prepares whenever it is given a different string
+            # object, so the cached copy of the SQL is what gets executed
+            entry = (self._cnx.cursor(prepared=True), sql)
+            cache[sql] = entry
+            if len(cache) > MYSQL_STATEMENT_CACHE:
+                _, (evicted, _) = cache.popitem(last=False)
+                evicted.close()
+        else:
+            cache.move_to_end(sql)
+        return entry
+
+    def execute(self, sql, params=()):
+        cursor, sql = self._prepared(sql)
+        return InstrumentedCursor(cursor, self, self._repository.metrics).execute(sql, tuple(params))
+
+    # Takes %s placeholders: a plain cursor turns an INSERT into one
+    # multi-row statement, where a prepared one would run per row
+    def executemany(self, sql, seq_of_params):
+        return InstrumentedCursor(self._cnx.cursor(), self, self._repository.metrics).executemany(sql, seq_of_params)
+
+    def start_transaction(self):
+        self._cnx.start_transaction()
+
+    def commit(self):
+        self._cnx.commit()
+
+    def rollback(self):
+        self._cnx.rollback()
+
+    def close(self):
+        if self._cnx is not None:
+            self._repository.release(self._cnx)
+            self._cnx = None
+
+# Backed by mysql.connector's pool. The pool raises instead of waiting when
+# every connection is checked out, so a semaphore makes callers queue.
+class MySQLRepository(ExpenseRepository):
+    date_column = "CAST(date AS CHAR)"
+    insert_ignore = "INSERT IGNORE"
+    search_filter = "MATCH (description) AGAINST (? IN BOOLEAN MODE)"
+
+    # connector is mysql.connector unless given a stand-in for it, such as
+    # mysql_standin
+    def __init__(self, config, metrics, size=POOL_SIZE, connector=None):
+        if connector is None:
+            import mysql.connector
+            import mysql.connector.pooling
+            connector = mysql.connector
+        super().__init__()
+        self.integrity_errors = (connector.IntegrityError,)
+        self.metrics = metrics
+        self.size = size
+        self.prepared = {}
+        self.checkouts = 0
+        self.in_use = 0
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        # FOUND_ROWS makes an UPDATE's row count the rows it matched, as in
+        # SQLite, rather than only those whose values changed
+        self._pool = connector.pooling.MySQLConnectionPool(
+            pool_name="expense_tracker", pool_size=size, pool_reset_session=False, autocommit=True,
+            client_flags=[connector.constants.ClientFlag.FOUND_ROWS], **config)
+
+    # Applies pending MYSQL_MIGRATIONS. MySQL cannot roll DDL back, so a
+    # named lock keeps two nodes from migrating at once instead of a
+    # transaction.
+    def initialize(self):
+        cnx = self._pool.get_connection()
+        try:
+            cursor = cnx.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INT PRIMARY KEY,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("SELECT GET_LOCK('expense_tracker_migrate', 60)")
+            cursor.fetchall()
+            try:
+                cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+                current = cursor.fetchall()[0][0]
+                for version, statements in MYSQL_MIGRATIONS:
+                    if version <= current:
+                        continue
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute("INSERT INTO schema_version (version) VALUES (%s)", (version,))
+            finally:
+                cursor.execute("SELECT RELEASE_LOCK('expense_tracker_migrate')")
+                cursor.fetchall()
+            cursor.close()
+        finally:
+            cnx.close()
+
+    def connect(self):
+        self._slots.acquire()
+        try:
+            cnx = self._pool.get_connection()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+        return MySQLPooledConnection(self, cnx)
+
+    def release(self, cnx):
+        if cnx.in_transaction:
+            cnx.rollback()
+        cnx.close()
+        with self._lock:
+            self.in_use -= 1
+        self._slots.release()
+
+    # Boolean mode with every word required and matched as a prefix. Words
+    # shorter than the server's innodb_ft_min_token_size are not indexed.
+    # Concurrent transactions can commit AUTO_INCREMENT ids out of order, so
+    # rows past the highest expid seen are not all the rows added since.
+    # Every change counts as an edit.
+    def versions(self, user_id):
+        version = self.data_version(user_id)
+        return version, version
+
+    def _search_match(self, user_id, terms):
+        return " ".join(f"+{term}*" for term in terms)
+
+    def search_page(self, user_id, filters, offset, limit):
+        where, params = self._expense_filters(user_id, filters)
+        return self._with_names(user_id, self._fetchall(f"""
+            SELECT expid, category_id, description, amount, {self.date_column} FROM expenses
+            WHERE {where}
+            ORDER BY {self.search_filter} DESC, expid DESC
+            LIMIT ? OFFSET ?
+        """, [*params, self._search_match(user_id, search_terms(filters.get("search"))), limit, offset]))
+
+    # Every connection is opened when the pool is created, so every
+    # checkout reuses one
+    def stats(self):
+        with self._lock:
+            return {"hits": self.checkouts, "misses": 0, "idle": self.size - self.in_use}
+
+    def import_batch(self, user_id, rows, totals, buckets):
+        db = self.connect()
+        try:
+            db.start_transaction()
+            db.execute("SET @bulk_load = 1")
+            db.executemany("INSERT INTO expenses (userid, category_id, description, amount, date) "
+                           "VALUES (%s, %s, %s, %s, %s)", rows)
+            db.executemany("""
+                INSERT INTO category_totals (userid, category_id, total, expense_count) VALUES (%s, %s, %s, %s)
+                ON DUPLICATE KEY UPDATE
+                    total = total + VALUES(total),
+                    expense_count = expense_count + VALUES(expense_count)
+            """, totals)
+            for table, bucket, _ in TIME_BUCKETS:
+                db.executemany(MYSQL_BUCKET_UPSERT.format(table=table, bucket=bucket), buckets[table])
+            db.execute("""
+                INSERT INTO user_totals (userid, total_expenses, data_version) VALUES (?, ?, 1)
+                ON DUPLICATE KEY UPDATE
+                    total_expenses = total_expenses + VALUES(total_expenses),
+                    data_version = data_version + 1
+            """, (user_id, sum(total for _, _, total, _ in totals)))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.execute("SET @bulk_load = NULL")
+            db.close()
+
+# SQLite allows one writer per file, so the SQLite backend can spread users
+# over several files, each with its own pool and writer thread: writes for
+# users on different shards commit in parallel. Everything stored for a user
+# (income, categories, expenses, rollups, search index) lives on the shard
+# user_shard() picks for their userid. The users table stays on shard 0,
+# which assigns userids and answers logins, which look users up by email.
+class ShardedRepository:
+    def __init__(self, pools):
+        self.shards = [SQLiteRepository(pool) for pool in pools]
+        self.directory = self.shards[0]
+
+    def shard(self, user_id):
+        return self.shards[user_shard(user_id, len(self.shards))]
+
+    def stats(self):
+        stats = [shard.stats() for shard in self.shards]
+        return {name: sum(shard[name] for shard in stats) for name in stats[0]}
+
+    # The directory's income table only holds the users of its own shard
+    def find_login(self, email):
+        row = self.directory.find_login(email)
+        if row and self.shard(row[0]) is not self.directory:
+            row = row[:3] + (self.shard(row[0]).has_income(row[0]),)
+        return row
+
+    def find_user_by_email(self, email):
+        return self.directory.find_user_by_email(email)
+
+    def create_user(self, username, email, password_hash):
+        return self.directory.create_user(username, email, password_hash)
+
+    def set_password(self, email, password_hash):
+        return self.directory.set_password(email, password_hash)
+
+# Every ExpenseRepository method taking a user_id first runs on that user's
+# shard
+USER_SHARD_METHODS = [
+    "has_income", "add_income", "set_income", "get_totals", "data_version", "versions", "categories",
+    "add_category", "category_id", "add_expense", "delete_expenses", "update_expenses", "expense_page",
+    "expense_chunk", "search_page", "count_expenses", "category_totals", "top_category", "monthly_totals",
+    "daily_totals", "spent_before", "import_batch",
+]
+
+def on_user_shard(name):
+    def method(self, user_id, *args, **kwargs):
+        return getattr(self.shard(user_id), name)(user_id, *args, **kwargs)
+    method.__name__ = name
+    return method
+
+for name in USER_SHARD_METHODS:
+    setattr(ShardedRepository, name, on_user_shard(name))